@@ -14,6 +14,19 @@ from . import config
 settings = config.Config()
 
 
+def exec_config(filename):
+    "Executes a configuration file and returns the names it defines."
+    environment = {
+        '__builtins__': __builtins__,
+        '__name__': '__config__',
+        '__file__': filename,
+        '__doc__': None,
+        '__package__': None
+    }
+    execfile(filename, environment, environment)
+    return environment
+
+
 # Try loading custom configuration
 def load_config():
     filename = os.environ.get('GOLDENGATE_CONFIG')
@@ -26,15 +39,8 @@ def load_config():
         sys.stderr.write('Invalid filename: ' + filename)
         return
 
-    environment = {
-        '__builtins__': __builtins__,
-        '__name__': '__config__',
-        '__file__': filename,
-        '__doc__': None,
-        '__package__': None
-    }
     try:
-        execfile(filename, environment, environment)
+        environment = exec_config(filename)
     except Exception, e:
         print 'Unable to read configuration file: %s' % filename
         traceback.print_exc()
@@ -50,8 +56,33 @@ def load_config():
             sys.stderr.write("Invalid value for %s: %s\n\n" % (key, value))
             raise
 
+    # Build the entity directory now, so a bad one fails here rather than
+    # on every request.
+    from . import directory
+    try:
+        directory.reload()
+    except ValueError, e:
+        sys.stderr.write("Invalid entity directory: %s\n\n" % (e,))
+        raise
+
 load_config()
 
+
+def reload_config():
+    """
+    Reads the configuration file again and returns a new snapshot of the
+    settings built from it (settings it doesn't set get their defaults). The
+    snapshot isn't installed; see `GoldenGate.reload`. Raises an exception if
+    the file can't be read or has invalid values.
+
+    """
+    filename = os.environ.get('GOLDENGATE_CONFIG')
+    if filename is None:
+        raise ValueError('No configuration file to reload (GOLDENGATE_CONFIG is not set)')
+    environment = exec_config(filename)
+    return settings.build(dict((key.lower(), value) for key, value in environment.items()
+                               if key.lower() in settings.settings))
+
 RANDOM_TOKEN_STRING_LENGTH = 16
 RANDOM_TOKEN_ALPHABET = 'abcdefghjklmnpqrstuvwxyzABCDEFGHJKLMNPQRSTUVWXYZ23456789'
 
@@ -64,3 +95,28 @@ def random_token(length=RANDOM_TOKEN_STRING_LENGTH, alphabet=RANDOM_TOKEN_ALPHAB
 
 def generate_credentials():
     print ', '.join([random_token(), random_token(32)])
+
+
+def approve_request():
+    """
+    Approve a request that uses the two-person integrity policy. The gateway
+    is at GOLDENGATE_URL (http://localhost:8000 by default).
+
+    """
+    import urllib2
+    import urlparse
+    from . import http
+    from .auth import aws
+    if len(sys.argv) != 4:
+        print 'Usage: gg-approve-request <request uuid> <key> <secret>'
+        sys.exit(1)
+    request_uuid, key, secret = sys.argv[1:]
+    gateway = urlparse.urlsplit(os.environ.get('GOLDENGATE_URL', 'http://localhost:8000'))
+    url = http.URL(gateway.scheme, gateway.netloc, '/~/approve/' + request_uuid, {})
+    request = aws.Request('GET', url, [('host', gateway.netloc)], '', None)
+    signed = aws.SignatureMethod_HMAC_SHA256().sign(request, key, secret)
+    try:
+        print urllib2.urlopen(signed.get_url()).read()
+    except urllib2.HTTPError, e:
+        print e.code, e.read()
+        sys.exit(1)
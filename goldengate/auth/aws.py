@@ -1,11 +1,12 @@
 import hmac
+import hashlib
 import base64
 import time
 import calendar
-import random
+import urllib
 
 from .. import settings, http
-from . import base, UnauthenticatedException
+from . import base, replay, UnauthenticatedException
 
 
 def _utf8_str(s):
@@ -16,18 +17,107 @@ def _utf8_str(s):
 
 
 TIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+V4_TIME_FORMAT = '%Y%m%dT%H%M%SZ'
 def generate_timestamp():
     return time.strftime(TIME_FORMAT, time.gmtime())
 def parse_timestamp(timestamp):
+    # Fast path for the fixed-width format everyone actually sends. Anything
+    # else goes through strptime, which is a lot slower but more forgiving.
+    if (len(timestamp) == 19 and timestamp[4] == '-' and timestamp[7] == '-' and
+        timestamp[10] == 'T' and timestamp[13] == ':' and timestamp[16] == ':'):
+        digits = timestamp[0:4] + timestamp[5:7] + timestamp[8:10] + timestamp[11:13] + timestamp[14:16] + timestamp[17:19]
+        if digits.isdigit():
+            year, month, day = int(digits[0:4]), int(digits[4:6]), int(digits[6:8])
+            hour, minute, second = int(digits[8:10]), int(digits[10:12]), int(digits[12:14])
+            if (1 <= month <= 12 and 1 <= day <= calendar.monthrange(year, month)[1] and
+                hour < 24 and minute < 60 and second < 62):
+                return calendar.timegm((year, month, day, hour, minute, second))
     return calendar.timegm(time.strptime(timestamp, TIME_FORMAT))
+def parse_v4_timestamp(timestamp):
+    # SigV4 timestamps are always in the basic format, e.g., 20150830T123600Z.
+    if len(timestamp) != 16 or timestamp[8] != 'T' or timestamp[15] != 'Z':
+        raise ValueError('bad timestamp: %r' % (timestamp,))
+    return parse_timestamp('%s-%s-%sT%s:%s:%s' % (
+        timestamp[0:4], timestamp[4:6], timestamp[6:8], timestamp[9:11], timestamp[11:13], timestamp[13:15]))
+
+
+# Parameters that authenticate a request, as opposed to describing it.
+AUTH_PARAMETERS = frozenset([
+    'AWSAccessKeyId',
+    'Signature',
+    'SignatureMethod',
+    'SignatureVersion',
+    'Timestamp',
+    'Expires',
+    'X-Amz-Algorithm',
+    'X-Amz-Credential',
+    'X-Amz-Date',
+    'X-Amz-Expires',
+    'X-Amz-SignedHeaders',
+    'X-Amz-Signature',
+    'X-Amz-Security-Token',
+])
+AUTH_HEADERS = frozenset([
+    'authorization',
+    'x-amz-date',
+    'x-amz-content-sha256',
+    'x-amz-security-token',
+])
+
+
+def is_read_only(action):
+    "Returns True if `action` starts with one of the configured read-only prefixes."
+    return action is not None and action.startswith(tuple(settings.read_only_action_prefixes))
 
 
 def _are_equal(this, that):
-    # Because someone is going to complain about timing attacks.
+    # Constant-time comparison, because someone is going to complain about
+    # timing attacks.
+    this, that = _utf8_str(this), _utf8_str(that)
+    if hasattr(hmac, 'compare_digest'): # 2.7.7
+        return hmac.compare_digest(this, that)
     if len(this) != len(that):
         return False
-    rot = random.randint(0, len(this)-1)
-    return (this[:rot] + this[rot:]) == (that[:rot] + that[rot:])
+    result = 0
+    for x, y in zip(this, that):
+        result |= ord(x) ^ ord(y)
+    return result == 0
+
+
+HMAC_CACHE_SIZE = 10000
+_hmacs = {}
+def _hmac(secret, digestmod):
+    """
+    Returns a fresh HMAC object for `secret`. Deriving the inner and outer
+    pads from the secret is most of the work of setting one up, so a keyed
+    HMAC is kept for each secret and copied for each use.
+
+    """
+    key = (secret, digestmod)
+    keyed = _hmacs.get(key)
+    if keyed is None:
+        if len(_hmacs) >= HMAC_CACHE_SIZE:
+            _hmacs.clear()
+        keyed = _hmacs[key] = hmac.new(_utf8_str(secret), digestmod=digestmod)
+    return keyed.copy()
+
+
+def unsigned_parameters(request):
+    "Returns a copy of the request's parameters without any auth parameters."
+    return dict((k, v) for k, v in request.url.parameters.iteritems() if k not in AUTH_PARAMETERS)
+
+
+def unsigned_headers(request):
+    "Returns the request's headers without any auth headers."
+    for name, _ in request.headers:
+        if name in AUTH_HEADERS:
+            return [header for header in request.headers if header[0] not in AUTH_HEADERS]
+    return request.headers
+
+
+def as_request(request):
+    "Returns `request` as an `aws.Request`, without copying it if it already is one."
+    return request if isinstance(request, Request) else request._clone(klass=Request)
 
 
 class SignatureMethod(object):
@@ -48,19 +138,32 @@ class SignatureMethod(object):
     def build_signature(self, request, aws_secret):
         raise NotImplementedError
 
+    def sign(self, request, aws_key, aws_secret):
+        """
+        Returns a copy of `request` signed with the given credentials. Any
+        auth parameters or headers the request already had are dropped.
+
+        """
+        parameters = unsigned_parameters(request)
+        parameters['AWSAccessKeyId'] = aws_key
+        parameters['SignatureVersion'] = self.version
+        parameters['SignatureMethod'] = self.name
+        parameters['Timestamp'] = generate_timestamp()
+        signed = request._clone(url=http.clone_url(request.url, parameters=parameters), headers=unsigned_headers(request))
+
+        # The signature isn't part of what's signed, so it can be added to the
+        # (not yet shared) parameters in place.
+        parameters['Signature'] = self.build_signature(signed, aws_secret)
+        return signed
+
 
 class SignatureMethod_HMAC_SHA1(SignatureMethod):
     name = 'HmacSHA1'
     version = '2'
 
     def build_signature(self, request, aws_secret):
-        base = self.build_signature_base_string(request)
-        try:
-            import hashlib # 2.5
-            hashed = hmac.new(aws_secret, base, hashlib.sha1)
-        except ImportError:
-            import sha # deprecated
-            hashed = hmac.new(aws_secret, base, sha)
+        hashed = _hmac(aws_secret, hashlib.sha1)
+        hashed.update(self.build_signature_base_string(request))
         return base64.b64encode(hashed.digest())
 
 
@@ -69,12 +172,107 @@ class SignatureMethod_HMAC_SHA256(SignatureMethod):
     version = '2'
 
     def build_signature(self, request, aws_secret):
-        import hashlib
-        base = self.build_signature_base_string(request)
-        hashed = hmac.new(aws_secret, base, hashlib.sha256)
+        hashed = _hmac(aws_secret, hashlib.sha256)
+        hashed.update(self.build_signature_base_string(request))
         return base64.b64encode(hashed.digest())
 
 
+SIGNING_KEY_CACHE_SIZE = 10000
+_signing_keys = {}
+def _signing_key(aws_secret, date, region, service):
+    """
+    Derives the SigV4 signing key for a credential and scope. The key only
+    changes when the date does, so derived keys are cached.
+
+    """
+    key = (aws_secret, date, region, service)
+    signing_key = _signing_keys.get(key)
+    if signing_key is None:
+        if len(_signing_keys) >= SIGNING_KEY_CACHE_SIZE:
+            _signing_keys.clear()
+        signing_key = 'AWS4' + _utf8_str(aws_secret)
+        for part in (date, region, service, 'aws4_request'):
+            signing_key = hmac.new(signing_key, part, hashlib.sha256).digest()
+        _signing_keys[key] = signing_key
+    return signing_key
+
+
+def _v4_escape(s):
+    return urllib.quote(_utf8_str(s), safe='-_.~')
+
+
+class SignatureMethod_HMAC_SHA256_V4(SignatureMethod):
+    """
+    AWS Signature Version 4. The credential scope (date, region and service)
+    and the signed headers are read from the request's authorization, which
+    can be in the query string or the Authorization header.
+
+    """
+    name = 'AWS4-HMAC-SHA256'
+    version = '4'
+
+    def __init__(self, region=None, service=None):
+        self.region = region
+        self.service = service
+
+    def build_canonical_request(self, request, signed_headers):
+        headers = dict(request.headers)
+        headers.setdefault('host', request.url.host)
+        canonical_headers = ''.join('%s:%s\n' % (name, ' '.join(_utf8_str(headers.get(name, '')).split()))
+                                    for name in signed_headers)
+        parameters = sorted((_v4_escape(k), _v4_escape(v)) for k, v in request.url.parameters.iteritems()
+                            if k != 'X-Amz-Signature')
+        return '\n'.join((
+            request.method,
+            urllib.quote(_utf8_str(request.url.path or '/'), safe='/-_.~'),
+            '&'.join('%s=%s' % parameter for parameter in parameters),
+            canonical_headers,
+            ';'.join(signed_headers),
+            hashlib.sha256(request.body or '').hexdigest(),
+        ))
+
+    def build_signature_base_string(self, request):
+        authorization = request.get_v4_authorization()
+        return '\n'.join((
+            self.name,
+            authorization['date'],
+            authorization['scope'],
+            hashlib.sha256(self.build_canonical_request(request, authorization['signed_headers'])).hexdigest(),
+        ))
+
+    def build_signature(self, request, aws_secret):
+        authorization = request.get_v4_authorization()
+        date, region, service, _ = authorization['scope'].split('/')
+        hashed = _hmac(_signing_key(aws_secret, date, region, service), hashlib.sha256)
+        hashed.update(self.build_signature_base_string(request))
+        return hashed.hexdigest()
+
+    def scope_for_host(self, host):
+        """
+        Returns (region, service) for an endpoint like ec2.us-west-1.amazonaws.com.
+        Endpoints without a region are in us-east-1.
+
+        """
+        parts = host.split(':')[0].split('.')
+        service = self.service or parts[0]
+        region = self.region or (parts[1] if len(parts) > 3 else 'us-east-1')
+        return region, service
+
+    def sign(self, request, aws_key, aws_secret):
+        now = time.gmtime()
+        date = time.strftime('%Y%m%d', now)
+        region, service = self.scope_for_host(request.url.host)
+        parameters = unsigned_parameters(request)
+        parameters['X-Amz-Algorithm'] = self.name
+        parameters['X-Amz-Credential'] = '/'.join((aws_key, date, region, service, 'aws4_request'))
+        parameters['X-Amz-Date'] = time.strftime(V4_TIME_FORMAT, now)
+        parameters['X-Amz-SignedHeaders'] = 'host'
+        signed = request._clone(url=http.clone_url(request.url, parameters=parameters), headers=unsigned_headers(request))
+
+        parameters['X-Amz-Signature'] = self.build_signature(signed, aws_secret)
+        return signed
+
+
 class Request(http.Request):
     """
     A request that uses Amazon AWS's token-based signature authentication,
@@ -84,7 +282,8 @@ class Request(http.Request):
 
     @property
     def aws_action(self):
-        return self.url.parameters['Action']
+        "The request's Action parameter, or None if it doesn't have one."
+        return self.url.parameters.get('Action')
 
     def get_normalized_parameters(self):
         """
@@ -111,16 +310,49 @@ class Request(http.Request):
         # For an empty path use '/'
         return self.url.path if self.url.path else '/'
 
-    def signed_request(self, signature_method, aws_key, aws_secret):
-        parameters = self.url.parameters.copy()
-        parameters['AWSAccessKeyId'] = aws_key
-        parameters['SignatureVersion'] = signature_method.version
-        parameters['SignatureMethod'] = signature_method.name
-        parameters['Timestamp'] = generate_timestamp()
-        prepared = self._clone(url=http.clone_url(self.url, parameters=parameters))
+    def is_v4(self):
+        if 'X-Amz-Algorithm' in self.url.parameters:
+            return True
+        for name, value in self.headers:
+            if name == 'authorization':
+                return value.startswith('AWS4-')
+        return False
 
-        parameters['Signature'] = signature_method.build_signature(prepared, aws_secret)
-        return self._clone(url=http.clone_url(prepared.url, parameters=parameters))
+    def get_v4_authorization(self):
+        """
+        Returns a dict with the SigV4 algorithm, access key, credential scope,
+        date, signed headers and signature of the request, taken from the
+        query string or the Authorization header. Raises KeyError or
+        ValueError if any of them are missing or malformed.
+
+        """
+        parameters = self.url.parameters
+        if 'X-Amz-Algorithm' in parameters:
+            algorithm = parameters['X-Amz-Algorithm']
+            credential = parameters['X-Amz-Credential']
+            signed_headers = parameters['X-Amz-SignedHeaders']
+            signature = parameters.get('X-Amz-Signature')
+            date = parameters['X-Amz-Date']
+        else:
+            headers = dict(self.headers)
+            algorithm, fields = headers['authorization'].split(' ', 1)
+            fields = dict(field.strip().split('=', 1) for field in fields.split(','))
+            credential = fields['Credential']
+            signed_headers = fields['SignedHeaders']
+            signature = fields['Signature']
+            date = headers['x-amz-date']
+        aws_key, scope = credential.split('/', 1)
+        return {
+            'algorithm': algorithm,
+            'aws_key': aws_key,
+            'scope': scope,
+            'date': date,
+            'signed_headers': signed_headers.lower().split(';'),
+            'signature': signature,
+        }
+
+    def signed_request(self, signature_method, aws_key, aws_secret):
+        return signature_method.sign(self, aws_key, aws_secret)
 
 
 class Authenticator(base.Authenticator):
@@ -134,13 +366,17 @@ class Authenticator(base.Authenticator):
     """
 
     TIMESTAMP_THRESHOLD = 300 # In seconds, five minutes.
-    signature_methods = [SignatureMethod_HMAC_SHA1(), SignatureMethod_HMAC_SHA256()]
+    signature_methods = [SignatureMethod_HMAC_SHA1(), SignatureMethod_HMAC_SHA256(), SignatureMethod_HMAC_SHA256_V4()]
 
-    def __init__(self, credentials):
+    def __init__(self, credentials, replay_cache=None):
         self.credentials = credentials
+        self.replay_cache = replay_cache if replay_cache is not None else replay.get_replay_cache(self.TIMESTAMP_THRESHOLD)
 
     def authenticate(self, request):
         # Returns the authentic identity of the requester.
+        request = as_request(request)
+        if request.is_v4():
+            return self.authenticate_v4(request)
         try:
             aws_key = request.url.parameters['AWSAccessKeyId']
             signature = request.url.parameters['Signature']
@@ -154,22 +390,51 @@ class Authenticator(base.Authenticator):
             timestamp = parse_timestamp(timestamp)
         except ValueError:
             raise UnauthenticatedException('bad timestamp')
+        signer = self.get_signature_method(signature_method, signature_version)
+        return self.verify(request, signer, aws_key, signature, timestamp)
 
+    def authenticate_v4(self, request):
+        try:
+            authorization = request.get_v4_authorization()
+            date, _, _, terminator = authorization['scope'].split('/')
+        except (KeyError, ValueError):
+            raise UnauthenticatedException('missing required signature parameters.')
+        if not authorization['signature']:
+            raise UnauthenticatedException('missing required signature parameters.')
+        if not authorization['date'].startswith(date) or terminator != 'aws4_request':
+            raise UnauthenticatedException('bad credential scope')
+        try:
+            timestamp = parse_v4_timestamp(authorization['date'])
+        except ValueError:
+            raise UnauthenticatedException('bad timestamp')
+        signer = self.get_signature_method(authorization['algorithm'], '4')
+        return self.verify(request, signer, authorization['aws_key'], authorization['signature'], timestamp)
+
+    def verify(self, request, signer, aws_key, signature, timestamp):
         # Timestamp can't be in the future, and can't be older than TIMESTAMP_THRESHOLD.
-        if (timestamp > time.time() or
-            timestamp < (time.time() - self.TIMESTAMP_THRESHOLD)):
+        now = time.time()
+        if (timestamp > now or
+            timestamp < (now - self.TIMESTAMP_THRESHOLD)):
             raise UnauthenticatedException('bad timestamp')
 
         credentials = self.credentials.for_key(aws_key)
         if credentials is None:
             raise UnauthenticatedException('signature mismatch')
-        signer = self.get_signature_method(signature_method, signature_version)
 
-        expected_signature = signer.build_signature(request._clone(klass=Request), credentials.secret)
-        if _are_equal(signature, expected_signature):
-            return credentials.entity
-        else:
+        expected_signature = signer.build_signature(request, credentials.secret)
+        if not _are_equal(signature, expected_signature):
             raise UnauthenticatedException('signature mismatch')
+        self.check_replay(aws_key, signature, timestamp)
+        return credentials.entity
+
+    def check_replay(self, aws_key, signature, timestamp):
+        if self.replay_cache is None:
+            return
+        try:
+            if self.replay_cache.seen(aws_key, signature, timestamp):
+                raise UnauthenticatedException('replayed request')
+        except replay.ReplayCacheFull:
+            raise http.HTTPException(503, body='too many requests')
 
     @classmethod
     def get_signature_method(cls, name, version):
@@ -188,14 +453,19 @@ class Authorizer(base.Authorizer):
     signature_method = SignatureMethod_HMAC_SHA256()
 
     def __init__(self, aws_key=None, aws_secret=None, *args, **kwargs):
-        self.aws_key = aws_key if aws_key is not None else settings.aws_key
-        self.aws_secret = aws_secret if aws_secret is not None else settings.aws_secret
+        values = kwargs.get('values')
+        if values is None:
+            values = settings.__dict__
+        self.aws_key = aws_key if aws_key is not None else values['aws_key']
+        self.aws_secret = aws_secret if aws_secret is not None else values['aws_secret']
+        if values['upstream_signature_version'] == '4':
+            self.signature_method = SignatureMethod_HMAC_SHA256_V4(values['aws_region'] or None, values['aws_service'] or None)
         super(Authorizer, self).__init__(*args, **kwargs)
 
     def prepare(self, entity, request):
         # Re-sign the request with the real AWS credentials.
         request = super(Authorizer, self).prepare(entity, request)
-        return request._clone(klass=Request).signed_request(
+        return as_request(request).signed_request(
             self.signature_method,
             self.aws_key,
             self.aws_secret
@@ -203,4 +473,4 @@ class Authorizer(base.Authorizer):
 
     def authorize(self, entity, request):
         # Make sure request is an aws.Request
-        return super(Authorizer, self).authorize(entity, request._clone(klass=Request))
+        return super(Authorizer, self).authorize(entity, as_request(request))
@@ -1,5 +1,5 @@
 from . import UnauthenticatedException, UnauthorizedException
-from .. import policy, settings, http
+from .. import policy, http, balancer, directory
 
 
 class Authenticator(object):
@@ -23,21 +23,41 @@ class Authorizer(object):
 
     An authorized request is one that has been prepared to point at the real
     remote host that we're proxying to. This preparation is handled by
-    dispatching to the `prepare` method.
+    dispatching to the `prepare` method. If several remote hosts are
+    configured, the balancer picks which one the request is sent to.
+
+    If `values` (a settings snapshot, see `Config.build`) is given, the
+    policies and entity directory come from it rather than from whatever the
+    current settings are, so a reload can't change them partway through a
+    request.
 
     """
-    def __init__(self, policies=None):
+    def __init__(self, policies=None, balancer=None, values=None):
         self.policies = policies
+        # The configured policies are indexed once per settings snapshot,
+        # and a list given here once per authorizer.
+        self.index = policy.PolicyIndex(policies) if policies is not None else None
+        self.balancer = balancer
+        self.values = values
 
     def prepare(self, entity, request):
-        # Update the request to point to the real remote host.
-        request = request._clone()
-        request.url = http.clone_url(request.url, host=settings.remote_host)
-        request.headers = [header if header[0] != 'host' else ('host', settings.remote_host) for header in request.headers]
-        return request
+        # Update the request to point to the real remote host. The balancer
+        # goes with it so the proxy reports back to the one that chose it.
+        chosen = self.balancer or balancer.get_balancer()
+        remote_host = chosen.choose()
+        return request._clone(
+            url=http.clone_url(request.url, host=remote_host),
+            headers=[header if header[0] != 'host' else ('host', remote_host) for header in request.headers],
+            upstream_balancer=chosen,
+        )
 
     def authorize(self, entity, request):
-        if policy.Policy.for_request(entity, request, policies=self.policies).grant(entity, request):
+        policies = self.index
+        if self.values is not None:
+            if policies is None:
+                policies = policy.PolicyIndex.for_settings(self.values)
+            request = request._clone(entity_directory=directory.for_settings(self.values))
+        if policy.Policy.authorize(entity, request, policies=policies):
             return self.prepare(entity, request)
         else:
             raise UnauthorizedException(entity)
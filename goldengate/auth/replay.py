@@ -0,0 +1,145 @@
+"""
+Replay detection for signed requests.
+
+A signed request is only accepted while its timestamp is within the
+authenticator's threshold, so a replay cache only needs to remember the
+signatures it has seen for that long. Entries are grouped into buckets by the
+request's own (signed) timestamp: a replayed request carries the same
+timestamp as the original, so it's always found in the same bucket, and once
+a bucket falls out of the window it's dropped wholesale.
+
+"""
+
+from __future__ import with_statement
+import hashlib
+import threading
+import time
+
+from .. import settings, kvstore
+
+
+class ReplayCacheFull(Exception):
+    pass
+
+
+class ReplayCache(object):
+    """
+    In-process replay cache. Holds at most `capacity` entries, and at most
+    `key_capacity` for any one access key, so a single busy (or hostile) key
+    can't fill the cache for everyone else. If either limit is reached
+    `ReplayCacheFull` is raised rather than forgetting signatures that are
+    still valid.
+
+    """
+
+    def __init__(self, window=300, bucket_size=60, capacity=100000, key_capacity=None):
+        self.window = window
+        self.bucket_size = bucket_size
+        self.capacity = capacity
+        self.key_capacity = key_capacity
+        self.buckets = {}
+        self.size = 0
+        # Access key -> number of entries for it.
+        self.key_sizes = {}
+        self.current = None
+        self.lock = threading.Lock()
+
+    def _expire(self):
+        now = time.time()
+        current = int(now // self.bucket_size)
+        if current == self.current:
+            return
+        self.current = current
+        oldest = int((now - self.window) // self.bucket_size)
+        for bucket in [bucket for bucket in self.buckets if bucket < oldest]:
+            entries = self.buckets.pop(bucket)
+            self.size -= len(entries)
+            for key, _ in entries:
+                remaining = self.key_sizes[key] - 1
+                if remaining:
+                    self.key_sizes[key] = remaining
+                else:
+                    del self.key_sizes[key]
+            self.forget(entries)
+
+    def _add(self, bucket, key, entry):
+        # Called with the lock held.
+        key_size = self.key_sizes.get(key, 0)
+        if self.size >= self.capacity or (self.key_capacity is not None and key_size >= self.key_capacity):
+            raise ReplayCacheFull()
+        self.buckets.setdefault(bucket, set()).add(entry)
+        self.key_sizes[key] = key_size + 1
+        self.size += 1
+
+    def forget(self, entries):
+        "Called with the (key, entry) pairs of a bucket that has aged out."
+        pass
+
+    def seen(self, key, signature, timestamp):
+        """
+        Records a request signed by `key` with `signature` at `timestamp` and
+        returns True if it had already been seen.
+
+        """
+        bucket = int(timestamp // self.bucket_size)
+        entry = (key, signature)
+        with self.lock:
+            self._expire()
+            if entry in self.buckets.get(bucket, ()):
+                return True
+            self._add(bucket, key, entry)
+        return False
+
+
+class KVReplayCache(ReplayCache):
+    """
+    Replay cache shared between gateway processes through a kvstore backend.
+    Each process remembers which keys it wrote so that it can delete them once
+    their bucket ages out.
+
+    An entry is recorded with an add-if-absent (see
+    `BaseStorage.add_with_timeout`), and a request whose entry was already
+    there has been seen, so two processes that see the same request at the
+    same moment can't both accept it. That's atomic on the memcached, redis
+    and local memory backends; the others check and then set. Entries are
+    written with a timeout of a bucket longer than the window on backends
+    that support one, so they don't outlive a process that dies before it
+    can delete them.
+
+    """
+
+    prefix = '__GG_REPLAY__::'
+
+    def __init__(self, backend, **kwargs):
+        self.backend = backend
+        super(KVReplayCache, self).__init__(**kwargs)
+
+    def forget(self, entries):
+        for _, stored_key in entries:
+            self.backend.delete(stored_key)
+
+    def seen(self, key, signature, timestamp):
+        bucket = int(timestamp // self.bucket_size)
+        stored_key = '%s%d:%s' % (self.prefix, bucket, hashlib.sha1('%s:%s' % (key, signature)).hexdigest())
+        if not self.backend.add_with_timeout(stored_key, True, self.window + self.bucket_size):
+            return True
+        try:
+            with self.lock:
+                self._expire()
+                self._add(bucket, key, (key, stored_key))
+        except ReplayCacheFull:
+            # Nothing was accepted, so don't let the entry turn the client's
+            # retry into a replay.
+            self.backend.delete(stored_key)
+            raise
+        return False
+
+
+def get_replay_cache(window):
+    "Returns a replay cache configured from settings, or None if it's disabled."
+    if not settings.replay_protection:
+        return None
+    kwargs = {'window': window, 'capacity': settings.replay_cache_size, 'key_capacity': settings.replay_cache_key_size}
+    if settings.replay_cache_backend:
+        return KVReplayCache(kvstore.get_kvstore(settings.replay_cache_backend), **kwargs)
+    return ReplayCache(**kwargs)
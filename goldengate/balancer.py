@@ -0,0 +1,214 @@
+"""
+Spreads requests across several upstream endpoints (e.g., regional or VPC
+endpoints for the same service).
+
+The balancer picks an endpoint for each request when the request is prepared
+(the host is part of the AWS signature, so it has to be chosen before the
+request is signed) and the proxy reports back when the request starts and
+finishes. Endpoints that fail repeatedly are ejected for a while, and with
+health checks on, endpoints that don't accept connections are skipped until
+they do again.
+
+"""
+
+from __future__ import with_statement
+import random
+import socket
+import threading
+import time
+import logging
+
+from . import settings
+from .http import STANDARD_PORTS
+
+
+logger = logging.getLogger(__name__)
+
+
+class Endpoint(object):
+    def __init__(self, host, scheme='https'):
+        self.host = host
+        # The scheme requests to the endpoint are sent with, which gives the
+        # port to health check when the host doesn't have one.
+        self.scheme = scheme
+        self.outstanding = 0
+        self.ewma = 0.0
+        self.failures = 0
+        self.ejected_until = 0
+        # Set while the endpoint fails its health checks. Kept apart from
+        # ejection so a successful check doesn't undo it.
+        self.down = False
+
+    @property
+    def address(self):
+        host, _, port = self.host.partition(':')
+        return host, int(port or STANDARD_PORTS.get(self.scheme, '443'))
+
+    def available(self, now):
+        return self.ejected_until <= now and not self.down
+
+
+class Balancer(object):
+    """
+    Chooses one of `hosts` for each request. The `least_outstanding` strategy
+    picks the endpoint with the fewest requests in flight (breaking ties by
+    latency), and the `ewma` strategy picks the one with the lowest
+    exponentially weighted moving average latency, scaled by the number of
+    requests in flight.
+
+    An endpoint is ejected for `eject_duration` seconds after
+    `eject_threshold` consecutive failures. Health checks (see
+    `start_health_checks`) mark an endpoint down while it doesn't accept
+    connections, but never bring back one that's been ejected. If every
+    endpoint is ejected or down they're all considered again.
+
+    """
+
+    strategies = ('least_outstanding', 'ewma')
+
+    def __init__(self, hosts, strategy='least_outstanding', decay=0.3, eject_threshold=3, eject_duration=30, scheme='https'):
+        if strategy not in self.strategies:
+            raise ValueError('Unknown balancer strategy: %s' % (strategy,))
+        self.endpoints = dict((host, Endpoint(host, scheme)) for host in hosts)
+        self.strategy = strategy
+        self.decay = decay
+        self.eject_threshold = eject_threshold
+        self.eject_duration = eject_duration
+        self.lock = threading.Lock()
+        # Set to stop the health checks.
+        self.health_checks = None
+
+    def score(self, endpoint):
+        if self.strategy == 'ewma':
+            return endpoint.ewma * (endpoint.outstanding + 1)
+        return (endpoint.outstanding, endpoint.ewma)
+
+    def choose(self):
+        endpoints = self.endpoints.values()
+        if len(endpoints) == 1:
+            return endpoints[0].host
+        now = time.time()
+        healthy = [endpoint for endpoint in endpoints if endpoint.available(now)] or endpoints
+        best = min(self.score(endpoint) for endpoint in healthy)
+        return random.choice([endpoint for endpoint in healthy if self.score(endpoint) == best]).host
+
+    def start(self, host, scheme=None):
+        endpoint = self.endpoints.get(host)
+        if endpoint is None:
+            return
+        with self.lock:
+            endpoint.outstanding += 1
+            if scheme is not None:
+                endpoint.scheme = scheme
+
+    def finish(self, host, latency, ok):
+        endpoint = self.endpoints.get(host)
+        if endpoint is None:
+            return
+        with self.lock:
+            endpoint.outstanding -= 1
+            endpoint.ewma = latency if not endpoint.ewma else (
+                self.decay * latency + (1 - self.decay) * endpoint.ewma)
+            self._report(endpoint, ok)
+
+    def _report(self, endpoint, ok):
+        if ok:
+            endpoint.failures = 0
+            endpoint.ejected_until = 0
+            return
+        endpoint.failures += 1
+        if endpoint.failures >= self.eject_threshold:
+            endpoint.ejected_until = time.time() + self.eject_duration
+
+    def check(self, timeout=5):
+        "Actively check that each endpoint accepts TCP connections."
+        for endpoint in self.endpoints.values():
+            try:
+                socket.create_connection(endpoint.address, timeout).close()
+                ok = True
+            except socket.error:
+                logger.warning('Health check failed for %s', endpoint.host)
+                ok = False
+            endpoint.down = not ok
+
+    def start_health_checks(self, interval):
+        stopped = self.health_checks = threading.Event()
+        def run():
+            while True:
+                stopped.wait(interval)
+                if stopped.is_set():
+                    return
+                self.check()
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+
+    def stop_health_checks(self):
+        if self.health_checks is not None:
+            self.health_checks.set()
+
+
+def _upstream(values):
+    # The settings a balancer is built from.
+    return (
+        tuple(values['remote_hosts'] or [values['remote_host']]),
+        values['balancer_strategy'],
+        values['balancer_eject_threshold'],
+        values['balancer_eject_duration'],
+        values['balancer_health_check_interval'],
+    )
+
+
+def build(values):
+    """
+    Builds a balancer for a settings snapshot (see `Config.build`) without
+    making it the process-wide one or starting its health checks.
+
+    """
+    hosts, strategy, eject_threshold, eject_duration, _ = upstream = _upstream(values)
+    balancer = Balancer(hosts, strategy=strategy, eject_threshold=eject_threshold, eject_duration=eject_duration)
+    balancer.upstream = upstream
+    return balancer
+
+
+def for_settings(values):
+    """
+    Returns the balancer for a settings snapshot: the process-wide one if it
+    was built from the same upstream settings, otherwise a new one (which
+    isn't installed yet).
+
+    """
+    balancer = _balancer
+    if balancer is not None and balancer.upstream == _upstream(values):
+        return balancer
+    return build(values)
+
+
+_balancer = None
+_balancer_lock = threading.Lock()
+
+
+def _install(balancer):
+    global _balancer
+    previous, _balancer = _balancer, balancer
+    interval = balancer.upstream[-1]
+    if interval:
+        balancer.start_health_checks(interval)
+    if previous is not None:
+        previous.stop_health_checks()
+
+
+def install(balancer):
+    "Makes `balancer` the process-wide one, moving the health checks over to it."
+    with _balancer_lock:
+        if balancer is not _balancer:
+            _install(balancer)
+
+
+def get_balancer():
+    "Returns the process-wide balancer for the configured remote hosts."
+    if _balancer is None:
+        with _balancer_lock:
+            if _balancer is None:
+                _install(build(settings.__dict__))
+    return _balancer
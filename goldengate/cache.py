@@ -0,0 +1,211 @@
+"""
+Caching and coalescing of upstream responses.
+
+`LRUCache` is a bounded in-process cache whose entries expire after a TTL.
+`KVCacheStore` exposes the same interface on top of a `goldengate.kvstore`
+backend so that several gateway processes can share cached entries.
+`SingleFlight` lets concurrent identical requests share one upstream call.
+
+"""
+
+from __future__ import with_statement
+import hashlib
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+from .http import Response
+
+
+def request_key(request, ignored_parameters=(), *extra):
+    """
+    Returns a key identifying `request` by its method, path and sorted
+    parameters (minus `ignored_parameters`), plus anything in `extra`.
+
+    """
+    parameters = sorted((key, value) for key, value in request.url.parameters.iteritems()
+                        if key not in ignored_parameters)
+    return hashlib.sha1(repr(extra + (request.method, request.url.path, parameters))).hexdigest()
+
+
+class LRUCache(object):
+    """
+    Thread-safe mapping that holds at most `size` entries, evicting the least
+    recently used entry when it's full. Entries expire after `ttl` seconds
+    (or never, if ttl is None).
+
+    """
+
+    def __init__(self, size=1000, ttl=None):
+        self.size = size
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                expires, value = self.data.pop(key)
+            except KeyError:
+                return default
+            if expires is not None and expires < time.time():
+                return default
+            self.data[key] = (expires, value)
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = ttl if ttl is not None else self.ttl
+        expires = time.time() + ttl if ttl is not None else None
+        with self.lock:
+            self.data.pop(key, None)
+            self.data[key] = (expires, value)
+            while len(self.data) > self.size:
+                self.data.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def __len__(self):
+        return len(self.data)
+
+
+class KVCacheStore(object):
+    "Cache store with the `LRUCache` interface backed by a kvstore backend."
+
+    prefix = '__GG_CACHE__::'
+
+    def __init__(self, backend, ttl=None):
+        self.backend = backend
+        self.ttl = ttl
+
+    def get(self, key, default=None):
+        entry = self.backend.get(self.prefix + key)
+        if entry is None:
+            return default
+        expires, value = entry
+        if expires is not None and expires < time.time():
+            self.backend.delete(self.prefix + key)
+            return default
+        return value
+
+    def set(self, key, value, ttl=None):
+        ttl = ttl if ttl is not None else self.ttl
+        expires = time.time() + ttl if ttl is not None else None
+        self.backend.set(self.prefix + key, (expires, value))
+
+    def delete(self, key):
+        self.backend.delete(self.prefix + key)
+
+
+class ResponseCache(object):
+    """
+    Caches upstream responses for read-only actions. Only actions with an
+    entry in `ttls` (a dict mapping action names to TTLs in seconds) are
+    cached. Entries are keyed by entity, action and the canonical set of
+    request parameters minus `ignored_parameters` (the ones that sign the
+    request rather than describe it).
+
+    If `is_read_only` is given, it's called with each action in `ttls` and a
+    ValueError is raised for any that aren't read-only, since caching them
+    would replay a mutating request's response instead of sending it.
+
+    """
+
+    def __init__(self, ttls, store=None, ignored_parameters=(), is_read_only=None):
+        if is_read_only is not None:
+            mutating = sorted(action for action in ttls if not is_read_only(action))
+            if mutating:
+                raise ValueError('Refusing to cache actions that are not read-only: %s' % (', '.join(mutating),))
+        self.ttls = ttls
+        self.store = store if store is not None else LRUCache()
+        self.ignored_parameters = frozenset(ignored_parameters)
+
+    def key(self, entity, request):
+        return request_key(request, self.ignored_parameters, entity)
+
+    def fetch(self, entity, request, fetch):
+        """
+        Returns the cached response for `request` made by `entity` if there is
+        one. Otherwise calls `fetch` to get the response and caches it.
+
+        """
+        ttl = self.ttls.get(request.url.parameters.get('Action'))
+        if ttl is None:
+            return fetch()
+        key = self.key(entity, request)
+        cached = self.store.get(key)
+        if cached is not None:
+            status, headers, body = cached
+            return Response(status, list(headers), body)
+
+        response = fetch()
+        # Streamed responses don't have a body to hold onto.
+        if response.status == 200 and hasattr(response, 'body'):
+            self.store.set(key, (response.status, response.content_headers(), response.body), ttl)
+        return response
+
+
+class _Call(object):
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+        # How many callers are waiting for this call.
+        self.waiters = 0
+
+
+class SingleFlight(object):
+    """
+    Coalesces concurrent calls with the same key. The first caller runs the
+    call, and anyone who asks for the same key while it's in flight waits
+    for it to finish and gets the same result (or exception).
+
+    If `share` is given, it's only used once someone else has joined the
+    call: the result is passed through it before the first caller gets it,
+    and each caller that joined gets `share` of that. A call nobody joined
+    returns the result untouched (e.g., a response that's still being
+    streamed from the upstream).
+
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, fn, share=None):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = _Call()
+            else:
+                call.waiters += 1
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error[0], call.error[1], call.error[2]
+            return share(call.result) if share is not None else call.result
+
+        try:
+            try:
+                result = fn()
+            finally:
+                # Nobody can join once it's out of `calls`.
+                with self.lock:
+                    del self.calls[key]
+            if share is not None and call.waiters:
+                result = share(result)
+            call.result = result
+        except:
+            call.error = sys.exc_info()
+            raise
+        finally:
+            call.event.set()
+        return call.result
@@ -1,18 +1,44 @@
 
 
 class Config(object):
+    """
+    The gateway's settings. Each setting's value is kept in the instance
+    dict, so reading one is a plain attribute lookup. The whole set of
+    settings can be replaced at once: `build` makes a new snapshot (a dict
+    that holds the Setting objects under 'settings' and their values) and
+    `install` swaps it in with a single assignment, so a reader sees either
+    the old settings or the new ones, never a mix.
+
+    """
+
     def __init__(self):
-        self.settings = {}
+        self.install(self.build({}))
+
+    def build(self, values):
+        "Returns a snapshot of the default settings, overridden by `values`."
+        settings = {}
         for setting in SettingMeta.known_settings.values():
-            self.settings[setting.name] = setting()
+            settings[setting.name] = setting()
+        for name, value in values.iteritems():
+            settings[name].set(value)
+        snapshot = dict((name, setting.get()) for name, setting in settings.iteritems())
+        snapshot['settings'] = settings
+        # The index of the snapshot's policies and its entity directory,
+        # built by `PolicyIndex.for_settings` and `directory.for_settings`
+        # (they can't be built here, since this module is loaded first).
+        snapshot['policy_index'] = None
+        snapshot['directory'] = None
+        return snapshot
+
+    def install(self, snapshot):
+        self.__dict__ = snapshot
 
     def __getattr__(self, name):
-        if name not in self.settings:
-            raise AttributeError('Missing setting: %s' % (name,))
-        return self.settings[name].get()
+        # Only called for names that aren't settings.
+        raise AttributeError('Missing setting: %s' % (name,))
 
     def __setattr__(self, name, value):
-        if name != 'settings' and name in self.settings:
+        if name != 'settings' and name in self.__dict__.get('settings', ()):
             raise AttributeError('Invalid access!')
         super(Config, self).__setattr__(name, value)
 
@@ -21,6 +47,7 @@ class Config(object):
 
     def set(self, name, value):
         self.settings[name].set(value)
+        self.__dict__[name] = self.settings[name].get()
 
 
 class SettingMeta(type):
@@ -78,6 +105,35 @@ class RemoteHost(Setting):
     default = 'ec2.amazonaws.com'
 
 
+class RemoteHosts(Setting):
+    # Several endpoints to balance requests across. If empty, every request
+    # goes to remote_host.
+    name = 'remote_hosts'
+    default = []
+
+
+class BalancerStrategy(Setting):
+    # Either 'least_outstanding' or 'ewma'.
+    name = 'balancer_strategy'
+    default = 'least_outstanding'
+
+
+class BalancerEjectThreshold(Setting):
+    name = 'balancer_eject_threshold'
+    default = 3
+
+
+class BalancerEjectDuration(Setting):
+    name = 'balancer_eject_duration'
+    default = 30
+
+
+class BalancerHealthCheckInterval(Setting):
+    # Seconds between active (TCP connect) health checks. None disables them.
+    name = 'balancer_health_check_interval'
+    default = None
+
+
 class Credentials(Setting):
     name = 'credentials'
     default = []
@@ -88,6 +144,37 @@ class CredentialStore(ClassSetting):
     default = 'goldengate.credentials.StaticCredentialStore'
 
 
+class CredentialsFile(Setting):
+    # Used by FileCredentialStore, which requires it. A file with just
+    # CREDENTIALS in it, not the config file.
+    name = 'credentials_file'
+    default = None
+
+
+class CredentialsReloadInterval(Setting):
+    # How often (in seconds) FileCredentialStore checks for changes.
+    name = 'credentials_reload_interval'
+    default = 5
+
+
+class CredentialCacheSize(Setting):
+    # Settings for KVCredentialStore's local cache.
+    name = 'credential_cache_size'
+    default = 10000
+
+
+class CredentialCacheTTL(Setting):
+    name = 'credential_cache_ttl'
+    default = 300
+
+
+class CredentialPollInterval(Setting):
+    # How often (in seconds) KVCredentialStore checks for changes made by
+    # other gateways.
+    name = 'credential_poll_interval'
+    default = 5
+
+
 class StorageBackend(Setting):
     name = 'storage_backend'
     default = 'locmem://'
@@ -106,3 +193,231 @@ class AWSSecret(Setting):
 class Policies(Setting):
     name = 'policies'
     default = []
+
+
+class UpstreamMaxConnections(Setting):
+    name = 'upstream_max_connections'
+    default = 10
+
+
+class UpstreamIdleTimeout(Setting):
+    name = 'upstream_idle_timeout'
+    default = 60
+
+
+class UpstreamDNSTTL(Setting):
+    name = 'upstream_dns_ttl'
+    default = 60
+
+
+class UpstreamPoolTimeout(Setting):
+    # How long (in seconds) a request waits for a connection to an upstream
+    # host once upstream_max_connections are in use, before failing with a
+    # 503. None waits forever.
+    name = 'upstream_pool_timeout'
+    default = 10
+
+
+class UpstreamPrewarm(Setting):
+    # Maps upstream origins to the number of connections to open at startup,
+    # e.g. {'https://ec2.amazonaws.com': 4}.
+    name = 'upstream_prewarm'
+    default = {}
+
+
+class StreamResponses(Setting):
+    name = 'stream_responses'
+    default = False
+
+
+class StreamChunkSize(Setting):
+    name = 'stream_chunk_size'
+    default = 64 * 1024
+
+
+class ResponseCacheTTLs(Setting):
+    # Maps read-only AWS actions to the number of seconds their responses may
+    # be cached for, e.g. {'DescribeInstances': 10}. Empty disables caching.
+    name = 'response_cache_ttls'
+    default = {}
+
+
+class ResponseCacheSize(Setting):
+    name = 'response_cache_size'
+    default = 1000
+
+
+class ResponseCacheBackend(Setting):
+    # A kvstore backend URI to share the cache between processes. If empty,
+    # each process keeps its own in-memory LRU cache.
+    name = 'response_cache_backend'
+    default = ''
+
+
+class ReadOnlyActionPrefixes(Setting):
+    name = 'read_only_action_prefixes'
+    default = ['Describe', 'Get', 'List']
+
+
+class CoalesceRequests(Setting):
+    # Share one upstream call between identical read-only requests that are
+    # in flight at the same time.
+    name = 'coalesce_requests'
+    default = True
+
+
+class UpstreamTimeout(Setting):
+    # Socket timeout, in seconds, for each attempt at an upstream request.
+    name = 'upstream_timeout'
+    default = 30
+
+
+class UpstreamRetries(Setting):
+    # Retries for read-only actions. Other actions are never retried.
+    name = 'upstream_retries'
+    default = 2
+
+
+class UpstreamBackoff(Setting):
+    name = 'upstream_backoff'
+    default = 0.1
+
+
+class UpstreamMaxBackoff(Setting):
+    name = 'upstream_max_backoff'
+    default = 2.0
+
+
+class UpstreamHedgePercentile(Setting):
+    # Latency percentile after which a second attempt is made at a read-only
+    # request, e.g. 95. None disables hedging.
+    name = 'upstream_hedge_percentile'
+    default = None
+
+
+class UpstreamBreakerThreshold(Setting):
+    name = 'upstream_breaker_threshold'
+    default = 5
+
+
+class UpstreamBreakerReset(Setting):
+    name = 'upstream_breaker_reset'
+    default = 30
+
+
+class ReplayProtection(Setting):
+    # Reject signed requests that have already been seen. Identical requests
+    # signed within the same second (SigV2 timestamps only have one second
+    # resolution) are rejected too, so clients have to vary something.
+    name = 'replay_protection'
+    default = False
+
+
+class ReplayCacheSize(Setting):
+    # Requests are rejected with a 503 once this many signatures from the
+    # last five minutes are remembered (about 333 requests a second).
+    name = 'replay_cache_size'
+    default = 100000
+
+
+class ReplayCacheKeySize(Setting):
+    # The most signatures remembered for a single access key, so one key
+    # can't fill the cache for everyone. None for no limit.
+    name = 'replay_cache_key_size'
+    default = 20000
+
+
+class ReplayCacheBackend(Setting):
+    # A kvstore backend URI to share the replay cache between processes. If
+    # empty, each process keeps its own.
+    name = 'replay_cache_backend'
+    default = ''
+
+
+class UpstreamSignatureVersion(Setting):
+    # AWS signature version used to re-sign requests: '2' or '4'.
+    name = 'upstream_signature_version'
+    default = '2'
+
+
+class AWSRegion(Setting):
+    # SigV4 credential scope. If empty, they're worked out from the host.
+    name = 'aws_region'
+    default = ''
+
+
+class AWSService(Setting):
+    name = 'aws_service'
+    default = ''
+
+
+class TimeLockPollInterval(Setting):
+    # How often (in seconds) time-locked requests check whether they were
+    # cancelled through another gateway process, with storage backends that
+    # can't publish cancellations (everything but redis).
+    name = 'time_lock_poll_interval'
+    default = 5
+
+
+class DeferredExecutor(Setting):
+    # Whether this process sends deferred requests. Executors claim requests
+    # before sending them, so it can be on in several processes (with a
+    # memcached or redis storage backend; the others need a single gateway
+    # process). Policies that defer requests log a warning in processes
+    # where it's off.
+    name = 'deferred_executor'
+    default = False
+
+
+class DeferredWorkers(Setting):
+    name = 'deferred_workers'
+    default = 4
+
+
+class DeferredPollInterval(Setting):
+    # How often (in seconds) the executor checks the kvstore for requests
+    # deferred by other gateways.
+    name = 'deferred_poll_interval'
+    default = None
+
+
+class InstitutionalEntities(Setting):
+    # Entities that aren't people (e.g., an account for a CI server). They
+    # can't approve requests that need two-person integrity. Same as listing
+    # them under 'institutional' in entity_kinds.
+    name = 'institutional_entities'
+    default = []
+
+
+class EntityGroups(Setting):
+    # Group name -> list of entities, for GroupMatcher.
+    name = 'entity_groups'
+    default = {}
+
+
+class EntityKinds(Setting):
+    # Kind (e.g., 'institutional') -> list of entities, for KindMatcher. An
+    # entity can only be of one kind.
+    name = 'entity_kinds'
+    default = {}
+
+
+class ApprovalPollInterval(Setting):
+    # How often (in seconds) requests waiting for approval check whether they
+    # were approved through another gateway process, with storage backends
+    # that can't publish approvals (everything but redis).
+    name = 'approval_poll_interval'
+    default = 5
+
+
+class ReloadEntities(Setting):
+    # Entities allowed to reload the configuration through /~/reload.
+    name = 'reload_entities'
+    default = []
+
+
+class ReloadOnSighup(Setting):
+    # Reload the configuration when the process gets a SIGHUP. Leave this off
+    # under servers that use SIGHUP themselves.
+    name = 'reload_on_sighup'
+    default = False
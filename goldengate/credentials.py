@@ -1,6 +1,12 @@
+import os
+import threading
+import logging
 from collections import namedtuple
 
 
+logger = logging.getLogger(__name__)
+
+
 Credential = namedtuple('Credentials', 'entity key secret')
 
 
@@ -19,6 +25,10 @@ class StaticCredentialStore(CredentialStore):
         # Must be a single set of credentials for each key
         assert len(set([credential.key for credential in credentials])) == len(credentials)
         self.credentials = credentials
+        self.by_key = dict((credential.key, credential) for credential in credentials)
+        self.by_entity = {}
+        for credential in credentials:
+            self.by_entity.setdefault(credential.entity, []).append(credential)
 
     def for_key(self, key):
         """
@@ -26,11 +36,119 @@ class StaticCredentialStore(CredentialStore):
         credentials exist.
 
         """
-        for credential in self.credentials:
-            if credential.key == key:
-                return credential
-        return None
+        return self.by_key.get(key)
 
     def for_entity(self, entity):
         "Returns a list of credentials for a particular entity."
-        return [credential for credential in self.credentials if credential.entity == entity]
+        return list(self.by_entity.get(entity, []))
+
+
+class ReloadableCredentialStore(CredentialStore):
+    """
+    Credential store that can be reloaded without restarting the gateway.
+    Each reload builds a new `StaticCredentialStore` and swaps it in with a
+    single assignment, so lookups never see a half-built store and don't need
+    a lock.
+
+    """
+
+    def __init__(self, credentials=()):
+        self.snapshot = StaticCredentialStore(list(credentials))
+
+    def load(self):
+        "Returns the current list of credentials."
+        raise NotImplementedError
+
+    def reload(self):
+        self.snapshot = StaticCredentialStore(self.load())
+
+    def for_key(self, key):
+        return self.snapshot.for_key(key)
+
+    def for_entity(self, entity):
+        return self.snapshot.for_entity(entity)
+
+
+class FileCredentialStore(ReloadableCredentialStore):
+    """
+    Reads credentials from the CREDENTIALS setting of a file of their own
+    (the credentials_file setting). If `interval` is set the file is checked
+    that often and reloaded when it changes. If a reload fails (including
+    when the file has no CREDENTIALS, e.g. after a partial edit) the old
+    credentials are kept.
+
+    The file is executed to read it, so it can't be the gateway's config
+    file: that would build a new set of policies (and notification brokers
+    that are never stopped) every time the credentials are reloaded.
+
+    The file is read when the store is created, and a ValueError is raised
+    if there's no file to read.
+
+    """
+
+    def __init__(self, credentials=(), filename=None, interval=None):
+        from . import settings
+        self.filename = filename or settings.credentials_file
+        if not self.filename:
+            raise ValueError('FileCredentialStore needs a credentials_file')
+        config = os.environ.get('GOLDENGATE_CONFIG')
+        if config is not None and os.path.abspath(self.filename) == os.path.abspath(config):
+            raise ValueError('credentials_file must not be the configuration file')
+        if interval is None:
+            interval = settings.credentials_reload_interval
+        self.interval = interval or 0
+        self.watching = None
+        super(FileCredentialStore, self).__init__(credentials)
+        self.mtime = self.modified()
+        self.reload()
+        if self.interval:
+            self.watch(self.interval)
+
+    @staticmethod
+    def source(values):
+        "Returns the (filename, interval) of the store for a settings snapshot (see `Config.build`)."
+        return values['credentials_file'], values['credentials_reload_interval'] or 0
+
+    def modified(self):
+        try:
+            return os.stat(self.filename).st_mtime
+        except (OSError, TypeError):
+            return None
+
+    def load(self):
+        from . import exec_config
+        environment = exec_config(self.filename)
+        for name, value in environment.iteritems():
+            if name.lower() == 'credentials':
+                return [Credential(*credential) for credential in value]
+        raise ValueError('no CREDENTIALS in %s' % (self.filename,))
+
+    def check(self):
+        "Reloads the credentials if the file has changed since it was last loaded."
+        mtime = self.modified()
+        if mtime is None or mtime == self.mtime:
+            return False
+        self.mtime = mtime
+        try:
+            self.reload()
+        except Exception:
+            logger.exception('Unable to reload credentials from %s', self.filename)
+            return False
+        return True
+
+    def watch(self, interval):
+        stopped = self.watching = threading.Event()
+        def run():
+            while True:
+                stopped.wait(interval)
+                if stopped.is_set():
+                    return
+                self.check()
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        "Stops watching the file for changes."
+        if self.watching is not None:
+            self.watching.set()
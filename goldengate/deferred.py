@@ -0,0 +1,340 @@
+"""
+Deferred execution of requests that have to wait (e.g., for a time-lock to
+expire) without holding the client's connection open.
+
+A deferred request is stored in the kvstore with the time it should be sent,
+and the client gets a 202 with the request's UUID straight away. An
+`Executor` sends the request when it's due, re-signing it then rather than
+when it was made, and stores the upstream response so the client can fetch
+it from /~/result/<uuid>. A request that's waiting to be released (e.g.,
+for an approval) can be given an expiry, after which it's dropped. Pending
+requests survive a restart because the
+executor reloads the queue from the kvstore when it starts.
+
+Updates to the queue are locked, and an executor claims each request before
+sending it, both with an add-if-absent (see `BaseStorage.add_with_timeout`),
+so several gateway processes can queue requests and run executors on a
+shared kvstore without losing a request or sending one twice. That's atomic
+on the memcached, redis and local memory backends; the others check and then
+set, so with them only one process should defer requests. `deferred_executor` is off by
+default: turn it on in at least one process, and set
+`deferred_poll_interval` in any that should pick up requests queued by the
+others. A gateway warns when its policies defer requests but it doesn't run
+an executor (see `check_policies`).
+
+"""
+
+from __future__ import with_statement
+import Queue
+import logging
+import threading
+import time
+
+from . import settings, scheduler
+from .http import Request, HTTPException
+from .kvstore import models
+
+
+logger = logging.getLogger(__name__)
+
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+EXPIRED = 'expired'
+
+
+class DeferredRequest(models.Model):
+    id = models.Field(pk=True)
+    entity = models.Field()
+    request = models.Field()
+    execute_at = models.Field()
+    # When to give up on a request that hasn't been released, or None.
+    expires_at = models.Field()
+    state = models.Field(default=PENDING)
+    # A (status, headers, body) tuple once the request has been sent.
+    response = models.Field()
+
+
+class DeferredQueue(models.Model):
+    # There's a single queue; it's just the list of pending request ids.
+    id = models.Field(pk=True)
+    ids = models.Field(default=())
+
+    QUEUE_ID = 'pending'
+    LOCK_KEY = '__GG_DEFERRED_QUEUE_LOCK__'
+    # How long (in seconds) a process can hold the queue. Far longer than
+    # reading and writing it takes, so it only runs out if the holder died.
+    LOCK_TIMEOUT = 30
+    lock = threading.Lock()
+
+    @classmethod
+    def pending(cls):
+        queue = cls.get(cls.QUEUE_ID)
+        return queue.ids if queue is not None else ()
+
+    @classmethod
+    def update(cls, fn):
+        # Serialized within a process by `lock`, and between processes by
+        # adding LOCK_KEY (see `BaseStorage.add_with_timeout`), so processes
+        # queueing requests at the same moment can't lose each other's.
+        with cls.lock:
+            backend = cls.storage_backend
+            deadline = time.time() + cls.LOCK_TIMEOUT
+            while not backend.add_with_timeout(cls.LOCK_KEY, True, cls.LOCK_TIMEOUT):
+                if time.time() >= deadline:
+                    # Its holder died, and the backend can't expire keys.
+                    logger.warning('Taking over the deferred queue from a process that stopped holding it')
+                    break
+                time.sleep(0.005)
+            try:
+                queue = cls.get(cls.QUEUE_ID) or cls(id=cls.QUEUE_ID)
+                queue.ids = tuple(fn(queue.ids))
+                queue.save()
+            finally:
+                backend.delete(cls.LOCK_KEY)
+
+
+def _claim_key(request_uuid):
+    return '__GG_DEFERRED_CLAIM__::%s' % (request_uuid,)
+
+
+# How long a claim lasts, in seconds. Far longer than sending a request
+# takes, so it only runs out for a request whose executor died sending it.
+CLAIM_TIMEOUT = 600
+
+
+class DeferredException(HTTPException):
+    """
+    Raised by a policy that has deferred a request. Tells the client where
+    to find the result.
+
+    """
+    type = 'deferred'
+
+    def __init__(self, entity, request_uuid):
+        self.entity = entity
+        self.request_uuid = request_uuid
+        location = '/~/result/%s' % (request_uuid,)
+        super(DeferredException, self).__init__(202, [('Location', location)], request_uuid)
+
+
+def defer(request_uuid, entity, request, execute_at, expires_at=None):
+    """
+    Queues `request` to be sent on behalf of `entity` at `execute_at`, or
+    once it's released if `execute_at` is None. A request that hasn't been
+    released by `expires_at` never will be.
+
+    """
+    job = DeferredRequest(id=request_uuid, entity=entity, request=request.to_dict(), execute_at=execute_at, expires_at=expires_at)
+    job.save()
+    DeferredQueue.update(lambda ids: ids + (request_uuid,))
+    if _executor is not None and _due(job) is not None:
+        _executor.schedule(request_uuid, _due(job))
+
+
+def release(request_uuid, execute_at=None):
+    "Sends a deferred request that was waiting to be released at `execute_at`, or right away."
+    job = DeferredRequest.get(request_uuid)
+    if job is None or job.state != PENDING or job.execute_at is not None:
+        return False
+    job.execute_at = execute_at if execute_at is not None else time.time()
+    job.save()
+    if _executor is not None:
+        # Replaces the expiry timer, if there was one.
+        _executor.unschedule(request_uuid)
+        _executor.schedule(request_uuid, job.execute_at)
+    return True
+
+
+def cancel(request_uuid):
+    "Cancels a deferred request if it hasn't been sent yet."
+    job = DeferredRequest.get(request_uuid)
+    if job is None or job.state != PENDING:
+        return False
+    job.state = CANCELLED
+    job.save()
+    DeferredQueue.update(lambda ids: [i for i in ids if i != request_uuid])
+    if _executor is not None:
+        _executor.unschedule(request_uuid)
+    return True
+
+
+def result(request_uuid):
+    "Returns the `DeferredRequest` with the given UUID, or None."
+    return DeferredRequest.get(request_uuid)
+
+
+def _due(job):
+    # When the executor next has to look at a pending job: when it's to be
+    # sent, or when it expires if it's still waiting to be released.
+    if job.execute_at is not None:
+        return job.execute_at
+    return job.expires_at
+
+
+class Executor(object):
+    """
+    Sends deferred requests when they're due using a pool of `workers`
+    threads. Requests are prepared (pointed at the upstream and re-signed) by
+    `authorizer` and sent through `proxy`.
+
+    The shared scheduler only fires the timers for when requests are due.
+    With a `poll_interval`, the kvstore is checked for requests queued by
+    other processes on a thread of the executor's own, so slow kvstore reads
+    don't hold up everything else on the scheduler.
+
+    """
+
+    def __init__(self, authorizer, proxy, auditor, workers=4, poll_interval=None):
+        self.authorizer = authorizer
+        self.proxy = proxy
+        self.auditor = auditor
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.queue = Queue.Queue()
+        # Request UUID -> scheduler timer.
+        self.scheduled = {}
+        self.lock = threading.Lock()
+        self.threads = []
+        self.poller = None
+        self.stopped = threading.Event()
+
+    def start(self):
+        global _executor
+        _executor = self
+        self.recover()
+        if self.poll_interval:
+            self.poller = threading.Thread(target=self.poll)
+            self.poller.daemon = True
+            self.poller.start()
+
+    def poll(self):
+        while not self.stopped.wait(self.poll_interval):
+            try:
+                self.recover()
+            except Exception:
+                logger.exception('Unable to check for deferred requests')
+
+    def recover(self):
+        """
+        Schedules every pending request in the kvstore that isn't scheduled
+        yet. Requests that were being sent by an executor that stopped (so
+        their claim has run out) are marked as failed, since there's no
+        telling whether they reached the upstream.
+
+        """
+        for request_uuid in DeferredQueue.pending():
+            if request_uuid in self.scheduled:
+                continue
+            job = DeferredRequest.get(request_uuid)
+            if job is None:
+                continue
+            if job.state == PENDING and _due(job) is not None:
+                self.schedule(request_uuid, _due(job))
+            elif job.state == RUNNING and not DeferredRequest.storage_backend.has_key(_claim_key(request_uuid)):
+                self.finish(job, FAILED, (500, [], 'interrupted'))
+
+    def claim(self, request_uuid):
+        "Returns True if this executor gets to send the request, and False if another one already has it."
+        return DeferredRequest.storage_backend.add_with_timeout(_claim_key(request_uuid), True, CLAIM_TIMEOUT)
+
+    def schedule(self, request_uuid, execute_at):
+        with self.lock:
+            if request_uuid not in self.scheduled:
+                self.scheduled[request_uuid] = scheduler.get_scheduler().schedule(
+                    execute_at, lambda: self.submit(request_uuid))
+
+    def unschedule(self, request_uuid):
+        with self.lock:
+            timer = self.scheduled.pop(request_uuid, None)
+        if timer is not None:
+            timer.cancel()
+
+    def stop(self):
+        "Stops sending deferred requests. They'll be picked up again by the next executor."
+        global _executor
+        if _executor is self:
+            _executor = None
+        self.stopped.set()
+        for request_uuid in self.scheduled.keys():
+            self.unschedule(request_uuid)
+
+    def submit(self, request_uuid):
+        # Runs on the scheduler's thread, so hand the request to a worker.
+        with self.lock:
+            while len(self.threads) < self.workers:
+                thread = threading.Thread(target=self.work)
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+        self.queue.put(request_uuid)
+
+    def work(self):
+        while True:
+            request_uuid = self.queue.get()
+            try:
+                self.execute(request_uuid)
+            except Exception:
+                logger.exception('Unable to execute deferred request %s', request_uuid)
+
+    def execute(self, request_uuid):
+        self.unschedule(request_uuid)
+        job = DeferredRequest.get(request_uuid)
+        if job is None or job.state != PENDING:
+            return
+        if job.execute_at is None:
+            # Never released.
+            if job.expires_at is not None and job.expires_at <= time.time():
+                self.finish(job, EXPIRED, None)
+            return
+        if not self.claim(request_uuid):
+            return
+        job.state = RUNNING
+        job.save()
+        request = Request.from_dict(job.request)
+        try:
+            prepared = self.authorizer.prepare(job.entity, request)
+            self.auditor.record(job.entity, ['executed', [job.request, prepared.to_dict()]])
+            response = self.proxy.request(prepared).buffered()
+        except HTTPException, e:
+            self.finish(job, FAILED, (e.status, e.headers, e.body))
+        except Exception:
+            logger.exception('Unable to execute deferred request %s', request_uuid)
+            self.finish(job, FAILED, (500, [], ''))
+        else:
+            self.finish(job, DONE, (response.status, response.content_headers(), response.body))
+
+    def finish(self, job, state, response):
+        job.state = state
+        job.response = response
+        job.save()
+        DeferredQueue.update(lambda ids: [i for i in ids if i != job.id])
+
+
+_executor = None
+
+
+def check_policies(policies, executor):
+    """
+    Logs a warning (and returns True) if any of `policies` defer requests
+    but `executor` (this process's executor) is None, since they're then
+    only sent if another process sharing the kvstore runs one.
+
+    """
+    deferring = [p for p in policies if getattr(p, 'defer', False)]
+    if deferring and executor is None:
+        logger.warning(
+            '%d policies defer requests, but this process has no deferred executor: '
+            'they will only be sent if DEFERRED_EXECUTOR is on in another gateway '
+            'process sharing the kvstore', len(deferring))
+    return bool(deferring) and executor is None
+
+
+def get_executor(authorizer, proxy, auditor):
+    "Returns an executor configured from settings, or None if this gateway shouldn't run one."
+    if not settings.deferred_executor:
+        return None
+    return Executor(authorizer, proxy, auditor, settings.deferred_workers, settings.deferred_poll_interval)
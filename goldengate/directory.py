@@ -0,0 +1,102 @@
+"""
+A directory of entity groups and kinds.
+
+Groups (the entity_groups setting) are named sets of entities that policies
+can refer to by name, e.g. {'admins': ['alice', 'bob']}. Kinds (entity_kinds)
+say what sort of thing an entity is, e.g. {'institutional': ['hudson']}, and
+an entity has at most one kind. Entities listed in institutional_entities are
+of the 'institutional' kind.
+
+Membership is worked out when a directory is built, so checking it is a
+single set or dict lookup. Policies look groups up in the directory when
+they're evaluated, so changing the groups doesn't mean rebuilding the
+policies. Each settings snapshot (see `Config.build`) gets its own directory,
+built the first time it's needed (or when the settings it's built from are
+replaced) and kept on the snapshot, so installing new settings installs
+their directory with them. Changes made to the groups in place need a call
+to `reload`.
+
+"""
+
+from . import settings
+
+
+INSTITUTIONAL = 'institutional'
+
+
+class Directory(object):
+    def __init__(self, groups=None, kinds=None):
+        # Group -> frozenset of members.
+        self.members = dict((group, frozenset(members)) for group, members in (groups or {}).iteritems())
+        # Entity -> frozenset of the groups it's in.
+        memberships = {}
+        for group, members in self.members.iteritems():
+            for entity in members:
+                memberships.setdefault(entity, set()).add(group)
+        self.memberships = dict((entity, frozenset(groups)) for entity, groups in memberships.iteritems())
+        # Entity -> kind.
+        self.kinds = {}
+        for kind, entities in (kinds or {}).iteritems():
+            for entity in entities:
+                if self.kinds.get(entity, kind) != kind:
+                    raise ValueError('%s is both %s and %s' % (entity, self.kinds[entity], kind))
+                self.kinds[entity] = kind
+
+    def groups_of(self, entity):
+        return self.memberships.get(entity, frozenset())
+
+    def in_group(self, entity, group):
+        return entity in self.members.get(group, ())
+
+    def kind_of(self, entity):
+        "Returns the entity's kind, or None if it doesn't have one."
+        return self.kinds.get(entity)
+
+
+def _sources(values):
+    return (values['entity_groups'], values['entity_kinds'], values['institutional_entities'])
+
+
+def _build(sources):
+    groups, kinds, institutional = sources
+    kinds = dict(kinds)
+    if institutional:
+        kinds[INSTITUTIONAL] = list(kinds.get(INSTITUTIONAL, ())) + list(institutional)
+    directory = Directory(groups, kinds)
+    directory.sources = sources
+    return directory
+
+
+def for_settings(values):
+    """
+    Returns the directory for a settings snapshot, building it if it hasn't
+    been built yet or the settings it was built from have been replaced.
+    Raises ValueError if the snapshot gives an entity two kinds.
+
+    """
+    directory = values.get('directory')
+    sources = _sources(values)
+    if directory is None or any(a is not b for a, b in zip(directory.sources, sources)):
+        directory = values['directory'] = _build(sources)
+    return directory
+
+
+def get_directory():
+    "Returns the directory for the current settings."
+    return for_settings(settings.__dict__)
+
+
+def of(request):
+    """
+    Returns the directory `request` is being authorized against (see
+    `auth.base.Authorizer`), or the current one.
+
+    """
+    return getattr(request, 'entity_directory', None) or get_directory()
+
+
+def reload():
+    "Rebuilds the directory for the current settings (e.g., after they were changed in place)."
+    values = settings.__dict__
+    directory = values['directory'] = _build(_sources(values))
+    return directory
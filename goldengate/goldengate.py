@@ -3,11 +3,20 @@
 # than may be provided by the backend service.
 
 
-import httplib2
-from . import settings
-from .credentials import Credential
-from .http import Request, Response, HTTPException
-from .auth import aws
+import copy
+import httplib
+import logging
+import signal
+import socket
+import threading
+import time
+from . import settings, reload_config, pool, cache, kvstore, resilience, balancer, deferred, directory, policy
+from .credentials import Credential, ReloadableCredentialStore, FileCredentialStore
+from .http import Request, Response, StreamingResponse, HTTPException, HOP_BY_HOP_HEADERS
+from .auth import aws, UnauthorizedException
+
+
+logger = logging.getLogger(__name__)
 
 
 class Proxy(object):
@@ -15,37 +24,390 @@ class Proxy(object):
     Proxy is basically an HTTP client that accepts Request objects, makes the
     HTTP request that it represents, and returns a Response object.
 
+    Upstream connections are kept alive and shared between threads through a
+    connection pool (see `goldengate.pool`).
+
+    If `stream_responses` is set, response bodies larger than `chunk_size` (or
+    of unknown length) are streamed back to the client as they're read rather
+    than being buffered.
+
+    Requests for read-only actions that fail (connection errors, timeouts or
+    5XX responses) are retried with jittered exponential backoff, and can be
+    hedged: if no response has arrived by the host's `hedge_percentile`
+    latency a second attempt is made and whichever finishes first wins. Each
+    host has a circuit breaker, and requests to a host whose breaker is open
+    fail immediately with a 503, as do requests that can't get a connection
+    to the host within `upstream_pool_timeout` seconds.
+
     """
 
     def __init__(self):
-        self.http = httplib2.Http()
+        self.http = pool.ConnectionPool(
+            max_connections=settings.upstream_max_connections,
+            idle_timeout=settings.upstream_idle_timeout,
+            timeout=settings.upstream_timeout,
+            resolver=pool.Resolver(settings.upstream_dns_ttl),
+            acquire_timeout=settings.upstream_pool_timeout,
+        )
+        for origin, count in settings.upstream_prewarm.iteritems():
+            self.http.prewarm(origin, count)
+        self.stream_responses = settings.stream_responses
+        self.chunk_size = settings.stream_chunk_size
+        self.retries = settings.upstream_retries
+        self.backoff = resilience.Backoff(settings.upstream_backoff, settings.upstream_max_backoff)
+        self.hedge_percentile = settings.upstream_hedge_percentile
+        self.breakers = {}
+        self.latencies = {}
+        self.balancer = balancer.get_balancer()
+
+    def breaker(self, host):
+        breaker = self.breakers.get(host)
+        if breaker is None:
+            breaker = self.breakers.setdefault(host, resilience.CircuitBreaker(
+                settings.upstream_breaker_threshold,
+                settings.upstream_breaker_reset,
+            ))
+        return breaker
+
+    def latency(self, host):
+        latency = self.latencies.get(host)
+        if latency is None:
+            latency = self.latencies.setdefault(host, resilience.LatencyTracker())
+        return latency
 
     def request(self, request):
-        response, content = self.http.request(request.get_url(), request.method, headers=dict(request.headers), body=request.body)
+        breaker = self.breaker(request.url.host)
+        idempotent = self.idempotent(request)
+        attempts = self.retries + 1 if idempotent else 1
+        for attempt in xrange(attempts):
+            if attempt:
+                time.sleep(self.backoff.delay(attempt))
+            if not breaker.allow():
+                raise HTTPException(503, body='upstream unavailable')
+            try:
+                if idempotent and self.hedge_percentile is not None:
+                    response = self.hedged(request)
+                else:
+                    response = self.attempt(request)
+            except pool.PoolTimeout:
+                # Every connection to the host is busy; that's not the
+                # host's fault, so it doesn't count against the breaker (but
+                # if this was its trial request, another one can have a go).
+                breaker.release()
+                raise HTTPException(503, body='upstream busy')
+            except (socket.error, httplib.HTTPException), e:
+                breaker.failure()
+                if attempt + 1 < attempts:
+                    continue
+                if isinstance(e, socket.timeout):
+                    raise HTTPException(504, body='upstream timed out')
+                raise HTTPException(502, body='upstream unreachable')
+            except:
+                breaker.failure()
+                raise
+            if response.status < 500:
+                breaker.success()
+                return response
+            breaker.failure()
+            if attempt + 1 < attempts:
+                self.discard(response)
+                continue
+            return response
+
+    @staticmethod
+    def idempotent(request):
+        return aws.is_read_only(request.url.parameters.get('Action'))
+
+    def hedged(self, request):
+        delay = self.latency(request.url.host).percentile(self.hedge_percentile)
+        if delay is None:
+            return self.attempt(request)
+        return resilience.hedge(lambda: self.attempt(request), delay, self.discard)
+
+    @staticmethod
+    def discard(response):
+        if isinstance(response, StreamingResponse):
+            response.stream.close()
+
+    def attempt(self, request):
+        host = request.url.host
+        # Report back to the balancer that chose the host (see
+        # Authorizer.prepare), even if a reload swaps in another one
+        # meanwhile.
+        balancer = getattr(request, 'upstream_balancer', None) or self.balancer
+        balancer.start(host, request.url.scheme)
+        start = time.time()
+        ok = False
+        try:
+            if self.stream_responses:
+                response = self.stream(request)
+            else:
+                response = self.buffer(request)
+            ok = response.status < 500
+        finally:
+            latency = time.time() - start
+            balancer.finish(host, latency, ok)
+        self.latency(host).record(latency)
+        return response
+
+    def buffer(self, request):
+        response, content = self.http.request(request.get_url(), request.method, headers=dict(request.headers), body=request.body,
+                                              idempotent=self.idempotent(request))
         status = int(response.pop('status'))
-        return Response(status, response, content)
+        return Response(status, self.filter_headers(response.iteritems()), content)
+
+    def stream(self, request):
+        response = self.http.urlopen(request.method, request.get_url(), body=request.body, headers=dict(request.headers),
+                                     idempotent=self.idempotent(request))
+        headers = self.filter_headers(response.headers)
+        content_length = dict(response.headers).get('content-length')
+        if content_length is not None and content_length.isdigit() and int(content_length) <= self.chunk_size:
+            try:
+                return Response(response.status, headers, response.read())
+            finally:
+                response.close()
+        return StreamingResponse(
+            response.status,
+            headers,
+            stream=response,
+            content_length=content_length,
+            chunk_size=self.chunk_size,
+            file_wrapper=request.file_wrapper,
+        )
+
+    @staticmethod
+    def filter_headers(headers):
+        return [(key, value) for key, value in headers
+                if key.lower() not in HOP_BY_HOP_HEADERS]
+
+
+def default_response_cache():
+    "Returns the ResponseCache configured in settings, or None if caching is off."
+    if not settings.response_cache_ttls:
+        return None
+    if settings.response_cache_backend:
+        store = cache.KVCacheStore(kvstore.get_kvstore(settings.response_cache_backend))
+    else:
+        store = cache.LRUCache(settings.response_cache_size)
+    return cache.ResponseCache(settings.response_cache_ttls, store, aws.AUTH_PARAMETERS, aws.is_read_only)
+
+
+def _brokers(policies):
+    "Returns the notification brokers `policies` send notifications through."
+    return set(broker for broker in (getattr(p, 'notification_broker', None) for p in policies)
+               if broker is not None)
+
+
+def _stop(obj):
+    # Stops a credential store or notification broker a reload replaced.
+    # Ones that don't have anything running may not have a stop method.
+    stop = getattr(obj, 'stop', None)
+    if stop is not None:
+        try:
+            stop()
+        except Exception:
+            logger.exception('Unable to stop %r', obj)
+
+
+# Held while the configuration is being reloaded. Reloads swap process-wide
+# state (the settings and balancer), so there's one lock for the whole
+# process.
+_reload_lock = threading.Lock()
+
+
+class Runtime(object):
+    """
+    What a gateway handles requests with that a reload replaces: a settings
+    snapshot (see `Config.build`, which also holds its policy index and
+    entity directory), the authenticator with the snapshot's credential
+    store, and the authorizer built for the snapshot and its balancer. A
+    reload doesn't change it, it builds a new one.
+
+    """
+
+    def __init__(self, authenticator, authorizer, values=None):
+        self.authenticator = authenticator
+        self.authorizer = authorizer
+        self.values = values
+
+    @property
+    def snapshot(self):
+        "The settings snapshot, or the current settings if it wasn't built for one."
+        return self.values if self.values is not None else settings.__dict__
 
 
 class GoldenGate(object):
-    def __init__(self, authenticator=aws.Authenticator, authorizer=aws.Authorizer, auditor=settings.auditor, proxy=Proxy):
+    def __init__(self, authenticator=aws.Authenticator, authorizer=aws.Authorizer, auditor=settings.auditor, proxy=Proxy, response_cache=default_response_cache):
         credentials = [Credential(*credential) for credential in settings.credentials]
-        self.authenticator = authenticator(settings.credential_store(credentials))
-        self.authorizer = authorizer()
+        self.authorizer_class = authorizer
+        # Until the first reload, requests are handled with the current settings.
+        self.runtime = Runtime(authenticator(settings.credential_store(credentials)), authorizer())
         self.auditor = auditor(*settings.auditor_args)
         self.proxy = proxy()
+        self.cache = response_cache()
+        self.coalescer = cache.SingleFlight() if settings.coalesce_requests else None
+        self.executor = deferred.get_executor(self.authorizer, self.proxy, self.auditor)
+        if self.executor is not None:
+            self.executor.start()
+        deferred.check_policies(settings.policies, self.executor)
+
+    @property
+    def authenticator(self):
+        return self.runtime.authenticator
+
+    @property
+    def authorizer(self):
+        return self.runtime.authorizer
+
+    # Management URL prefixes and the methods that handle them. The handler
+    # is called with the request and the rest of the path. Routes that don't
+    # end in '/' only match that exact path.
+    routes = [
+        ('/~/cancel/', 'manage_cancel'),
+        ('/~/result/', 'manage_result'),
+        ('/~/approve/', 'manage_approve'),
+        ('/~/reload', 'manage_reload'),
+    ]
 
     def manage(self, request):
         "Handle Golden Gate management requests."
-        if request.url.path.startswith('/~/cancel/'):
-            uuid = request.url.path[10:]
-            from policy import TimeLockPolicy
-            try:
-                TimeLockPolicy.cancel(uuid)
-            except KeyError:
-                return Response(404)
-            return Response(body='okie dokie.')
+        path = request.url.path
+        for prefix, name in self.routes:
+            if path == prefix or (prefix.endswith('/') and path.startswith(prefix)):
+                return getattr(self, name)(request, path[len(prefix):])
         return Response(404)
 
+    def manage_cancel(self, request, uuid):
+        from policy import TimeLockPolicy
+        try:
+            TimeLockPolicy.cancel(uuid)
+        except KeyError:
+            return Response(404)
+        return Response(body='okie dokie.')
+
+    def manage_approve(self, request, uuid):
+        "Approves a request that needs two-person integrity."
+        from policy import TwoPersonPolicy, ApprovalException
+        entity = self.authenticator.authenticate(request)
+        try:
+            TwoPersonPolicy.approve(uuid, entity)
+        except KeyError:
+            return Response(404)
+        except ApprovalException, e:
+            raise UnauthorizedException(entity, str(e))
+        return Response(body='okie dokie.')
+
+    def manage_reload(self, request, rest):
+        "Reloads the configuration on behalf of an entity in reload_entities."
+        runtime = self.runtime
+        entity = runtime.authenticator.authenticate(request)
+        if entity not in runtime.snapshot['reload_entities']:
+            raise UnauthorizedException(entity)
+        if not self.try_reload():
+            return Response(500, body='unable to reload configuration')
+        return Response(body='okie dokie.')
+
+    def reload(self):
+        """
+        Reloads the configuration file. Everything a request is handled with
+        that depends on the configuration (the settings with their policy
+        index and entity directory, the credential store, the balancer and
+        the authorizer) is built into a new `Runtime` first, and then
+        swapped in with a single assignment. Each request reads the runtime
+        once, so it's authenticated, authorized and routed entirely with the
+        old configuration or entirely with the new one. If the file can't be
+        read, or anything can't be built, an exception is raised and the old
+        configuration is kept.
+
+        Code that reads the process-wide `settings` directly (e.g., to tell
+        whether an action is read-only) sees the new settings once they're
+        installed just after the swap. Settings that are only read at startup
+        (the upstream connection pool, response cache, deferred executor and
+        auditor) still need a restart.
+
+        Reloads are serialized (e.g., a SIGHUP arriving during a reload
+        through /~/reload waits for it to finish).
+
+        Reloading executes the file again, which builds new notification
+        brokers, so once the new policies are in place the brokers only the
+        old ones used are stopped (after delivering what they've queued).
+        Brokers the file imports from elsewhere are shared by both and keep
+        running.
+
+        """
+        with _reload_lock:
+            self._reload()
+
+    def _reload(self):
+        snapshot = reload_config()
+        policy.PolicyIndex.for_settings(snapshot)
+        directory.for_settings(snapshot)
+        upstream = balancer.for_settings(snapshot)
+        previous = self.runtime
+        previous_brokers = _brokers(previous.snapshot['policies'])
+        store = self.credential_store(snapshot)
+        try:
+            # A copy, so the new runtime shares everything else (e.g., the
+            # replay cache) with the old one.
+            authenticator = copy.copy(previous.authenticator)
+            authenticator.credentials = store
+            authorizer = self.authorizer_class(balancer=upstream, values=snapshot)
+        except:
+            _stop(store)
+            raise
+        self.runtime = Runtime(authenticator, authorizer, snapshot)
+
+        settings.install(snapshot)
+        balancer.install(upstream)
+        if hasattr(self.proxy, 'balancer'):
+            self.proxy.balancer = upstream
+        if self.executor is not None:
+            self.executor.authorizer = authorizer
+        deferred.check_policies(snapshot['policies'], self.executor)
+        _stop(previous.authenticator.credentials)
+        for broker in previous_brokers - _brokers(snapshot['policies']):
+            _stop(broker)
+
+    def credential_store(self, values):
+        """
+        Builds a new credential store for a settings snapshot. It's never the
+        current store reloaded in place, since requests still being handled
+        with the old configuration use that one.
+
+        """
+        store_class = values['credential_store']
+        credentials = [Credential(*credential) for credential in values['credentials']]
+        if issubclass(store_class, FileCredentialStore):
+            filename, interval = store_class.source(values)
+            return store_class(credentials, filename=filename, interval=interval)
+        store = store_class(credentials)
+        if isinstance(store, ReloadableCredentialStore):
+            store.reload()
+        return store
+
+    def try_reload(self):
+        "Calls `reload`, logging rather than raising any error. Returns True if it worked."
+        try:
+            self.reload()
+        except Exception:
+            logger.exception('Unable to reload configuration')
+            return False
+        return True
+
+    def manage_result(self, request, uuid):
+        "Returns the response to a deferred request, if it has been sent."
+        entity = self.authenticator.authenticate(request)
+        job = deferred.result(uuid)
+        # Only the entity that made the request gets to see the result.
+        if job is None or job.entity != entity:
+            return Response(404)
+        if job.state in (deferred.PENDING, deferred.RUNNING):
+            return Response(202, body=job.state)
+        if job.state in (deferred.CANCELLED, deferred.EXPIRED):
+            return Response(410, body=job.state)
+        status, headers, body = job.response
+        return Response(status, list(headers), body)
+
     def handle(self, request):
         """
         The contract of the request handler is: accept a request, return a response.
@@ -54,15 +416,35 @@ class GoldenGate(object):
         if request.url.path.startswith('/~/'):
             return self.manage(request)
 
-        entity = self.authenticator.authenticate(request)
-        authorized_request = self.authorizer.authorize(entity, request)
+        # Read once, so a reload can't swap it out partway through.
+        runtime = self.runtime
+        entity = runtime.authenticator.authenticate(request)
+        authorized_request = runtime.authorizer.authorize(entity, request)
         self.auditor.record(
             entity, [
                 'applied',
                 [request.to_dict(), authorized_request.to_dict()],
             ]
         )
-        return self.proxy.request(authorized_request)
+        fetch = lambda: self.upstream(authorized_request)
+        if self.cache is None:
+            return fetch()
+        # Cached responses are only served once the request has been
+        # authorized, so policies are still applied to every request.
+        return self.cache.fetch(entity, request, fetch)
+
+    def upstream(self, request):
+        """
+        Make an authorized request. Identical read-only requests that arrive
+        while one is already in flight wait for it and share its response.
+        The response is only read into memory if another request does join
+        it; otherwise a streamed response is still streamed.
+
+        """
+        if self.coalescer is None or not aws.is_read_only(request.url.parameters.get('Action')):
+            return self.proxy.request(request)
+        key = cache.request_key(request, aws.AUTH_PARAMETERS, request.url.host)
+        return self.coalescer.do(key, lambda: self.proxy.request(request), lambda response: response.buffered())
 
 
 class Handler(object):
@@ -83,4 +465,21 @@ class Handler(object):
                 raise
 
 
+def reload_on_signal(gateway, signum=signal.SIGHUP):
+    "Reloads `gateway`'s configuration whenever the process receives `signum`."
+    def handler(signum, frame):
+        # Reload on another thread rather than in the middle of whatever the
+        # main thread was doing when the signal arrived.
+        thread = threading.Thread(target=gateway.try_reload)
+        thread.daemon = True
+        thread.start()
+    try:
+        signal.signal(signum, handler)
+    except ValueError:
+        # Signal handlers can only be installed from the main thread.
+        logger.warning('Unable to install a handler for signal %d, reload through /~/reload instead', signum)
+
+
 application = Handler(GoldenGate())
+if settings.reload_on_sighup:
+    reload_on_signal(application.handler)
@@ -1,4 +1,5 @@
 import urllib
+import urlparse
 from collections import namedtuple
 try:
     from urlparse import parse_qs
@@ -51,6 +52,22 @@ STATUS_CODES = {
 }
 
 
+# Headers that only apply to a single connection and must not be passed
+# through the gateway. Content-Length is included because Response computes
+# its own.
+HOP_BY_HOP_HEADERS = frozenset([
+    'connection',
+    'keep-alive',
+    'proxy-authenticate',
+    'proxy-authorization',
+    'te',
+    'trailers',
+    'transfer-encoding',
+    'upgrade',
+    'content-length',
+])
+
+
 class HTTPException(Exception):
     """
     An HTTPException indicates some sort of HTTP error condition (probably a
@@ -119,24 +136,85 @@ def headers_from_environ(environ):
     return headers
 
 
+def body_from_environ(environ):
+    # Read exactly CONTENT_LENGTH bytes. Reading wsgi.input to EOF isn't
+    # allowed by WSGI, and some servers will block waiting for more data.
+    try:
+        length = int(environ.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        length = 0
+    if length <= 0:
+        return ''
+    return environ['wsgi.input'].read(length)
+
+
 def clone_url(url, **kwargs):
-    opts = {
-        'scheme': url.scheme,
-        'host': url.host,
-        'path': url.path,
-        'parameters': url.parameters.copy(),
-    }
-    opts.update(kwargs)
-    return URL(**opts)
+    # The parameters dict is shared with `url` unless it's replaced (see
+    # Request).
+    return url._replace(**kwargs)
+
+
+class ParameterView(object):
+    """
+    A read-only view of a request's parameters for policies to look at.
+    Values can be read as strings (`get`) or integers (`get_int`), and
+    indexed parameters like InstanceId.1, InstanceId.2, ... can be read as a
+    list by naming the index 'N' (`get_list('InstanceId.N')`, or
+    `get_list('Filter.N.Name')`). The parameters are only grouped into lists
+    the first time a list is asked for.
+
+    """
+
+    def __init__(self, parameters):
+        self.parameters = parameters
+        self.lists = None
+
+    def get(self, name, default=None):
+        return self.parameters.get(name, default)
+
+    def get_int(self, name, default=None):
+        "Returns the parameter as an integer, or `default` if it's missing or isn't one."
+        try:
+            return int(self.parameters[name])
+        except (KeyError, ValueError):
+            return default
+
+    def _group(self):
+        lists = {}
+        for key, value in self.parameters.iteritems():
+            parts = key.split('.')
+            for i, part in enumerate(parts):
+                if part.isdigit():
+                    name = '.'.join(parts[:i] + ['N'] + parts[i + 1:])
+                    lists.setdefault(name, []).append((int(part), value))
+                    break
+        return dict((name, tuple([value for _, value in sorted(values)])) for name, values in lists.iteritems())
+
+    def get_list(self, name):
+        "Returns the values of an indexed parameter, in index order, as a tuple."
+        if self.lists is None:
+            self.lists = self._group()
+        return self.lists.get(name, ())
+
+    def lookup(self, name):
+        "Returns `get_list(name)` if `name` is indexed, and `get(name)` otherwise."
+        if 'N' in name.split('.'):
+            return self.get_list(name)
+        return self.get(name)
 
 
 class Request(object):
     """
     Request encapsulates information related to an HTTP request.
 
+    Clones share their url, parameters and headers with the request they were
+    cloned from, so once a request has been created those shouldn't be
+    modified in place. Assign a new url (see `clone_url`) or headers list
+    instead, or pass them to `_clone`.
+
     """
 
-    def __init__(self, method, url, headers, body, callback):
+    def __init__(self, method, url, headers, body, callback, file_wrapper=None):
         self.method = method.upper()
         self.url = url
         if isinstance(headers, dict):
@@ -145,6 +223,7 @@ class Request(object):
             self.headers = headers[:]
         self.body = body
         self.callback = callback
+        self.file_wrapper = file_wrapper
 
     @classmethod
     def from_wsgi(cls, environ, start_response):
@@ -152,10 +231,32 @@ class Request(object):
             method=environ.get('REQUEST_METHOD', 'GET'),
             url=url_from_environ(environ),
             headers=headers_from_environ(environ),
-            body=environ['wsgi.input'].read(),
+            body=body_from_environ(environ),
             callback=start_response,
+            file_wrapper=environ.get('wsgi.file_wrapper'),
         )
 
+    @classmethod
+    def from_dict(cls, d, callback=None):
+        "Rebuilds a request from the output of `to_dict`."
+        parsed = urlparse.urlsplit(d['url'])
+        parameters = dict((k, v[0]) for k, v in parse_qs(parsed.query, keep_blank_values=True).iteritems())
+        return cls(
+            method=d['method'],
+            url=URL(scheme=parsed.scheme, host=parsed.netloc, path=parsed.path, parameters=parameters),
+            headers=d['headers'],
+            body=d['body'],
+            callback=callback,
+        )
+
+    @property
+    def parameter_view(self):
+        "A `ParameterView` of the URL parameters, built once per set of parameters."
+        view = self.__dict__.get('_parameter_view')
+        if view is None or view.parameters is not self.url.parameters:
+            view = self._parameter_view = ParameterView(self.url.parameters)
+        return view
+
     def get_url(self):
         url = self.url.scheme + '://' + self.url.host + self.url.path
         if self.url.parameters:
@@ -163,17 +264,12 @@ class Request(object):
         return url
 
     def _clone(self, klass=None, **kwargs):
-        if klass is None:
-            klass = self.__class__
-        opts = {
-            'method': self.method,
-            'url': clone_url(self.url),
-            'headers': self.headers,
-            'body': self.body,
-            'callback': self.callback,
-        }
-        opts.update(kwargs)
-        return klass(**opts)
+        clone = object.__new__(klass if klass is not None else self.__class__)
+        clone.__dict__.update(self.__dict__)
+        if isinstance(kwargs.get('headers'), dict):
+            kwargs['headers'] = kwargs['headers'].items()
+        clone.__dict__.update(kwargs)
+        return clone
 
     def to_dict(self):
         return {
@@ -199,7 +295,10 @@ class Response(object):
         if isinstance(headers, dict):
             headers = headers.items()
         self.headers = headers if headers is not None else []
-        self.body = unicode(body).encode(self.charset)
+        if isinstance(body, unicode):
+            self.body = body.encode(self.charset)
+        else:
+            self.body = str(body)
         self.headers += [['Content-Length', len(self.body)]]
 
     def send(self, start_response):
@@ -207,6 +306,15 @@ class Response(object):
         start_response(status, self.headers)
         return iter([self.body])
 
+    def content_headers(self):
+        "Returns the response headers, minus the ones describing the body's length."
+        return [(name, value) for name, value in self.headers
+                if name.lower() != 'content-length']
+
+    def buffered(self):
+        "Returns a copy of this response that can be sent independently."
+        return Response(self.status, self.content_headers(), self.body)
+
     @classmethod
     def encode_headers(cls, headers):
         "Properly encode a dict of headers. They must be ascii."
@@ -216,3 +324,49 @@ class Response(object):
             else:
                 return str(data)
         return [(_encode(key), _encode(value)) for key, value in headers]
+
+
+class StreamingResponse(Response):
+    """
+    A response whose body is read from a file-like `stream` and handed to the
+    WSGI server in chunks of `chunk_size` bytes as it's sent, so it's never
+    held in memory all at once. The bytes are passed along as-is. If the
+    server provided a `wsgi.file_wrapper` it's used to send the stream.
+
+    """
+
+    def __init__(self, status=200, headers=None, stream=None, content_length=None, chunk_size=64 * 1024, file_wrapper=None):
+        self.status = status
+        if isinstance(headers, dict):
+            headers = headers.items()
+        self.headers = list(headers) if headers is not None else []
+        if content_length is not None:
+            self.headers += [['Content-Length', content_length]]
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.file_wrapper = file_wrapper
+
+    def send(self, start_response):
+        status = '%d %s' % (self.status, STATUS_CODES.get(self.status))
+        start_response(status, self.headers)
+        if self.file_wrapper is not None:
+            return self.file_wrapper(self.stream, self.chunk_size)
+        return self.iter_chunks()
+
+    def buffered(self):
+        "Reads the rest of the stream and returns it as a plain Response."
+        try:
+            body = self.stream.read()
+        finally:
+            self.stream.close()
+        return Response(self.status, self.content_headers(), body)
+
+    def iter_chunks(self):
+        try:
+            while True:
+                chunk = self.stream.read(self.chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            self.stream.close()
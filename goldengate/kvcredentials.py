@@ -0,0 +1,132 @@
+"""
+Credentials stored in the kvstore. This lives outside `goldengate.credentials`
+because that module is imported while the settings are being set up, before
+the kvstore can be.
+
+"""
+
+import time
+import uuid
+
+from .cache import LRUCache
+from .credentials import Credential, CredentialStore
+from .kvstore import models
+
+
+class StoredCredential(models.Model):
+    key = models.Field(pk=True)
+    entity = models.Field()
+    secret = models.Field()
+
+
+class EntityKeys(models.Model):
+    entity = models.Field(pk=True)
+    keys = models.Field(default=())
+
+
+_MISS = object()
+
+
+class KVCredentialStore(CredentialStore):
+    """
+    Keeps credentials in the kvstore with a bounded in-process cache in front
+    of it. Lookups for keys that don't exist are cached too, so unknown keys
+    don't reach the kvstore on every request.
+
+    Every change bumps a version stamp in the kvstore. Each gateway checks the
+    stamp at most once every `poll_interval` seconds and drops its cache when
+    it has changed, so a change made on one gateway reaches the others within
+    a few seconds. Cached entries also expire after `ttl` seconds.
+
+    Any `credentials` given are saved to the kvstore when the store is
+    created.
+
+    """
+
+    version_key = '__GG_CREDENTIALS_VERSION__'
+
+    def __init__(self, credentials=(), cache_size=None, ttl=None, poll_interval=None):
+        from . import settings
+        self.backend = StoredCredential.storage_backend
+        self.cache = LRUCache(
+            cache_size if cache_size is not None else settings.credential_cache_size,
+            ttl if ttl is not None else settings.credential_cache_ttl,
+        )
+        self.poll_interval = poll_interval if poll_interval is not None else settings.credential_poll_interval
+        self.generation = 0
+        self.version = self.backend.get(self.version_key)
+        self.next_poll = time.time() + self.poll_interval
+        if credentials:
+            for credential in credentials:
+                self._save(credential)
+            self.bump()
+
+    def invalidate(self):
+        # Lookups that started before the cache was cleared won't cache what
+        # they found (see `for_key`).
+        self.generation += 1
+        self.cache.clear()
+
+    def poll(self):
+        now = time.time()
+        if now < self.next_poll:
+            return
+        self.next_poll = now + self.poll_interval
+        version = self.backend.get(self.version_key)
+        if version != self.version:
+            self.version = version
+            self.invalidate()
+
+    def bump(self):
+        self.version = uuid.uuid4().hex
+        self.backend.set(self.version_key, self.version)
+        self.invalidate()
+
+    def _save(self, credential):
+        StoredCredential(key=credential.key, entity=credential.entity, secret=credential.secret).save()
+        # Not atomic: two gateways adding keys for the same entity at once may
+        # lose one of them from the entity's list.
+        entity = EntityKeys.get(credential.entity) or EntityKeys(entity=credential.entity)
+        if credential.key not in entity.keys:
+            entity.keys = tuple(entity.keys) + (credential.key,)
+            entity.save()
+
+    def add(self, credential):
+        self._save(credential)
+        self.bump()
+
+    def remove(self, key):
+        stored = StoredCredential.get(key)
+        if stored is None:
+            return
+        stored.delete()
+        entity = EntityKeys.get(stored.entity)
+        if entity is not None:
+            entity.keys = tuple(k for k in entity.keys if k != key)
+            entity.save()
+        self.bump()
+
+    def _cached(self, cache_key, load):
+        self.poll()
+        generation = self.generation
+        value = self.cache.get(cache_key, _MISS)
+        if value is _MISS:
+            value = load()
+            if generation == self.generation:
+                self.cache.set(cache_key, value)
+        return value
+
+    def for_key(self, key):
+        def load():
+            stored = StoredCredential.get(key)
+            if stored is None:
+                return None
+            return Credential(stored.entity, stored.key, stored.secret)
+        return self._cached(key, load)
+
+    def for_entity(self, entity):
+        def load():
+            stored = EntityKeys.get(entity)
+            return stored.keys if stored is not None else ()
+        return [credential for credential in map(self.for_key, self._cached(('entity', entity), load))
+                if credential is not None]
@@ -13,10 +13,43 @@ class BaseStorage(object):
         """Set a value in the key-value store."""
         raise NotImplementedError
 
+    def set_with_timeout(self, key, value, timeout):
+        """
+        Set a value that expires after `timeout` seconds. Backends that can't
+        expire keys just set it.
+        """
+        self.set(key, value)
+
+    def add_with_timeout(self, key, value, timeout):
+        """
+        Set a value that expires after `timeout` seconds, but only if the key
+        isn't already in the store. Returns True if it was set. Backends
+        that can't do this atomically check and then set.
+        """
+        if self.has_key(key):
+            return False
+        self.set_with_timeout(key, value, timeout)
+        return True
+
     def delete(self, key):
         """Delete a key from the key-value store. Fail silently."""
         raise NotImplementedError
 
+    def publish(self, channel, message):
+        """
+        Send `message` to everything subscribed to `channel`, in any process
+        using this store. Backends that can't notify subscribers ignore it.
+        """
+        pass
+
+    def subscribe(self, channel, callback):
+        """
+        Call `callback` with each message published to `channel`. Returns
+        False if the backend can't notify subscribers, in which case callers
+        have to poll the store for changes instead.
+        """
+        return False
+
     def has_key(self, key):
         """Returns True if the key is in the store."""
         return self.get(key) is not None
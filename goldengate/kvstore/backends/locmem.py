@@ -20,6 +20,7 @@ class StorageClass(BaseStorage):
         BaseStorage.__init__(self, params)
         self._db = {}
         self._lock = RWLock()
+        self._subscribers = {}
 
     def set(self, key, value):
         self._lock.writer_enters()
@@ -28,6 +29,17 @@ class StorageClass(BaseStorage):
         finally:
             self._lock.writer_leaves()
 
+    def add_with_timeout(self, key, value, timeout):
+        # Keys don't expire, but adding is atomic.
+        self._lock.writer_enters()
+        try:
+            if key in self._db:
+                return False
+            self._db[key] = pickle.dumps(value)
+            return True
+        finally:
+            self._lock.writer_leaves()
+
     def get(self, key):
         self._lock.reader_enters()
         # Python 2.3 and 2.4 don't allow combined try-except-finally blocks.
@@ -57,6 +69,26 @@ class StorageClass(BaseStorage):
         finally:
             self._lock.reader_leaves()
 
+    # The store only exists in this process, so every subscriber does too
+    # and publishing can just call them.
+
+    def publish(self, channel, message):
+        self._lock.reader_enters()
+        try:
+            callbacks = list(self._subscribers.get(channel, ()))
+        finally:
+            self._lock.reader_leaves()
+        for callback in callbacks:
+            callback(message)
+
+    def subscribe(self, channel, callback):
+        self._lock.writer_enters()
+        try:
+            self._subscribers.setdefault(channel, []).append(callback)
+        finally:
+            self._lock.writer_leaves()
+        return True
+
 
 """
 Synchronization primitives:
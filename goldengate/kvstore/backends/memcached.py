@@ -37,9 +37,17 @@ class StorageClass(BaseStorage):
         self._db = memcache.Client(server.split(';'))
 
     def set(self, key, value):
+        self.set_with_timeout(key, value, 0)
+
+    def set_with_timeout(self, key, value, timeout):
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        self._db.set(_utf8_str(key), value, int(timeout))
+
+    def add_with_timeout(self, key, value, timeout):
         if isinstance(value, unicode):
             value = value.encode('utf-8')
-        self._db.set(_utf8_str(key), value, 0)
+        return bool(self._db.add(_utf8_str(key), value, int(timeout)))
 
     def get(self, key):
         val = self._db.get(_utf8_str(key))
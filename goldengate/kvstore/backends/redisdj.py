@@ -9,6 +9,8 @@ port is optional. If none is given, the port specified in redis.conf will be use
 
 """
 import base64
+import logging
+import threading
 from base import BaseStorage, InvalidKeyValueStoreBackendError
 
 try:
@@ -21,6 +23,8 @@ try:
 except ImportError:
     import pickle
 
+logger = logging.getLogger(__name__)
+
 def _utf8_str(s):
     if isinstance(s, unicode):
         return s.encode('utf-8')
@@ -43,6 +47,14 @@ class StorageClass(BaseStorage):
         encoded = base64.encodestring(pickle.dumps(value, 2)).strip()
         self._db.set(_utf8_str(key), encoded)
 
+    def set_with_timeout(self, key, value, timeout):
+        encoded = base64.encodestring(pickle.dumps(value, 2)).strip()
+        self._db.setex(name=_utf8_str(key), value=encoded, time=int(timeout))
+
+    def add_with_timeout(self, key, value, timeout):
+        encoded = base64.encodestring(pickle.dumps(value, 2)).strip()
+        return bool(self._db.set(_utf8_str(key), encoded, ex=int(timeout), nx=True))
+
     def get(self, key):
         val = self._db.get(_utf8_str(key))
         if val is None:
@@ -52,5 +64,25 @@ class StorageClass(BaseStorage):
     def delete(self, key):
         self._db.delete(_utf8_str(key))
 
+    def publish(self, channel, message):
+        self._db.publish(_utf8_str(channel), _utf8_str(message))
+
+    def subscribe(self, channel, callback):
+        pubsub = self._db.pubsub()
+        pubsub.subscribe(_utf8_str(channel))
+        thread = threading.Thread(target=self._listen, args=(pubsub, callback))
+        thread.daemon = True
+        thread.start()
+        return True
+
+    def _listen(self, pubsub, callback):
+        for message in pubsub.listen():
+            if message['type'] != 'message':
+                continue
+            try:
+                callback(message['data'])
+            except Exception:
+                logger.exception('Error handling message on %s', message['channel'])
+
     def close(self, **kwargs):
         pass
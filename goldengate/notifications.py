@@ -1,31 +1,199 @@
+from __future__ import with_statement
+import Queue
+import logging
 import smtplib
+import socket
+import threading
+import time
 from collections import namedtuple
 from email.mime.text import MIMEText
 
+from . import scheduler
+from .resilience import Backoff
+
+
+logger = logging.getLogger(__name__)
+
 
 class NotificationException(Exception):
     pass
 
 
-Notification = namedtuple('Notification', 'recipients body')
+class Notification(namedtuple('Notification', 'recipients body deadline')):
+    """
+    A message for `recipients`. `deadline` is when it stops being any use
+    (e.g., when the time-lock it announces expires), or None.
+
+    """
+    __slots__ = ()
+
+    def __new__(cls, recipients, body, deadline=None):
+        return super(Notification, cls).__new__(cls, recipients, body, deadline)
+
+
+class Delivery(object):
+    """
+    What became of a notification. `delivered` is None until the broker
+    knows, then True or False. Callbacks passed to `then` are called with the
+    delivery once it's settled (straight away if it already is), on whichever
+    thread settled it.
+
+    """
+
+    def __init__(self, delivered=None):
+        self.delivered = delivered
+        self.callbacks = []
+        self.lock = threading.Lock()
+
+    def settle(self, delivered):
+        with self.lock:
+            if self.delivered is not None:
+                return
+            self.delivered = delivered
+            callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+    def then(self, callback):
+        with self.lock:
+            if self.delivered is None:
+                self.callbacks.append(callback)
+                return
+        callback(self)
+
+
+def delivery_of(result):
+    """
+    Returns the `Delivery` for what a broker's `send` returned. Brokers that
+    don't return one deliver before `send` returns (or raise).
+
+    """
+    return result if isinstance(result, Delivery) else Delivery(True)
+
+
+# Tells a worker to exit.
+_STOP = object()
 
 
 class NotificationBroker(object):
     def send(self, notification):
         print notification
+        return Delivery(True)
+
+    def stop(self):
+        "Releases the broker's resources once it won't be sent anything else."
+        pass
+
+
+class QueuedNotificationBroker(NotificationBroker):
+    """
+    Base class for brokers that deliver notifications in the background.
+    `send` only puts the notification on a queue and returns its `Delivery`;
+    `workers` threads take them off and call `deliver`, retrying failed
+    deliveries up to `retries` times with exponential backoff.
+
+    Subclasses implement `deliver`, and can implement `idle` to release
+    resources when a worker hasn't had anything to do for `idle_timeout`
+    seconds.
+
+    """
 
+    def __init__(self, workers=1, retries=5, backoff=None, idle_timeout=60):
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff if backoff is not None else Backoff(1, 60)
+        self.idle_timeout = idle_timeout
+        self.queue = Queue.Queue()
+        self.threads = []
+        self.lock = threading.Lock()
 
-class EmailNotificationBroker(object):
-    def __init__(self, sender, host, port, tls=True, username=None, password=None):
+    def send(self, notification):
+        if len(self.threads) < self.workers:
+            self._start_workers()
+        delivery = Delivery()
+        self.queue.put((notification, delivery))
+        return delivery
+
+    def _start_workers(self):
+        with self.lock:
+            while len(self.threads) < self.workers:
+                thread = threading.Thread(target=self.work, args=(len(self.threads),))
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+
+    def join(self):
+        "Blocks until every queued notification has been delivered (or given up on)."
+        self.queue.join()
+
+    def stop(self):
+        "Stops the workers once they've delivered what's already queued."
+        with self.lock:
+            for _ in self.threads:
+                self.queue.put(_STOP)
+            self.threads = []
+
+    def work(self, worker):
+        while True:
+            try:
+                item = self.queue.get(True, self.idle_timeout)
+            except Queue.Empty:
+                self.idle(worker)
+                continue
+            if item is _STOP:
+                self.idle(worker)
+                self.queue.task_done()
+                return
+            notification, delivery = item
+            try:
+                delivery.settle(self.deliver_with_retries(worker, notification))
+            finally:
+                self.queue.task_done()
+
+    def deliver_with_retries(self, worker, notification):
+        "Returns whether the notification was delivered."
+        for attempt in xrange(self.retries + 1):
+            try:
+                self.deliver(worker, notification)
+                return True
+            except Exception:
+                if attempt == self.retries:
+                    logger.exception('Giving up on notification for %s', ', '.join(notification.recipients))
+                    return False
+                logger.warning('Unable to deliver notification, retrying', exc_info=True)
+                time.sleep(self.backoff.delay(attempt))
+
+    def deliver(self, worker, notification):
+        raise NotImplementedError
+
+    def idle(self, worker):
+        pass
+
+
+class EmailNotificationBroker(QueuedNotificationBroker):
+    """
+    Sends notifications by email from background workers. Each worker keeps
+    its own SMTP session open between messages, reconnecting if the server
+    has dropped it, and closes it after `idle_timeout` seconds without mail.
+    A notification is sent as a single message addressed to all of its
+    recipients.
+
+    """
+
+    smtp_class = smtplib.SMTP
+
+    def __init__(self, sender, host, port, tls=True, username=None, password=None, connections=1, **kwargs):
         self.sender = sender
         self.host = host
         self.port = port
         self.tls = tls
         self.username = username
         self.password = password
+        self.sessions = {}
+        super(EmailNotificationBroker, self).__init__(workers=connections, **kwargs)
 
-    def send(self, notification):
-        smtp = smtplib.SMTP(self.host, self.port)
+    def connect(self):
+        smtp = self.smtp_class(self.host, self.port)
         if self.tls:
             smtp.ehlo()
             smtp.starttls()
@@ -34,12 +202,121 @@ class EmailNotificationBroker(object):
             try:
                 smtp.login(self.username, self.password)
             except smtplib.SMTPAuthenticationError, ex:
+                smtp.close()
                 raise NotificationException('SMTP Error')
+        return smtp
+
+    def session(self, worker):
+        smtp = self.sessions.get(worker)
+        if smtp is None:
+            smtp = self.sessions[worker] = self.connect()
+        return smtp
+
+    def message(self, notification):
+        message = MIMEText(notification.body)
+        message['From'] = self.sender
+        message['To'] = ', '.join(notification.recipients)
+        message['Subject'] = 'Golden Gate Notification'
+        return message.as_string()
+
+    def deliver(self, worker, notification):
+        message = self.message(notification)
+        try:
+            refused = self.session(worker).sendmail(self.sender, list(notification.recipients), message)
+        except (smtplib.SMTPServerDisconnected, socket.error):
+            # The server probably closed an idle session. Try once more on a
+            # fresh one before handing the failure to the retry logic.
+            self.close(worker)
+            refused = self.session(worker).sendmail(self.sender, list(notification.recipients), message)
+        if refused:
+            logger.error('Notification refused for %s', ', '.join(refused))
+
+    def close(self, worker):
+        smtp = self.sessions.pop(worker, None)
+        if smtp is not None:
+            try:
+                smtp.quit()
+            except (smtplib.SMTPException, socket.error):
+                smtp.close()
+
+    def idle(self, worker):
+        self.close(worker)
+
+
+class DigestNotificationBroker(NotificationBroker):
+    """
+    Wraps another broker and combines the notifications sent to the same
+    recipients within `window` seconds into a single digest, so a burst of
+    gated requests doesn't turn into a burst of email. Each notification's
+    body (and so its cancellation or approval link) is kept as it is. A
+    digest is sent early once it has `max_entries` notifications in it, or
+    once it's `margin` seconds before the earliest deadline of the
+    notifications in it, so recipients still have time to act on them. Each
+    notification's `Delivery` settles with the digest's.
+
+    """
+
+    separator = '\n\n' + '-' * 72 + '\n\n'
+
+    def __init__(self, broker, window=30, max_entries=50, margin=60):
+        self.broker = broker
+        self.window = window
+        self.max_entries = max_entries
+        self.margin = margin
+        self.pending = {}
+        self.timers = {}
+        self.lock = threading.Lock()
+
+    def send(self, notification):
+        key = tuple(sorted(notification.recipients))
+        now = time.time()
+        flush_at = now + self.window
+        if notification.deadline is not None:
+            flush_at = min(flush_at, notification.deadline - self.margin)
+        delivery = Delivery()
+        with self.lock:
+            entries = self.pending.get(key)
+            if entries is None:
+                entries = self.pending[key] = []
+            entries.append((notification, delivery))
+            due = len(entries) >= self.max_entries or flush_at <= now
+            timer = self.timers.get(key)
+            if not due and (timer is None or flush_at < timer.when):
+                if timer is not None:
+                    timer.cancel()
+                self.timers[key] = scheduler.get_scheduler().schedule(flush_at, lambda: self.flush(key, entries))
+        if due:
+            self.flush(key, entries)
+        return delivery
+
+    def flush(self, key, entries):
+        with self.lock:
+            # Already sent (early, because it filled up or was due).
+            if self.pending.get(key) is not entries:
+                return
+            del self.pending[key]
+            timer = self.timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        bodies = [notification.body for notification, _ in entries]
+        if len(bodies) == 1:
+            body = bodies[0]
+        else:
+            body = '%d requests\n\n%s' % (len(bodies), self.separator.join(bodies))
+        deadlines = [notification.deadline for notification, _ in entries if notification.deadline is not None]
+        try:
+            sent = delivery_of(self.broker.send(Notification(list(key), body, min(deadlines) if deadlines else None)))
+        except Exception:
+            logger.exception('Unable to send digest to %s', ', '.join(key))
+            sent = Delivery(False)
+        sent.then(lambda sent: [entry.settle(sent.delivered) for _, entry in entries])
+
+    def flush_all(self):
+        "Sends everything that's waiting right away."
+        for key, entries in self.pending.items():
+            self.flush(key, entries)
 
-        for recipient in notification.recipients:
-            message = MIMEText(notification.body)
-            message['From'] = self.sender
-            message['To'] = recipient
-            message['Subject'] = 'Golden Gate Notification'
-            smtp.sendmail(self.sender, [recipient], message.as_string())
-        smtp.quit()
+    def stop(self):
+        "Sends everything that's waiting and stops the wrapped broker."
+        self.flush_all()
+        self.broker.stop()
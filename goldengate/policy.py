@@ -1,7 +1,12 @@
+from __future__ import with_statement
+import re
 import time
 import uuid
-from . import settings
-from .notifications import Notification
+import threading
+import logging
+import types
+from . import settings, scheduler, deferred, directory
+from .notifications import Notification, delivery_of
 from .sausagefactory import AuditTrail
 try:
     import simplejson as json
@@ -10,15 +15,22 @@ except ImportError:
 from kvstore import models
 
 
+logger = logging.getLogger(__name__)
+
+
 def action(action, allow, entities=None, **kwargs):
     """
     Helper for constructing AWS policies. The policy will match AWS request that
-    match a particular action. If allow is True the request will be granted. If
-    it's False it will be denied. Otherwise, allow is assumed to be a callable
-    that will return a Policy object.
+    match a particular action, which may be a glob pattern like 'Describe*'. If
+    allow is True the request will be granted. If it's False it will be denied.
+    Otherwise, allow is assumed to be a callable that will return a Policy
+    object.
 
     """
-    matcher = AWSActionMatcher(action)
+    if isinstance(action, basestring) and ('*' in action or '?' in action):
+        matcher = AWSActionGlobMatcher(action)
+    else:
+        matcher = AWSActionMatcher(action)
     if entities is not None:
         matcher = AllMatcher([EntityMatcher(entities), matcher])
 
@@ -54,7 +66,66 @@ class MissingPolicyException(Exception):
     pass
 
 
+def _owner(cls, name):
+    # The class in `cls`'s MRO that defines `name`.
+    for klass in cls.__mro__:
+        if name in klass.__dict__:
+            return klass
+    return None
+
+
+def _declares(obj, name, ignored=()):
+    """
+    Returns True if `obj`'s `name` (e.g. `constraints`) can be trusted to
+    describe it: `obj` is one of the policies or matchers defined here, or
+    every method its class adds to them (`applies_to`, `matches`, `grant`,
+    ...), apart from `ignored` ones, is defined no lower down than `name`
+    is. A subclass that overrides `matches` but inherits `constraints` has
+    to declare them again.
+
+    """
+    cls = type(obj)
+    if cls in _STOCK:
+        return True
+    owner = _owner(cls, name)
+    if owner is None:
+        return False
+    for klass in cls.__mro__:
+        if klass in _STOCK or klass is object:
+            break
+        for key, value in klass.__dict__.iteritems():
+            if key != '__init__' and key not in ignored and isinstance(value, (types.FunctionType, property, staticmethod, classmethod)):
+                if not issubclass(owner, klass):
+                    return False
+    return True
+
+
+def constraints(obj):
+    "Returns the (actions, entities) constraints of a policy or matcher."
+    # Policies and matchers don't have to subclass Policy and Matcher.
+    if hasattr(obj, 'constraints') and _declares(obj, 'constraints', ('grant',)):
+        return obj.constraints()
+    return None, None
+
+
+def attributes(obj):
+    "Returns the attributes a policy or matcher reads, or None if they aren't known."
+    if hasattr(obj, 'attributes') and _declares(obj, 'attributes', ('grant',)):
+        return obj.attributes()
+    return None
+
+
+def cacheable(policy):
+    "Returns True if `policy`'s decisions can be cached (see `Policy.cacheable`)."
+    return getattr(policy, 'cacheable', False) and _declares(policy, 'cacheable')
+
+
 class Policy(object):
+    # Set on policies whose decision only depends on what their matcher reads
+    # (and that have no side effects), so decisions can be cached. Subclasses
+    # that override `grant` (or anything else) have to set it again.
+    cacheable = False
+
     def applies_to(self, entity, request):
         """Returns true if this policy applies to the request."""
         raise NotImplementedError()
@@ -63,24 +134,213 @@ class Policy(object):
         """Should we grant entity permission to perform request?"""
         raise NotImplementedError()
 
+    def constraints(self):
+        """
+        Returns a tuple of (actions, entities) that this policy can only apply
+        to. Either may be None if it isn't limited to particular values.
+
+        """
+        return None, None
+
+    def attributes(self):
+        """
+        Returns the names of the attributes this policy reads to decide
+        whether it applies ('entity' for the entity, 'directory' for the
+        current entity directory, 'parameters.<name>' for a request
+        parameter, anything else is an attribute of the request), or None if
+        they aren't known.
+
+        """
+        return None
+
     @classmethod
     def for_request(self, entity, request, policies=None):
-        policies = policies if policies is not None else settings.policies
+        return PolicyIndex.of(policies).for_request(entity, request)
+
+    @classmethod
+    def authorize(self, entity, request, policies=None):
+        "Returns True if the policy for this request grants it."
+        return PolicyIndex.of(policies).grant(entity, request)
+
+
+class PolicyIndex(object):
+    """
+    A list of policies indexed by the AWS actions and entities they can apply
+    to. Looking up the policy for a request only checks the policies that
+    could apply to its action and entity, in their original order, so the
+    first policy that applies is the same one a linear scan would find.
+    Constraints are only used where they can be trusted (see `_declares`),
+    so a subclass that overrides `applies_to` or `matches` is a candidate for
+    every request unless it declares its constraints itself.
+
+    If every policy says which attributes it reads, decisions made by
+    cacheable policies are cached, keyed by those attributes. As with
+    constraints, `attributes` and `cacheable` are only trusted on subclasses
+    that declare them again below their overrides.
+
+    The index for the configured policies is built once per settings
+    snapshot (see `for_settings`), so replacing the policies setting gets a
+    new index (and an empty cache). A list of policies that's changed in
+    place isn't noticed: set it again instead.
+
+    The matchers of `MatcherPolicy`s are compiled (see `compile_matcher`) and
+    the index evaluates the compiled versions; the policies themselves are
+    left alone.
+
+    """
+
+    MAX_CANDIDATE_LISTS = 10000
+    MAX_DECISIONS = 10000
+
+    def __init__(self, policies):
+        self.policies = policies
+        # ((policy, applies_to), entities) for each policy, in order.
+        self.entries = []
+        # Positions of the policies that apply to any action.
+        self.any_action = []
+        # Action -> positions of the policies limited to it.
+        self.by_action = {}
+        # Positions of the policies limited to actions matching patterns.
+        self.patterns = ActionAutomaton()
+        for i, policy in enumerate(policies):
+            actions, entities = constraints(policy)
+            self.entries.append(((policy, self.applies_to(policy)), entities))
+            if actions is None:
+                self.any_action.append(i)
+            elif isinstance(actions, ActionPatterns):
+                self.patterns.add(i, actions)
+            else:
+                for action in actions:
+                    self.by_action.setdefault(action, []).append(i)
+        self.action_lists = {}
+        self.candidate_lists = {}
+
+        self.attributes = set()
         for policy in policies:
-            if policy.applies_to(entity, request):
+            policy_attributes = attributes(policy)
+            if policy_attributes is None:
+                self.attributes = None
+                break
+            self.attributes.update(policy_attributes)
+        if self.attributes is not None:
+            self.attributes = tuple(sorted(self.attributes))
+            self.readers = [_attribute_reader(name) for name in self.attributes]
+        self.decisions = {}
+
+    @classmethod
+    def for_settings(cls, values):
+        """
+        Returns the index for the policies in a settings snapshot (see
+        `Config.build`), building it the first time it's asked for and
+        keeping it on the snapshot.
+
+        """
+        index = values.get('policy_index')
+        if index is None or index.policies is not values['policies']:
+            index = values['policy_index'] = cls(values['policies'])
+        return index
+
+    @classmethod
+    def of(cls, policies=None):
+        """
+        Returns `policies` if it's already an index, the index for the current
+        settings if it's None, and otherwise a new index for the list.
+
+        """
+        if isinstance(policies, PolicyIndex):
+            return policies
+        if policies is None:
+            return cls.for_settings(settings.__dict__)
+        return cls(policies)
+
+    @staticmethod
+    def applies_to(policy):
+        "Returns the function the index calls to check whether `policy` applies to a request."
+        applies_to = getattr(getattr(type(policy), 'applies_to', None), 'im_func', None)
+        if isinstance(policy, MatcherPolicy) and applies_to is MatcherPolicy.applies_to.im_func:
+            return compile_matcher(policy.matcher).matches
+        return policy.applies_to
+
+    def for_action(self, action):
+        "Returns the ((policy, applies_to), entities) entries that could apply to `action`, in order."
+        entries = self.action_lists.get(action)
+        if entries is None:
+            positions = set(self.any_action)
+            positions.update(self.by_action.get(action, ()))
+            if action is not None:
+                positions.update(self.patterns.match(action))
+            entries = [self.entries[i] for i in sorted(positions)]
+            if len(self.action_lists) >= self.MAX_CANDIDATE_LISTS:
+                self.action_lists.clear()
+            self.action_lists[action] = entries
+        return entries
+
+    def candidates(self, action, entity):
+        "Returns the (policy, applies_to) pairs that could apply to `action` and `entity`."
+        key = (action, entity)
+        candidates = self.candidate_lists.get(key)
+        if candidates is None:
+            candidates = [entry for entry, entities in self.for_action(action)
+                          if entities is None or entity in entities]
+            if len(self.candidate_lists) >= self.MAX_CANDIDATE_LISTS:
+                self.candidate_lists.clear()
+            self.candidate_lists[key] = candidates
+        return candidates
+
+    def for_request(self, entity, request):
+        for policy, applies_to in self.candidates(getattr(request, 'aws_action', None), entity):
+            if applies_to(entity, request):
                 return policy
         raise MissingPolicyException
 
+    def grant(self, entity, request):
+        if self.attributes is None:
+            return self.for_request(entity, request).grant(entity, request)
+        key = tuple([read(entity, request) for read in self.readers])
+        decision = self.decisions.get(key)
+        if decision is None:
+            policy = self.for_request(entity, request)
+            decision = policy.grant(entity, request)
+            if cacheable(policy):
+                if len(self.decisions) >= self.MAX_DECISIONS:
+                    self.decisions.clear()
+                self.decisions[key] = decision
+        return decision
+
+
+def _attribute_reader(name):
+    # Returns a function that reads the attribute `name` (see
+    # Policy.attributes) from an entity and request.
+    if name == 'entity':
+        return lambda entity, request: entity
+    if name == 'directory':
+        return lambda entity, request: directory.of(request)
+    if name.startswith('parameters.'):
+        parameter = name[len('parameters.'):]
+        def read(entity, request):
+            view = getattr(request, 'parameter_view', None)
+            return view.lookup(parameter) if view is not None else None
+        return read
+    return lambda entity, request: getattr(request, name, None)
+
 
-class MatcherPolicy(object):
+class MatcherPolicy(Policy):
     def __init__(self, matcher):
         self.matcher = matcher
 
     def applies_to(self, entity, request):
         return self.matcher.matches(entity, request)
 
+    def constraints(self):
+        return constraints(self.matcher)
+
+    def attributes(self):
+        return attributes(self.matcher)
+
 
 class BooleanPolicy(MatcherPolicy):
+    cacheable = True
+
     def __init__(self, allow, matcher):
         self.allow = allow
         super(BooleanPolicy, self).__init__(matcher)
@@ -99,11 +359,100 @@ class DenyPolicy(BooleanPolicy):
         super(DenyPolicy, self).__init__(False, matcher)
 
 
+class Waiters(object):
+    """
+    Requests in this process that are waiting for something to happen to a
+    `model` instance, keyed by request UUID. Each one waits on an Event that
+    is set when it's settled or its timeout runs out (on the shared
+    scheduler), so waiting takes no CPU.
+
+    `settle` sets the Event of a request waiting in this process directly,
+    and publishes the UUID through the model's storage backend so requests
+    waiting in other gateway processes are woken up too. Only backends that
+    can notify subscribers (redis, and locmem, which is per-process anyway)
+    do that; with the others, a background thread polls instead: while
+    anything is waiting, it asks `settled(uuid)` about each waiting request
+    every `interval_setting` seconds, and it exits once nothing is waiting.
+
+    """
+
+    def __init__(self, model, settled, interval_setting):
+        self.model = model
+        self.channel = '__GG_SETTLED__::%s' % (model.__name__,)
+        self.events = {}
+        self.settled = settled
+        self.interval_setting = interval_setting
+        # Whether the backend notifies us, or None until we've asked.
+        self.subscribed = None
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def wait(self, request_uuid, timeout):
+        event = threading.Event()
+        with self.lock:
+            self.events[request_uuid] = event
+            if self.subscribed is None:
+                self.subscribed = self.model.storage_backend.subscribe(self.channel, self.wake)
+            if not self.subscribed:
+                self.start_polling()
+        # It may have been settled before it started waiting (e.g., a
+        # cancellation that beat the request here from the notification).
+        if self.settled(request_uuid):
+            event.set()
+        timer = scheduler.get_scheduler().call_later(timeout, event.set)
+        try:
+            event.wait()
+        finally:
+            timer.cancel()
+            with self.lock:
+                del self.events[request_uuid]
+
+    def settle(self, request_uuid):
+        "Called once `request_uuid` has been settled and saved."
+        self.wake(request_uuid)
+        self.model.storage_backend.publish(self.channel, request_uuid)
+
+    def wake(self, request_uuid):
+        event = self.events.get(request_uuid)
+        if event is not None:
+            event.set()
+
+    def poll(self):
+        for request_uuid, event in self.events.items():
+            if self.settled(request_uuid):
+                event.set()
+
+    def start_polling(self):
+        # Called with the lock held.
+        interval = getattr(settings, self.interval_setting)
+        if self.thread is None and interval:
+            self.thread = threading.Thread(target=self.run, args=(interval,))
+            self.thread.daemon = True
+            self.thread.start()
+
+    def run(self, interval):
+        while True:
+            time.sleep(interval)
+            with self.lock:
+                if not self.events:
+                    self.thread = None
+                    return
+            try:
+                self.poll()
+            except Exception:
+                logger.exception('Unable to poll waiting requests')
+
+
 class TimeLock(models.Model):
     id = models.Field(pk=True)
     cancelled = models.Field(default=False)
 
 
+def _time_lock_cancelled(request_uuid):
+    timelock = TimeLock.get(request_uuid)
+    return timelock is None or timelock.cancelled
+
+
 class TimeLockPolicy(MatcherPolicy):
     """
     A time-lock policy queues requests for execution after some time has
@@ -112,10 +461,28 @@ class TimeLockPolicy(MatcherPolicy):
     may decide to cancel the request at any period during the time-lock. If the
     request is not cancelled, it will be granted after the lock expires.
 
+    While a request waits for its lock to expire it's parked on the shared
+    scheduler rather than sleeping, and cancelling it wakes it up right away.
+    Cancellations made through other gateway processes wake it up too, if the
+    storage backend can publish them, or are picked up every
+    `time_lock_poll_interval` seconds if it can't.
+
+    Nobody can cancel a request they weren't told about, so a request whose
+    notification fails to be delivered is cancelled, and one whose
+    notification still hasn't been delivered when the lock expires is denied.
+
+    If `defer` is True the client doesn't wait at all: it gets a 202 with the
+    request's UUID, the request is queued and sent once the lock expires
+    (unless it's cancelled first, or the notification hasn't been delivered
+    by then), and the response can be fetched from /~/result/<uuid>.
+
     """
+    cacheable = False
+    waiters = Waiters(TimeLock, _time_lock_cancelled, 'time_lock_poll_interval')
 
-    def __init__(self, matcher, lock_duration, notification_broker, notification_template, notification_recipients):
+    def __init__(self, matcher, lock_duration, notification_broker, notification_template, notification_recipients, defer=False):
         self.lock_duration = lock_duration
+        self.defer = defer
         self.notification_broker = notification_broker
         self.notification_template = notification_template
         self.notification_recipients = notification_recipients
@@ -129,6 +496,17 @@ class TimeLockPolicy(MatcherPolicy):
             raise Exception("Couldn't find request with uuid '%s'" % (request_uuid,))
         request.cancelled = True
         request.save()
+        deferred.cancel(request_uuid)
+        cls.waiters.settle(request_uuid)
+
+    @classmethod
+    def notified(cls, request_uuid, delivery, execute_at=None):
+        "Called once the request's notification has been delivered (or hasn't)."
+        if not delivery.delivered:
+            logger.error("Notification for request %s wasn't delivered, cancelling it", request_uuid)
+            cls.cancel(request_uuid)
+        elif execute_at is not None:
+            deferred.release(request_uuid, execute_at)
 
     def grant(self, entity, request):
         # Generate UUID, add to list of pending requests, send email with
@@ -136,21 +514,175 @@ class TimeLockPolicy(MatcherPolicy):
         request_uuid = uuid.uuid4().get_hex()
         timelock = TimeLock(id=request_uuid, cancelled=False)
         timelock.save()
+        execute_at = time.time() + self.lock_duration
         message = render_template(self.notification_template, {
             'request_information': AuditTrail.sanitize(json.dumps(request.to_dict(), indent=4)),
-            'request_execution_time': time.strftime('%a, %d %b %Y %H:%M:%S +0000', time.gmtime(time.time() + self.lock_duration)),
+            'request_execution_time': time.strftime('%a, %d %b %Y %H:%M:%S +0000', time.gmtime(execute_at)),
             'time_lock_duration': str(self.lock_duration/60.0),
             'request_uuid': request_uuid,
         })
-        self.notification_broker.send(Notification(self.notification_recipients, message))
-        time.sleep(self.lock_duration)
-        return not TimeLock.get(request_uuid).cancelled
+        delivery = delivery_of(self.notification_broker.send(Notification(self.notification_recipients, message, execute_at)))
+
+        if self.defer:
+            # Held until the notification has been delivered, and dropped if
+            # that hasn't happened by the time the lock expires.
+            deferred.defer(request_uuid, entity, request, None, execute_at)
+            delivery.then(lambda delivery: self.notified(request_uuid, delivery, execute_at))
+            raise deferred.DeferredException(entity, request_uuid)
+
+        delivery.then(lambda delivery: self.notified(request_uuid, delivery))
+        self.waiters.wait(request_uuid, self.lock_duration)
+        timelock = TimeLock.get(request_uuid)
+        return timelock is not None and not timelock.cancelled and delivery.delivered is True
+
+
+class Approval(models.Model):
+    id = models.Field(pk=True)
+    entity = models.Field()
+    # The entities allowed to approve the request, or None for anyone who
+    # isn't institutional.
+    approvers = models.Field()
+    approved_by = models.Field()
+    expires_at = models.Field()
+
+
+def _approval_settled(request_uuid):
+    approval = Approval.get(request_uuid)
+    return approval is None or approval.approved_by is not None
+
+
+def is_institutional(entity):
+    "Institutional entities (e.g., a CI server's account) can't approve requests."
+    return directory.get_directory().kind_of(entity) == directory.INSTITUTIONAL
+
+
+class ApprovalException(Exception):
+    pass
+
+
+class TwoPersonPolicy(MatcherPolicy):
+    """
+    A two-person integrity policy only grants a request once a second entity
+    has approved it through /~/approve/<uuid>. The approver can't be the
+    entity that made the request or an institutional entity, and if
+    `approvers` is given it has to be one of them. Requests that aren't
+    approved within `timeout` seconds are denied.
+
+    Waiting requests are woken up as soon as an approval comes in (for
+    approvals made through another gateway process, that needs a storage
+    backend that can publish them; otherwise it's within
+    `approval_poll_interval` seconds). With defer=True the client gets a 202
+    straight away and the request is sent when it's approved, like a deferred
+    `TimeLockPolicy`.
+
+    """
+    cacheable = False
+    waiters = Waiters(Approval, _approval_settled, 'approval_poll_interval')
+
+    def __init__(self, matcher, timeout, notification_broker, notification_template, notification_recipients, approvers=None, defer=False):
+        self.timeout = timeout
+        self.approvers = approvers
+        self.defer = defer
+        self.notification_broker = notification_broker
+        self.notification_template = notification_template
+        self.notification_recipients = notification_recipients
+        super(TwoPersonPolicy, self).__init__(matcher)
+
+    @classmethod
+    def approve(cls, request_uuid, approver):
+        """
+        Approves a request on behalf of `approver`. Raises KeyError if there's
+        no such request and ApprovalException if `approver` can't approve it.
+
+        """
+        approval = Approval.get(request_uuid)
+        if approval is None:
+            raise KeyError(request_uuid)
+        if approval.approved_by is not None:
+            raise ApprovalException('Request has already been approved')
+        if approval.expires_at < time.time():
+            deferred.cancel(request_uuid)
+            raise ApprovalException('Request has expired')
+        if approver == approval.entity or is_institutional(approver) or (
+                approval.approvers is not None and approver not in approval.approvers):
+            raise ApprovalException('%s may not approve this request' % (approver,))
+        approval.approved_by = approver
+        approval.save()
+        deferred.release(request_uuid)
+        cls.waiters.settle(request_uuid)
+
+    def grant(self, entity, request):
+        request_uuid = uuid.uuid4().get_hex()
+        expires_at = time.time() + self.timeout
+        Approval(id=request_uuid, entity=entity, approvers=self.approvers, approved_by=None, expires_at=expires_at).save()
+        message = render_template(self.notification_template, {
+            'request_information': AuditTrail.sanitize(json.dumps(request.to_dict(), indent=4)),
+            'request_entity': str(entity),
+            'approval_timeout': str(self.timeout/60.0),
+            'request_uuid': request_uuid,
+        })
+        self.notification_broker.send(Notification(self.notification_recipients, message, expires_at))
+
+        if self.defer:
+            # Not scheduled until it's approved, and dropped if it isn't
+            # approved in time.
+            deferred.defer(request_uuid, entity, request, None, expires_at)
+            raise deferred.DeferredException(entity, request_uuid)
+
+        self.waiters.wait(request_uuid, self.timeout)
+        approval = Approval.get(request_uuid)
+        return approval is not None and approval.approved_by is not None
 
 
 class Matcher(object):
+    # Roughly how expensive `matches` is compared to a set lookup. Used to
+    # decide which of a compiled matcher's children to check first.
+    cost = 1
+
     def matches(self, entity, request):
         raise NotImplementedError()
 
+    def attributes(self):
+        """
+        Returns the names of the attributes this matcher reads (see
+        `Policy.attributes`), or None if they aren't known.
+
+        """
+        return None
+
+    def constraints(self):
+        """
+        Returns a tuple of (actions, entities) where actions and entities are
+        frozensets of the only values this matcher can match, or None if it
+        can match any value.
+
+        """
+        return None, None
+
+
+def _intersect(a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return a & b
+
+
+def _union(a, b):
+    if a is None or b is None:
+        return None
+    return a | b
+
+
+def _attributes(matchers):
+    found = set()
+    for matcher in matchers:
+        matcher_attributes = attributes(matcher)
+        if matcher_attributes is None:
+            return None
+        found.update(matcher_attributes)
+    return tuple(found)
+
 
 class AllMatcher(Matcher):
     def __init__(self, matchers):
@@ -162,6 +694,21 @@ class AllMatcher(Matcher):
                 return False
         return True
 
+    def constraints(self):
+        actions = entities = None
+        for matcher in self.matchers:
+            matcher_actions, matcher_entities = constraints(matcher)
+            actions = _intersect(actions, matcher_actions)
+            entities = _intersect(entities, matcher_entities)
+        return actions, entities
+
+    def attributes(self):
+        return _attributes(self.matchers)
+
+    @property
+    def cost(self):
+        return sum(getattr(matcher, 'cost', 1) for matcher in self.matchers)
+
 
 class AnyMatcher(Matcher):
     def __init__(self, matchers):
@@ -173,6 +720,20 @@ class AnyMatcher(Matcher):
                 return True
         return False
 
+    def constraints(self):
+        if not self.matchers:
+            return frozenset(), frozenset()
+        found = [constraints(matcher) for matcher in self.matchers]
+        return (reduce(_union, [actions for actions, _ in found]),
+                reduce(_union, [entities for _, entities in found]))
+
+    def attributes(self):
+        return _attributes(self.matchers)
+
+    @property
+    def cost(self):
+        return sum(getattr(matcher, 'cost', 1) for matcher in self.matchers)
+
 
 class NotMatcher(Matcher):
     def __init__(self, matcher):
@@ -181,6 +742,13 @@ class NotMatcher(Matcher):
     def matches(self, entity, request):
         return not self.matcher.matches(entity, request)
 
+    def attributes(self):
+        return attributes(self.matcher)
+
+    @property
+    def cost(self):
+        return getattr(self.matcher, 'cost', 1)
+
 
 class EntityMatcher(Matcher):
     def __init__(self, entities):
@@ -189,19 +757,523 @@ class EntityMatcher(Matcher):
     def matches(self, entity, request):
         return entity in self.entities
 
+    def constraints(self):
+        # Anything other than a plain collection of entities (a string, say)
+        # might not behave like a set, so it isn't indexed.
+        if isinstance(self.entities, (list, tuple, set, frozenset)):
+            return None, frozenset(self.entities)
+        return None, None
+
+    def attributes(self):
+        return ('entity',)
+
+
+class GroupMatcher(Matcher):
+    """
+    Matches entities in any of `groups` (see `directory`). Membership is
+    checked against the directory the request is authorized against (see
+    `directory.of`), so it follows changes to the groups.
+
+    """
+
+    def __init__(self, groups):
+        if isinstance(groups, basestring):
+            groups = [groups]
+        self.groups = frozenset(groups)
+
+    def matches(self, entity, request):
+        return not self.groups.isdisjoint(directory.of(request).groups_of(entity))
+
+    def attributes(self):
+        return ('entity', 'directory')
+
+
+class KindMatcher(Matcher):
+    "Matches entities of any of `kinds` (see `directory`)."
+
+    def __init__(self, kinds):
+        if isinstance(kinds, basestring):
+            kinds = [kinds]
+        self.kinds = frozenset(kinds)
+
+    def matches(self, entity, request):
+        return directory.of(request).kind_of(entity) in self.kinds
+
+    def attributes(self):
+        return ('entity', 'directory')
+
 
 class AWSActionMatcher(Matcher):
     def __init__(self, action):
+        # A single action, or a collection of them.
         self.action = action
+        if isinstance(action, basestring):
+            self.actions = frozenset([action])
+        else:
+            self.actions = frozenset(action)
 
     def matches(self, entity, request):
         action = getattr(request, 'aws_action', None)
         if action is None:
             return False
         else:
-            return action == self.action
+            return action in self.actions
+
+    def constraints(self):
+        return self.actions, None
+
+    def attributes(self):
+        return ('aws_action',)
+
+
+def _glob_expression(pattern):
+    # '*' matches any run of characters and '?' any one character; nothing
+    # else is special.
+    return ''.join('.*' if c == '*' else '.' if c == '?' else re.escape(c) for c in pattern)
+
+
+class ActionPatterns(object):
+    """
+    The actions constraint of a matcher that matches actions by pattern:
+    `actions` is a collection of exact actions, `globs` of glob patterns
+    and `regexes` of regular expressions (which have to match the whole
+    action).
+
+    Intersecting patterns with a set of exact actions gives the actions in
+    the set that match. Intersecting two sets of patterns isn't worked out;
+    the result is just one of them, which is still a safe upper bound on
+    what can match.
+
+    """
+
+    def __init__(self, actions=(), globs=(), regexes=()):
+        self.actions = frozenset(actions)
+        self.globs = tuple(globs)
+        self.regexes = tuple(regexes)
+        self.compiled = [re.compile(r'(?:%s)\Z' % (expression,)) for expression in
+                         [_glob_expression(glob) for glob in self.globs] + list(self.regexes)]
+
+    def matches(self, action):
+        return action in self.actions or any(regex.match(action) for regex in self.compiled)
+
+    def __and__(self, other):
+        if isinstance(other, ActionPatterns):
+            return self
+        return frozenset(action for action in other if self.matches(action))
+
+    __rand__ = __and__
+
+    def __or__(self, other):
+        if isinstance(other, ActionPatterns):
+            return ActionPatterns(self.actions | other.actions, self.globs + other.globs, self.regexes + other.regexes)
+        return ActionPatterns(self.actions | other, self.globs, self.regexes)
+
+    __ror__ = __or__
+
+    def __eq__(self, other):
+        return (isinstance(other, ActionPatterns) and self.actions == other.actions and
+                self.globs == other.globs and self.regexes == other.regexes)
+
+    def __ne__(self, other):
+        return not self == other
+
+
+class _TrieNode(object):
+    __slots__ = ('children', 'any_char', 'star', 'loops', 'rules')
+
+    def __init__(self, loops=False):
+        self.children = {}
+        # Transition on '?'.
+        self.any_char = None
+        # Transition (without reading a character) to the node for a '*'.
+        self.star = None
+        # A '*' node, which stays put on any character.
+        self.loops = loops
+        self.rules = []
+
+
+class ActionAutomaton(object):
+    """
+    Finds every rule with an `ActionPatterns` that matches an action. Glob
+    patterns share a trie that's walked as a nondeterministic automaton, so
+    all of them are checked in a single pass over the action whatever their
+    number. Exact actions are looked up in a dict, and regular expressions
+    (which can't be merged into the trie) are tried one by one.
+
+    """
+
+    def __init__(self):
+        self.root = _TrieNode()
+        self.exact = {}
+        self.regexes = []
+
+    def add(self, rule, patterns):
+        for action in patterns.actions:
+            self.exact.setdefault(action, set()).add(rule)
+        for glob in patterns.globs:
+            node = self.root
+            for c in glob:
+                if c == '*':
+                    if node.star is None:
+                        node.star = _TrieNode(loops=True)
+                    node = node.star
+                elif c == '?':
+                    if node.any_char is None:
+                        node.any_char = _TrieNode()
+                    node = node.any_char
+                else:
+                    node = node.children.setdefault(c, _TrieNode())
+            node.rules.append(rule)
+        for regex in patterns.regexes:
+            self.regexes.append((re.compile(r'(?:%s)\Z' % (regex,)), rule))
+
+    @staticmethod
+    def _closure(nodes):
+        stack = list(nodes)
+        while stack:
+            star = stack.pop().star
+            if star is not None and star not in nodes:
+                nodes.add(star)
+                stack.append(star)
+        return nodes
+
+    def match(self, action):
+        "Returns the set of rules with a pattern that matches `action`."
+        rules = set(self.exact.get(action, ()))
+        nodes = self._closure(set([self.root]))
+        for c in action:
+            following = set()
+            for node in nodes:
+                child = node.children.get(c)
+                if child is not None:
+                    following.add(child)
+                if node.any_char is not None:
+                    following.add(node.any_char)
+                if node.loops:
+                    following.add(node)
+            if not following:
+                break
+            nodes = self._closure(following)
+        else:
+            for node in nodes:
+                rules.update(node.rules)
+        for regex, rule in self.regexes:
+            if rule not in rules and regex.match(action):
+                rules.add(rule)
+        return rules
+
+
+class AWSActionPatternMatcher(Matcher):
+    "Base class for matchers that match the AWS action against a pattern."
+    cost = 2
+
+    def __init__(self, pattern):
+        self.pattern = pattern
+        self.regex = re.compile(r'(?:%s)\Z' % (self.expression(),))
+
+    def expression(self):
+        raise NotImplementedError()
+
+    def matches(self, entity, request):
+        action = getattr(request, 'aws_action', None)
+        return action is not None and self.regex.match(action) is not None
+
+    def attributes(self):
+        return ('aws_action',)
+
+
+class AWSActionGlobMatcher(AWSActionPatternMatcher):
+    "Matches actions like 'Describe*' ('*' matches anything, '?' any one character)."
+
+    def expression(self):
+        return _glob_expression(self.pattern)
+
+    def constraints(self):
+        return ActionPatterns(globs=[self.pattern]), None
+
+
+class AWSActionRegexMatcher(AWSActionPatternMatcher):
+    "Matches actions against a regular expression, which has to match the whole action."
+    cost = 3
+
+    def expression(self):
+        return self.pattern
+
+    def constraints(self):
+        return ActionPatterns(regexes=[self.pattern]), None
+
+
+class ParameterMatcherBase(Matcher):
+    """
+    Base class for matchers that look at a request parameter through the
+    request's `parameter_view`. Requests without one never match. A name like
+    'InstanceId.N' refers to all the InstanceId.1, InstanceId.2, ...
+    parameters (see `http.ParameterView`).
+
+    An indexed parameter has to have at least one value, and by default
+    (quantifier='all') every value has to match, which is what an allow rule
+    wants. Deny rules should use quantifier='any' so that a request matches
+    if any one of its values does: otherwise adding a single value that
+    doesn't match gets a request past the rule.
+
+    """
+    cost = 2
+    quantifiers = {'all': all, 'any': any}
+
+    def __init__(self, name, quantifier='all'):
+        if quantifier not in self.quantifiers:
+            raise ValueError('Unknown quantifier: %s' % (quantifier,))
+        self.name = name
+        self.quantifier = quantifier
+
+    def matches(self, entity, request):
+        view = getattr(request, 'parameter_view', None)
+        if view is None:
+            return False
+        return self.matches_value(view.lookup(self.name))
+
+    def matches_value(self, value):
+        raise NotImplementedError()
+
+    def each(self, value, test):
+        "Applies `test` to a value, or to the values of an indexed parameter."
+        if isinstance(value, tuple):
+            return bool(value) and self.quantifiers[self.quantifier](test(v) for v in value)
+        return test(value)
+
+    def attributes(self):
+        return ('parameters.' + self.name,)
+
+
+class ParameterMatcher(ParameterMatcherBase):
+    """
+    Matches requests where the parameter is one of `values`, or, if `values`
+    is None, where it's present at all.
+
+    """
+
+    def __init__(self, name, values=None, quantifier='all'):
+        if isinstance(values, basestring):
+            values = [values]
+        self.values = frozenset(values) if values is not None else None
+        super(ParameterMatcher, self).__init__(name, quantifier)
+
+    def matches_value(self, value):
+        if not value:
+            return False
+        if self.values is None:
+            return True
+        return self.each(value, self.values.__contains__)
+
+
+class ParameterGlobMatcher(ParameterMatcherBase):
+    "Matches requests where the parameter matches a glob pattern like 'ami-*'."
+
+    def __init__(self, name, pattern, quantifier='all'):
+        self.pattern = pattern
+        self.regex = re.compile(r'(?:%s)\Z' % (_glob_expression(pattern),))
+        super(ParameterGlobMatcher, self).__init__(name, quantifier)
+
+    def matches_value(self, value):
+        if not value:
+            return False
+        return self.each(value, lambda v: self.regex.match(v) is not None)
+
+
+class ParameterRangeMatcher(ParameterMatcherBase):
+    """
+    Matches requests where the parameter is an integer between `minimum` and
+    `maximum` (inclusive; either can be None).
+
+    """
+
+    def __init__(self, name, minimum=None, maximum=None, quantifier='all'):
+        self.minimum = minimum
+        self.maximum = maximum
+        super(ParameterRangeMatcher, self).__init__(name, quantifier)
+
+    def in_range(self, n):
+        return (self.minimum is None or n >= self.minimum) and (self.maximum is None or n <= self.maximum)
+
+    def matches_value(self, value):
+        return self.each(value, self.value_in_range)
+
+    def value_in_range(self, value):
+        try:
+            n = int(value)
+        except (TypeError, ValueError):
+            return False
+        return self.in_range(n)
+
+
+class ParameterCountMatcher(ParameterRangeMatcher):
+    """
+    Matches requests with between `minimum` and `maximum` values for an
+    indexed parameter, e.g. ParameterCountMatcher('InstanceId.N', maximum=5).
+
+    """
+
+    def matches_value(self, value):
+        return self.in_range(len(value or ()))
 
 
 class AlwaysMatcher(Matcher):
     def matches(self, entity, request):
         return True
+
+    def attributes(self):
+        return ()
+
+
+class NeverMatcher(Matcher):
+    def matches(self, entity, request):
+        return False
+
+    def constraints(self):
+        return frozenset(), frozenset()
+
+    def attributes(self):
+        return ()
+
+
+class _Child(object):
+    __slots__ = ('matcher', 'cost', 'evaluations', 'decisive')
+
+    def __init__(self, matcher):
+        self.matcher = matcher
+        self.cost = getattr(matcher, 'cost', 1)
+        self.evaluations = 0
+        self.decisive = 0
+
+    def score(self):
+        # Expected cost of finding the decisive child, if this one is checked
+        # first: its cost over the (smoothed) chance that it's decisive.
+        return self.cost * (self.evaluations + 2.0) / (self.decisive + 1.0)
+
+
+class _AdaptiveMatcher(object):
+    """
+    Checks its children in order of how cheaply they tend to settle the
+    result: for an AllMatcher the child that most often fails for the least
+    cost goes first, and for an AnyMatcher the one that most often succeeds.
+    The children are reordered every REORDER_INTERVAL evaluations from
+    counters kept as it goes. The counters aren't locked, so a few counts may
+    be lost to races, which only makes the ordering a little less exact.
+
+    """
+
+    REORDER_INTERVAL = 1000
+    # The result that stops evaluation (False for All, True for Any).
+    decisive_result = None
+
+    def __init__(self, matchers):
+        self.children = [_Child(matcher) for matcher in matchers]
+        self.matchers = list(matchers)
+        self.evaluations = 0
+
+    def matches(self, entity, request):
+        self.evaluations += 1
+        if self.evaluations % self.REORDER_INTERVAL == 0:
+            self.reorder()
+        decisive = self.decisive_result
+        for child in self.children:
+            child.evaluations += 1
+            if bool(child.matcher.matches(entity, request)) is decisive:
+                child.decisive += 1
+                return decisive
+        return not decisive
+
+    def reorder(self):
+        children = sorted(self.children, key=_Child.score)
+        # Swapped in whole, so concurrent evaluations see one order or the other.
+        self.children = children
+        self.matchers = [child.matcher for child in children]
+
+
+class AdaptiveAllMatcher(_AdaptiveMatcher, AllMatcher):
+    decisive_result = False
+
+
+class AdaptiveAnyMatcher(_AdaptiveMatcher, AnyMatcher):
+    decisive_result = True
+
+
+# The policies and matchers whose declarations (see `_declares`) are known to
+# be right.
+_STOCK = frozenset([
+    MatcherPolicy, BooleanPolicy, AllowPolicy, DenyPolicy, TimeLockPolicy, TwoPersonPolicy,
+    AllMatcher, AnyMatcher, NotMatcher, EntityMatcher, GroupMatcher, KindMatcher,
+    AWSActionMatcher, AWSActionGlobMatcher, AWSActionRegexMatcher, ParameterMatcher,
+    ParameterGlobMatcher, ParameterRangeMatcher, ParameterCountMatcher, AlwaysMatcher,
+    NeverMatcher, AdaptiveAllMatcher, AdaptiveAnyMatcher,
+])
+
+
+def _is(matcher, *classes):
+    # Only the stock matchers are rewritten: a subclass may override
+    # `matches`, and rewriting it would drop the override.
+    return type(matcher) in classes
+
+
+def _indexable_entities(matcher):
+    return _is(matcher, EntityMatcher) and constraints(matcher)[1] is not None
+
+
+def _merge(children, combine):
+    # Replaces the entity and action matchers among `children` with (at most)
+    # one of each whose values are combined with `combine`.
+    entities = [matcher for matcher in children if _indexable_entities(matcher)]
+    actions = [matcher for matcher in children if _is(matcher, AWSActionMatcher)]
+    merged = [matcher for matcher in children if matcher not in entities and matcher not in actions]
+    if entities:
+        entities = [EntityMatcher(reduce(combine, [constraints(matcher)[1] for matcher in entities]))]
+    if actions:
+        actions = [AWSActionMatcher(reduce(combine, [matcher.actions for matcher in actions]))]
+    return entities + actions + merged
+
+
+def compile_matcher(matcher):
+    """
+    Returns a matcher that matches the same requests as `matcher`, but is
+    quicker to evaluate: nested All and Any matchers are flattened, matchers
+    that can't make a difference are dropped, entity and action matchers
+    under the same All or Any are merged into a single set lookup, double
+    negations cancel out, and what's left of each All and Any is evaluated
+    adaptively (see `_AdaptiveMatcher`).
+
+    Matchers it doesn't know about, including subclasses of the ones it
+    does, are left as they are.
+
+    """
+    if _is(matcher, NotMatcher):
+        inner = compile_matcher(matcher.matcher)
+        if _is(inner, NotMatcher):
+            return inner.matcher
+        if _is(inner, AlwaysMatcher):
+            return NeverMatcher()
+        if _is(inner, NeverMatcher):
+            return AlwaysMatcher()
+        return NotMatcher(inner)
+
+    if _is(matcher, AllMatcher):
+        kinds, identity, absorbing, combine, adaptive = (AllMatcher, AdaptiveAllMatcher), AlwaysMatcher, NeverMatcher, frozenset.__and__, AdaptiveAllMatcher
+    elif _is(matcher, AnyMatcher):
+        kinds, identity, absorbing, combine, adaptive = (AnyMatcher, AdaptiveAnyMatcher), NeverMatcher, AlwaysMatcher, frozenset.__or__, AdaptiveAnyMatcher
+    else:
+        return matcher
+
+    children = []
+    for child in matcher.matchers:
+        child = compile_matcher(child)
+        if _is(child, *kinds):
+            children.extend(child.matchers)
+        elif _is(child, absorbing):
+            return absorbing()
+        elif not _is(child, identity):
+            children.append(child)
+    children = _merge(children, combine)
+    if not children:
+        return identity()
+    if len(children) == 1:
+        return children[0]
+    return adaptive(children)
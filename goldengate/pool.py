@@ -0,0 +1,323 @@
+"""
+A thread-safe pool of keep-alive HTTP connections to the upstream service.
+
+Connections are pooled per (scheme, host) with an upper bound on how many may
+be open to any one host at a time. Idle connections are reused until they've
+been idle for longer than `idle_timeout`, DNS lookups are cached for `dns_ttl`
+seconds, and connections can be opened ahead of time with `prewarm` so the
+first requests after startup don't pay for the TCP/TLS handshake.
+
+Waiting for a connection to a host gives up with `PoolTimeout` after
+`acquire_timeout` seconds, so a slow upstream can't hold on to every worker.
+
+"""
+
+from __future__ import with_statement
+import errno
+import httplib
+import logging
+import socket
+import threading
+import time
+import urlparse
+
+
+logger = logging.getLogger(__name__)
+
+
+class Resolver(object):
+    """
+    Caches the results of `getaddrinfo` so that opening a new upstream
+    connection doesn't have to wait on a DNS lookup.
+
+    """
+
+    def __init__(self, ttl=60):
+        self.ttl = ttl
+        self.cache = {}
+
+    def resolve(self, host, port):
+        now = time.time()
+        entry = self.cache.get((host, port))
+        if entry is not None and entry[0] > now:
+            return entry[1]
+        addresses = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+        self.cache[(host, port)] = (now + self.ttl, addresses)
+        return addresses
+
+
+def create_connection(addresses, timeout=socket._GLOBAL_DEFAULT_TIMEOUT, source_address=None):
+    "Like `socket.create_connection`, but for already resolved addresses."
+    error = None
+    for family, socktype, proto, _, address in addresses:
+        sock = None
+        try:
+            sock = socket.socket(family, socktype, proto)
+            if timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+                sock.settimeout(timeout)
+            if source_address:
+                sock.bind(source_address)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.connect(address)
+            return sock
+        except socket.error, e:
+            error = e
+            if sock is not None:
+                sock.close()
+    if error is not None:
+        raise error
+    raise socket.error('getaddrinfo returns an empty list')
+
+
+class HTTPConnection(httplib.HTTPConnection):
+    def __init__(self, host, resolver, **kwargs):
+        httplib.HTTPConnection.__init__(self, host, **kwargs)
+        self.resolver = resolver
+        self._create_connection = self._create_resolved_connection
+
+    def _create_resolved_connection(self, address, timeout, source_address=None):
+        return create_connection(self.resolver.resolve(*address), timeout, source_address)
+
+
+class HTTPSConnection(httplib.HTTPSConnection):
+    def __init__(self, host, resolver, **kwargs):
+        httplib.HTTPSConnection.__init__(self, host, **kwargs)
+        self.resolver = resolver
+        self._create_connection = self._create_resolved_connection
+
+    def _create_resolved_connection(self, address, timeout, source_address=None):
+        return create_connection(self.resolver.resolve(*address), timeout, source_address)
+
+
+class PoolTimeout(Exception):
+    "Raised when no connection to a host is released within `acquire_timeout`."
+
+
+class Slots(object):
+    """
+    A counting semaphore whose `acquire` can give up after `timeout` seconds,
+    which threading's can't do before Python 3.
+
+    """
+
+    def __init__(self, count):
+        self.count = count
+        self.condition = threading.Condition(threading.Lock())
+
+    def acquire(self, timeout=None):
+        with self.condition:
+            if timeout is not None:
+                deadline = time.time() + timeout
+            while not self.count:
+                if timeout is None:
+                    self.condition.wait()
+                    continue
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+            self.count -= 1
+            return True
+
+    def release(self):
+        with self.condition:
+            self.count += 1
+            self.condition.notify()
+
+
+class PooledResponse(object):
+    """
+    An upstream response that hands its connection back to the pool once the
+    body has been read to the end (or discards it if the response is closed
+    early, since the unread body would otherwise be left on the wire).
+
+    """
+
+    def __init__(self, pool, key, connection, response):
+        self.pool = pool
+        self.key = key
+        self.connection = connection
+        self.response = response
+        self.status = response.status
+        self.headers = response.getheaders()
+
+    def read(self, amt=None):
+        return self.response.read(amt)
+
+    def close(self):
+        if self.connection is None:
+            return
+        connection, self.connection = self.connection, None
+        reusable = self.response.fp is None and not self.response.will_close
+        self.response.close()
+        self.pool.release(self.key, connection, reusable)
+
+
+class ConnectionPool(object):
+    """
+    Thread-safe pool of keep-alive connections. At most `max_connections`
+    connections will be checked out for any one host; additional requests
+    block until a connection is released, or raise `PoolTimeout` if that
+    takes more than `acquire_timeout` seconds.
+
+    """
+
+    connection_classes = {
+        'http': HTTPConnection,
+        'https': HTTPSConnection,
+    }
+
+    def __init__(self, max_connections=10, idle_timeout=60, timeout=None, resolver=None, acquire_timeout=None):
+        self.max_connections = max_connections
+        self.acquire_timeout = acquire_timeout
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.resolver = resolver if resolver is not None else Resolver()
+        self.lock = threading.Lock()
+        self.idle = {}
+        self.slots = {}
+
+    def _slots(self, key):
+        with self.lock:
+            slots = self.slots.get(key)
+            if slots is None:
+                slots = self.slots[key] = Slots(self.max_connections)
+            return slots
+
+    def connect(self, scheme, host):
+        try:
+            klass = self.connection_classes[scheme]
+        except KeyError:
+            raise ValueError('Unsupported scheme: %s' % (scheme,))
+        kwargs = {}
+        if self.timeout is not None:
+            kwargs['timeout'] = self.timeout
+        connection = klass(host, self.resolver, **kwargs)
+        connection.connect()
+        return connection
+
+    def acquire(self, scheme, host):
+        """
+        Returns a tuple of (connection, reused) for the given host, where
+        reused is True if the connection came out of the idle pool.
+
+        """
+        key = (scheme, host)
+        if not self._slots(key).acquire(self.acquire_timeout):
+            raise PoolTimeout('No connection to %s available within %s seconds' % (host, self.acquire_timeout))
+        try:
+            connection = self._pop_idle(key)
+            if connection is not None:
+                return connection, True
+            return self.connect(scheme, host), False
+        except:
+            self._slots(key).release()
+            raise
+
+    def _pop_idle(self, key):
+        expired = []
+        connection = None
+        with self.lock:
+            idle = self.idle.get(key, [])
+            cutoff = time.time() - self.idle_timeout
+            # The list is ordered oldest first, so everything in front of the
+            # first live connection has been idle for too long.
+            while idle and idle[0][1] < cutoff:
+                expired.append(idle.pop(0)[0])
+            if idle:
+                connection = idle.pop()[0]
+        for stale in expired:
+            stale.close()
+        return connection
+
+    def release(self, key, connection, reusable=True):
+        try:
+            if reusable and connection.sock is not None:
+                with self.lock:
+                    self.idle.setdefault(key, []).append((connection, time.time()))
+            else:
+                connection.close()
+        finally:
+            self._slots(key).release()
+
+    def prewarm(self, origin, count):
+        "Open `count` connections to `origin` (e.g., https://ec2.amazonaws.com) and park them."
+        parsed = urlparse.urlsplit(origin)
+        key = (parsed.scheme, parsed.netloc)
+        connections = []
+        try:
+            for _ in xrange(min(count, self.max_connections)):
+                connections.append(self.acquire(*key)[0])
+        except (socket.error, httplib.HTTPException, PoolTimeout):
+            logger.exception('Unable to prewarm connections to %s', origin)
+        for connection in connections:
+            self.release(key, connection)
+
+    def urlopen(self, method, url, body=None, headers=None, idempotent=False):
+        """
+        Make a request and return a `PooledResponse` whose body has not been
+        read yet. The caller must read it to the end or close it.
+
+        If a reused connection turns out to have been closed by the server,
+        the request is retried once on a fresh connection, but only if it
+        failed while being sent or it's `idempotent`: once it's been sent,
+        the server may have acted on it.
+
+        """
+        parsed = urlparse.urlsplit(url)
+        key = (parsed.scheme, parsed.netloc)
+        path = parsed.path or '/'
+        if parsed.query:
+            path += '?' + parsed.query
+        headers = headers if headers is not None else {}
+
+        retried = False
+        while True:
+            connection, reused = self.acquire(*key)
+            sent = False
+            try:
+                connection.request(method, path, body, headers)
+                sent = True
+                response = connection.getresponse()
+            except (socket.error, httplib.HTTPException), e:
+                self.release(key, connection, False)
+                # The server may have closed a keep-alive connection while it
+                # was sitting in the pool. That's only worth retrying (once,
+                # on a fresh connection) if this was a reused connection, and
+                # only safe if the request never got out or can be repeated.
+                stale = isinstance(e, httplib.BadStatusLine) or getattr(e, 'errno', None) in (errno.ECONNRESET, errno.EPIPE)
+                if stale and reused and not retried and (idempotent or not sent):
+                    self._discard_idle(key)
+                    retried = True
+                    continue
+                raise
+            except:
+                self.release(key, connection, False)
+                raise
+            return PooledResponse(self, key, connection, response)
+
+    def _discard_idle(self, key):
+        with self.lock:
+            idle = self.idle.pop(key, [])
+        for connection, _ in idle:
+            connection.close()
+
+    def close(self):
+        "Close all idle connections."
+        for key in self.idle.keys():
+            self._discard_idle(key)
+
+    def request(self, uri, method='GET', body=None, headers=None, idempotent=False):
+        """
+        Make a request and return a tuple of (headers, content) where headers
+        is a dict that includes the response status, like httplib2 does.
+
+        """
+        response = self.urlopen(method, uri, body, headers, idempotent)
+        try:
+            content = response.read()
+        finally:
+            response.close()
+        headers = dict(response.headers)
+        headers['status'] = str(response.status)
+        return headers, content
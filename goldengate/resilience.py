@@ -0,0 +1,141 @@
+"""
+Building blocks for talking to an upstream that is sometimes slow or down:
+jittered exponential backoff, latency tracking for hedged requests, and a
+circuit breaker that fails fast once a host has stopped responding.
+
+"""
+
+from __future__ import with_statement
+import Queue
+import random
+import sys
+import threading
+import time
+from collections import deque
+
+
+class Backoff(object):
+    "Exponential backoff with full jitter."
+
+    def __init__(self, base=0.1, cap=2.0):
+        self.base = base
+        self.cap = cap
+
+    def delay(self, attempt):
+        return random.uniform(0, min(self.cap, self.base * (2 ** attempt)))
+
+
+class LatencyTracker(object):
+    "Keeps the most recent `size` latency samples for a host."
+
+    def __init__(self, size=100, minimum=20):
+        self.samples = deque(maxlen=size)
+        self.minimum = minimum
+
+    def record(self, latency):
+        self.samples.append(latency)
+
+    def percentile(self, percentile):
+        "Returns the given percentile, or None if there aren't enough samples yet."
+        samples = sorted(self.samples)
+        if len(samples) < self.minimum:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * percentile / 100.0))]
+
+
+class CircuitBreaker(object):
+    """
+    A circuit breaker opens after `threshold` consecutive failures. While
+    it's open requests are refused. After `reset_timeout` seconds a single
+    trial request is let through: if it succeeds the breaker closes again,
+    otherwise it stays open for another `reset_timeout`. A request that never
+    reaches the host counts as neither; `release` lets another one be tried.
+
+    """
+
+    def __init__(self, threshold=5, reset_timeout=30):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+        self.lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if self.trial or time.time() - self.opened_at < self.reset_timeout:
+                return False
+            self.trial = True
+            return True
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial = False
+
+    def release(self):
+        "Hands back the trial request (if this was it) when it never got to the host."
+        with self.lock:
+            self.trial = False
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.trial or self.failures >= self.threshold:
+                self.opened_at = time.time()
+                self.trial = False
+
+
+def hedge(fn, delay, discard):
+    """
+    Calls `fn`, and if it hasn't returned after `delay` seconds calls it
+    again in parallel. Returns whichever result comes back first (preferring
+    results over exceptions) and passes any later result to `discard`.
+
+    """
+    results = Queue.Queue()
+
+    def run():
+        try:
+            results.put((True, fn()))
+        except Exception:
+            results.put((False, sys.exc_info()))
+
+    def drain(pending):
+        for _ in xrange(pending):
+            ok, value = results.get()
+            if ok:
+                discard(value)
+
+    def start():
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+
+    start()
+    pending = 1
+    try:
+        ok, value = results.get(True, delay)
+    except Queue.Empty:
+        start()
+        pending += 1
+        ok, value = results.get()
+    pending -= 1
+    if not ok and pending:
+        ok, value = results.get()
+        pending -= 1
+
+    if pending:
+        thread = threading.Thread(target=drain, args=(pending,))
+        thread.daemon = True
+        thread.start()
+    if ok:
+        return value
+    raise value[0], value[1], value[2]
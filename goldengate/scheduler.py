@@ -0,0 +1,137 @@
+"""
+A timer scheduler shared by everything in the process that needs to do
+something later (e.g., wake up a time-locked request when its lock expires).
+Timers are kept in a heap and run by a single background thread, so waiting
+on many of them doesn't take a thread (or a sleeping worker) each.
+
+"""
+
+from __future__ import with_statement
+import atexit
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+class Timer(object):
+    def __init__(self, scheduler, when, fn):
+        self.scheduler = scheduler
+        self.when = when
+        self.fn = fn
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+        self.scheduler.wake()
+
+
+class Scheduler(object):
+    """
+    Runs callbacks at (or shortly after) the times they were scheduled for.
+    Callbacks run on the scheduler's thread, so they should be quick: set an
+    event, queue some work, that sort of thing.
+
+    """
+
+    def __init__(self):
+        self.heap = []
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+        self.thread = None
+        self.stopped = False
+
+    def __len__(self):
+        return len(self.heap)
+
+    def schedule(self, when, fn):
+        "Calls `fn` at time `when` (in seconds since the epoch). Returns a cancellable `Timer`."
+        timer = Timer(self, when, fn)
+        with self.condition:
+            heapq.heappush(self.heap, (when, next(self.sequence), timer))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run)
+                self.thread.daemon = True
+                self.thread.start()
+            # Wake the scheduler thread in case this is the new earliest timer.
+            self.condition.notify()
+        return timer
+
+    def wake(self):
+        with self.condition:
+            self.condition.notify()
+
+    def stop(self):
+        "Stops the scheduler's thread. Timers that haven't run yet never will."
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+
+    def call_later(self, delay, fn):
+        return self.schedule(time.time() + delay, fn)
+
+    def every(self, interval, fn):
+        "Calls `fn` every `interval` seconds."
+        def run():
+            try:
+                fn()
+            finally:
+                self.call_later(interval, run)
+        self.call_later(interval, run)
+
+    def next_timer(self):
+        # Waits until the earliest timer is due and pops it off the heap.
+        with self.condition:
+            while not self.stopped:
+                if not self.heap:
+                    self.condition.wait()
+                    continue
+                when, _, timer = self.heap[0]
+                if timer.cancelled:
+                    heapq.heappop(self.heap)
+                    continue
+                delay = when - time.time()
+                if delay > 0:
+                    self.condition.wait(delay)
+                    continue
+                heapq.heappop(self.heap)
+                return timer
+        return None
+
+    def run(self):
+        while True:
+            timer = self.next_timer()
+            if timer is None:
+                return
+            try:
+                timer.fn()
+            except Exception:
+                logger.exception('Timer callback failed')
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler():
+    "Returns the process-wide scheduler."
+    global _scheduler
+    if _scheduler is None:
+        with _scheduler_lock:
+            if _scheduler is None:
+                _scheduler = Scheduler()
+    return _scheduler
+
+
+@atexit.register
+def _stop_scheduler():
+    # Stop the thread before the interpreter starts tearing down the modules
+    # it uses, rather than letting it be killed halfway through a wake-up.
+    scheduler = _scheduler
+    if scheduler is not None and scheduler.thread is not None:
+        scheduler.stop()
+        scheduler.thread.join(1)
@@ -25,12 +25,12 @@ setup(
     packages=find_packages(),
     provides=['goldengate'],
     install_requires=[
-        'httplib2',
         'simplejson',
     ],
     entry_points = {
         'console_scripts': [
             'gg-new-credentials = goldengate:generate_credentials',
+            'gg-approve-request = goldengate:approve_request',
         ]
     },
     tests_require = [
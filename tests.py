@@ -2,14 +2,29 @@
 Tests are good.
 """
 
+import os
 import unittest
 import urllib
+import tempfile
 import time
+import calendar
+import hashlib
+import hmac
+import smtplib
+import threading
+import socket
+import errno
+import httplib
+import BaseHTTPServer
+import SocketServer
 try:
     from cStringIO import StringIO
 except ImportError:
     from StringIO import StringIO
-from goldengate import goldengate, http, auth, policy, kvstore, credentials, settings, config
+from goldengate import goldengate, http, auth, policy, kvstore, credentials, kvcredentials, settings, config, pool, cache, resilience, balancer
+
+from goldengate import deferred, notifications, directory, scheduler as goldengate_scheduler
+from goldengate import load_config
 
 from nose.plugins.skip import SkipTest
 
@@ -37,6 +52,8 @@ class MockAuthorizer(object):
     authorized = True
     entity = None
     request = None
+    def __init__(self, policies=None, balancer=None, values=None):
+        self.values = values
     def authorize(self, entity, request):
         self.entity = entity
         self.request = request
@@ -73,6 +90,45 @@ class MockProxy(object):
         return self.response
 
 
+class UpstreamServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    A keep-alive HTTP server on localhost that records the client port of
+    every request it handles so tests can tell whether connections are reused.
+
+    """
+    daemon_threads = True
+    body = 'snarf!'
+
+    class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            self.server.clients.append(self.client_address[1])
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(self.server.body)))
+            self.send_header('X-Favorite-Vegetable', 'asparagus')
+            self.end_headers()
+            self.wfile.write(self.server.body)
+
+        def log_message(self, *args):
+            pass
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), self.RequestHandler)
+        self.clients = []
+        thread = threading.Thread(target=self.serve_forever, args=(0.01,))
+        thread.daemon = True
+        thread.start()
+
+    def handle_error(self, request, client_address):
+        # Clients hanging up on keep-alive connections is expected.
+        pass
+
+    @property
+    def origin(self):
+        return 'http://127.0.0.1:%d' % (self.server_address[1],)
+
+
 class GGTestCase(unittest.TestCase):
     """
     Base test case that defines a couple handy dandy helper assertions and other fun stuff.
@@ -157,12 +213,225 @@ class GoldenGateTests(GGTestCase):
         self.assertRaises(auth.UnauthenticatedException, self.goldengate.handle, self.request)
 
 
+class ReloadTests(GGTestCase):
+    def setUp(self):
+        self.goldengate = goldengate.GoldenGate(authenticator=MockAuthenticator, authorizer=MockAuthorizer, auditor=MockAuditor, proxy=MockProxy)
+        self.goldengate.authenticator.entity = 'lion-o'
+        self.snapshot = settings.__dict__
+        self.reload_entities = settings.reload_entities
+        self.config = os.environ.get('GOLDENGATE_CONFIG')
+        fd, self.filename = tempfile.mkstemp(suffix='.py')
+        os.close(fd)
+        os.environ['GOLDENGATE_CONFIG'] = self.filename
+        self.write(
+            'from goldengate import policy',
+            'REMOTE_HOST = "reloaded.example.com"',
+            'CREDENTIALS = [("lion-o", "key", "secret")]',
+            'POLICIES = [policy.deny()]',
+            'RELOAD_ENTITIES = ["lion-o"]',
+            'DEFERRED_EXECUTOR = False',
+        )
+
+    def tearDown(self):
+        settings.install(self.snapshot)
+        settings.set('reload_entities', self.reload_entities)
+        directory.reload()
+        balancer.install(balancer.for_settings(settings.__dict__))
+        if self.config is None:
+            del os.environ['GOLDENGATE_CONFIG']
+        else:
+            os.environ['GOLDENGATE_CONFIG'] = self.config
+        os.remove(self.filename)
+        if self.goldengate.executor is not None:
+            self.goldengate.executor.stop()
+
+    def write(self, *lines):
+        f = open(self.filename, 'w')
+        f.write('\n'.join(lines) + '\n')
+        f.close()
+
+    def reload(self):
+        url = http.URL('http', 'example.com', '/~/reload', {})
+        return self.goldengate.handle(http.Request('POST', url, [], '', StartResponse()))
+
+    def test_reload(self):
+        authorizer = self.goldengate.authorizer
+        self.goldengate.reload()
+        self.assertEquals(settings.remote_host, 'reloaded.example.com')
+        self.assertFalse(settings.policies is self.snapshot['policies'])
+        self.assertTrue(settings.policy_index.policies is settings.policies)
+        self.assertEquals(self.goldengate.authenticator.credentials.for_key('key').entity, 'lion-o')
+        self.assertFalse(self.goldengate.authorizer is authorizer)
+        self.assertTrue(directory.get_directory().sources[0] is settings.entity_groups)
+        # Settings that aren't in the file go back to their defaults.
+        self.settings_are_defaults('stream_chunk_size', 'deferred_workers')
+
+    def settings_are_defaults(self, *names):
+        for name in names:
+            self.assertEquals(getattr(settings, name), config.SettingMeta.known_settings[name].default)
+
+    def test_reload_route(self):
+        self.assertRaises(auth.UnauthorizedException, self.reload)
+        settings.set('reload_entities', ['lion-o'])
+        self.assertEquals(self.reload().status, 200)
+        self.assertEquals(settings.remote_host, 'reloaded.example.com')
+
+        # Once reloaded, RELOAD_ENTITIES comes from the file.
+        self.goldengate.authenticator.entity = 'mumm-ra'
+        self.assertRaises(auth.UnauthorizedException, self.reload)
+
+    def test_reload_route_is_exact(self):
+        settings.set('reload_entities', ['lion-o'])
+        for path in ['/~/reloadx', '/~/reload/now']:
+            url = http.URL('http', 'example.com', path, {})
+            self.assertEquals(self.goldengate.handle(http.Request('POST', url, [], '', StartResponse())).status, 404)
+        self.assertFalse(settings.remote_host == 'reloaded.example.com')
+
+    def test_reload_credentials_file(self):
+        files = []
+        for key in ['first', 'second']:
+            fd, filename = tempfile.mkstemp(suffix='.py')
+            os.write(fd, 'CREDENTIALS = [("lion-o", %r, "secret")]\n' % (key,))
+            os.close(fd)
+            files.append(filename)
+        try:
+            for filename in files + files[1:]:
+                self.write(
+                    'CREDENTIAL_STORE = "goldengate.credentials.FileCredentialStore"',
+                    'CREDENTIALS_FILE = %r' % (filename,),
+                    'CREDENTIALS_RELOAD_INTERVAL = 0',
+                )
+                previous = self.goldengate.authenticator.credentials
+                self.goldengate.reload()
+                store = self.goldengate.authenticator.credentials
+                self.assertEquals(store.filename, filename)
+                # Requests still using the old store keep it as it was.
+                self.assertFalse(store is previous)
+            self.assertTrue(previous.watching is None or previous.watching.is_set())
+            self.assertEquals(store.for_key('second').entity, 'lion-o')
+            self.assertEquals(store.for_key('first'), None)
+        finally:
+            for filename in files:
+                os.remove(filename)
+
+    def test_reload_stops_old_brokers(self):
+        class Broker(notifications.NotificationBroker):
+            stopped = False
+            def stop(self):
+                self.stopped = True
+        shared = Broker()
+        old = notifications.DigestNotificationBroker(Broker())
+        settings.install(dict(self.snapshot, policies=[
+            policy.TimeLockPolicy(policy.AlwaysMatcher(), 60, old, '', []),
+            policy.TimeLockPolicy(policy.AlwaysMatcher(), 60, shared, '', []),
+        ]))
+        goldengate.shared_broker = shared
+        try:
+            self.write(
+                'from goldengate import policy, goldengate',
+                'POLICIES = [policy.TimeLockPolicy(policy.AlwaysMatcher(), 60, goldengate.shared_broker, "", [])]',
+            )
+            self.goldengate.reload()
+        finally:
+            del goldengate.shared_broker
+        self.assertTrue(old.broker.stopped)
+        self.assertFalse(shared.stopped)
+
+    def test_reloads_are_serialized(self):
+        class GoldenGate(goldengate.GoldenGate):
+            running = 0
+            overlapped = False
+            def _reload(self):
+                self.running += 1
+                self.overlapped = self.overlapped or self.running > 1
+                time.sleep(0.01)
+                super(GoldenGate, self)._reload()
+                self.running -= 1
+        gg = GoldenGate(authenticator=MockAuthenticator, authorizer=MockAuthorizer, auditor=MockAuditor, proxy=goldengate.Proxy)
+        threads = [threading.Thread(target=gg.reload) for _ in xrange(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        self.assertFalse(gg.overlapped)
+        self.assertTrue(gg.proxy.balancer is balancer.get_balancer())
+
+    def test_reload_moves_traffic(self):
+        gg = goldengate.GoldenGate(authenticator=MockAuthenticator, authorizer=auth.base.Authorizer, auditor=MockAuditor, proxy=goldengate.Proxy)
+        url = http.URL('http', 'example.com', '/', {})
+        request = http.Request('GET', url, [('host', 'example.com')], '', StartResponse())
+        previous = gg.proxy.balancer
+        self.assertFalse(gg.authorizer.prepare(None, request).url.host == 'reloaded.example.com')
+        gg.reload()
+        self.assertEquals(gg.authorizer.prepare(None, request).url.host, 'reloaded.example.com')
+        self.assertTrue(gg.proxy.balancer is balancer.get_balancer())
+        self.assertFalse(gg.proxy.balancer is previous)
+        # Reloading without changing the upstream keeps the balancer.
+        gg.reload()
+        self.assertTrue(balancer.get_balancer() is gg.proxy.balancer)
+
+    def test_requests_use_one_configuration(self):
+        gg = goldengate.GoldenGate(authenticator=MockAuthenticator, authorizer=auth.base.Authorizer, auditor=MockAuditor, proxy=MockProxy)
+        request = http.Request('GET', http.URL('http', 'example.com', '/', {}), [('host', 'example.com')], '', StartResponse())
+        for admin in ['lion-o', 'cheetara']:
+            self.write(
+                'from goldengate import policy',
+                'ENTITY_GROUPS = {"admins": [%r]}' % (admin,),
+                'POLICIES = [policy.AllowPolicy(policy.GroupMatcher("admins")), policy.deny()]',
+            )
+            previous = gg.runtime
+            gg.reload()
+        # A request that read the runtime before the last reload is still
+        # authorized with its policies and directory.
+        previous.authorizer.authorize('lion-o', request)
+        self.assertRaises(auth.UnauthorizedException, previous.authorizer.authorize, 'cheetara', request)
+        gg.authorizer.authorize('cheetara', request)
+        self.assertRaises(auth.UnauthorizedException, gg.authorizer.authorize, 'lion-o', request)
+        self.assertTrue(directory.get_directory().in_group('cheetara', 'admins'))
+        self.assertTrue(gg.runtime.snapshot is settings.__dict__)
+
+    def test_bad_entities_keep_settings(self):
+        self.write(
+            'REMOTE_HOST = "reloaded.example.com"',
+            'ENTITY_GROUPS = {"admins": ["lion-o"]}',
+            'ENTITY_KINDS = {"institutional": ["hudson"], "person": ["hudson"]}',
+        )
+        snapshot = settings.__dict__
+        entities = directory.get_directory()
+        self.assertRaises(ValueError, self.goldengate.reload)
+        self.assertTrue(settings.__dict__ is snapshot)
+        self.assertFalse(settings.remote_host == 'reloaded.example.com')
+        self.assertTrue(directory.get_directory() is entities)
+
+    def test_bad_config_keeps_settings(self):
+        self.write('REMOTE_HOST = ')
+        settings.set('reload_entities', ['lion-o'])
+        snapshot = settings.__dict__
+        self.assertEquals(self.reload().status, 500)
+        self.assertTrue(settings.__dict__ is snapshot)
+
+
 class ConfigTests(unittest.TestCase):
     def test_class_setting(self):
         setting = config.ClassSetting()
         setting.set('goldengate.auth.aws.Authorizer')
         self.assertTrue(setting.get() is auth.aws.Authorizer)
 
+    def test_snapshots(self):
+        conf = config.Config()
+        self.assertEquals(conf.__dict__['remote_host'], 'ec2.amazonaws.com')
+        conf.set('remote_host', 'example.com')
+        self.assertEquals(conf.remote_host, 'example.com')
+        self.assertRaises(AttributeError, setattr, conf, 'remote_host', 'example.org')
+        self.assertRaises(AttributeError, getattr, conf, 'nope')
+
+        snapshot = conf.build({'remote_hosts': ['a.example.com']})
+        self.assertEquals(conf.remote_hosts, [])
+        conf.install(snapshot)
+        self.assertEquals(conf.remote_hosts, ['a.example.com'])
+        self.assertEquals(conf.remote_host, 'ec2.amazonaws.com')
+        self.assertRaises(KeyError, conf.build, {'nope': 1})
+
 
 class HttpTests(GGTestCase):
 
@@ -189,6 +458,24 @@ class HttpTests(GGTestCase):
         self.assertEquals(dict(request.headers)['content-type'], 'application/x-www-form-urlencoded')
         self.assertEquals(request.body, '')
 
+    def test_parameter_view(self):
+        self.environ['QUERY_STRING'] = 'InstanceId.2=i-2&InstanceId.10=i-10&InstanceId.1=i-1&MaxCount=3&Filter.1.Name=tag&Foo=bar'
+        request = self.request(self.environ)
+        view = request.parameter_view
+        self.assertTrue(request.parameter_view is view)
+        self.assertEquals(view.get('Foo'), 'bar')
+        self.assertEquals(view.get_int('MaxCount'), 3)
+        self.assertEquals(view.get_int('Foo'), None)
+        self.assertEquals(view.lists, None)
+        self.assertEquals(view.get_list('InstanceId.N'), ('i-1', 'i-2', 'i-10'))
+        self.assertEquals(view.lookup('Filter.N.Name'), ('tag',))
+        self.assertEquals(view.lookup('Missing.N'), ())
+
+        # A clone with new parameters gets a new view.
+        clone = request._clone(url=http.clone_url(request.url, parameters={'Foo': 'baz'}))
+        self.assertEquals(clone.parameter_view.get('Foo'), 'baz')
+        self.assertTrue(request.parameter_view is view)
+
     def test_bad_query(self):
         self.environ['QUERY_STRING'] = '!'
         request = self.request(self.environ)
@@ -278,20 +565,35 @@ class HttpTests(GGTestCase):
         self.assertEquals(len(request.headers), 2)
         self.assertEquals(dict(request.headers)['x-spirit-animal'], 'kangaroo')
 
+    def test_request_from_dict(self):
+        this = self.request(self.environ)
+        that = http.Request.from_dict(this.to_dict())
+        self.assertEquals(that.to_dict(), this.to_dict())
+        self.assertEquals(that.url, this.url)
+
     def test_clone_request(self):
         this = self.request(self.environ)
         that = this._clone()
         self.assertFalse(this is that)
         self.assertEquals(this.method, that.method)
-        self.assertFalse(this.url is that.url)
         self.assertEquals(this.url, that.url)
-        self.assertFalse(this.url.parameters is that.url.parameters)
-        for key, value in this.url.parameters.iteritems():
-            self.assertEquals(that.url.parameters[key], value)
-        self.assertFalse(this.headers is that.headers)
-        for key, value in dict(this.headers).iteritems():
-            self.assertEquals(dict(that.headers)[key], value)
+        self.assertEquals(dict(this.headers), dict(that.headers))
         self.assertEquals(this.body, that.body)
+
+    def test_clone_request_is_copy_on_write(self):
+        this = self.request(self.environ)
+        that = this._clone(url=http.clone_url(this.url, host='example.org'), headers={'x-foo': 'bar'})
+        self.assertTrue(that.url.parameters is this.url.parameters)
+        self.assertEquals(that.url.host, 'example.org')
+        self.assertNotEquals(this.url.host, 'example.org')
+        self.assertEquals(that.headers, [('x-foo', 'bar')])
+        self.assertFalse('x-foo' in dict(this.headers))
+
+    def test_clone_request_class(self):
+        this = self.request(self.environ)
+        that = this._clone(klass=auth.aws.Request)
+        self.assertTrue(isinstance(that, auth.aws.Request))
+        self.assertTrue(auth.aws.as_request(that) is that)
         self.assertTrue(this.callback is that.callback)
 
     def test_to_dict(self):
@@ -321,6 +623,17 @@ class HttpTests(GGTestCase):
         for name, value in headers:
             self.assertEquals(dict(start_response.headers)[name], value)
 
+    def test_response_body_bytes_are_untouched(self):
+        body = 'caf\xc3\xa9'
+        response = http.Response(body=body)
+        self.assertEquals(response.body, body)
+        self.assertEquals(http.Response(body=u'caf\xe9').body, body)
+
+    def test_request_body_reads_content_length(self):
+        self.environ['wsgi.input'] = WSGIInput('Action=DescribeInstancesAndMore')
+        self.environ['CONTENT_LENGTH'] = '24'
+        self.assertEquals(self.request(self.environ).body, 'Action=DescribeInstances')
+
     def test_response_encode_headers(self):
         headers = [(u'x-foo', u'bar')]
         encoded = http.Response.encode_headers(headers)
@@ -348,7 +661,7 @@ class ProxyTests(GGTestCase):
     class MockHttp(object):
         response = {'x-favorite-vegetable': 'asparagus', 'status': '200'}
         content = 'snarf!'
-        def request(self, url, method, headers, body):
+        def request(self, url, method, headers, body, idempotent=False):
             self.url = url
             self.method = method
             self.headers = headers
@@ -372,6 +685,494 @@ class ProxyTests(GGTestCase):
         self.assertEquals(response.body, proxy.http.content)
 
 
+class ConnectionPoolTests(unittest.TestCase):
+    def setUp(self):
+        self.server = UpstreamServer()
+        self.connections = pool.ConnectionPool()
+
+    def tearDown(self):
+        self.connections.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_request(self):
+        headers, content = self.connections.request(self.server.origin + '/foo')
+        self.assertEquals(headers['status'], '200')
+        self.assertEquals(headers['x-favorite-vegetable'], 'asparagus')
+        self.assertEquals(content, self.server.body)
+
+    def test_keep_alive(self):
+        for _ in xrange(3):
+            self.connections.request(self.server.origin + '/foo')
+        self.assertEquals(len(self.server.clients), 3)
+        self.assertEquals(len(set(self.server.clients)), 1)
+
+    def test_idle_connections_are_evicted(self):
+        self.connections.idle_timeout = -1
+        self.connections.request(self.server.origin + '/foo')
+        self.connections.request(self.server.origin + '/foo')
+        self.assertEquals(len(set(self.server.clients)), 2)
+
+    def test_unread_response_is_not_reused(self):
+        self.connections.urlopen('GET', self.server.origin + '/foo').close()
+        self.connections.request(self.server.origin + '/foo')
+        self.assertEquals(len(set(self.server.clients)), 2)
+
+    def test_prewarm(self):
+        self.connections.prewarm(self.server.origin, 2)
+        key = ('http', self.server.origin[len('http://'):])
+        self.assertEquals(len(self.connections.idle[key]), 2)
+
+    class StaleConnection(object):
+        "A pooled connection the server has since closed."
+        sock = None
+        def __init__(self, error, when='getresponse'):
+            self.error = error
+            self.when = when
+        def request(self, *args):
+            if self.when == 'request':
+                raise self.error
+        def getresponse(self):
+            raise self.error
+        def close(self):
+            pass
+
+    def park(self, connection):
+        key = ('http', self.server.origin[len('http://'):])
+        self.connections.idle[key] = [(connection, time.time())]
+
+    def test_stale_connection_retried_if_idempotent(self):
+        self.park(self.StaleConnection(httplib.BadStatusLine('')))
+        headers, content = self.connections.request(self.server.origin + '/foo', idempotent=True)
+        self.assertEquals(headers['status'], '200')
+
+    def test_stale_connection_not_retried_once_sent(self):
+        self.park(self.StaleConnection(httplib.BadStatusLine('')))
+        self.assertRaises(httplib.BadStatusLine, self.connections.request, self.server.origin + '/foo', 'POST')
+        self.assertEquals(self.server.clients, [])
+
+    def test_stale_connection_retried_if_not_sent(self):
+        error = socket.error(errno.EPIPE, 'Broken pipe')
+        self.park(self.StaleConnection(error, when='request'))
+        headers, content = self.connections.request(self.server.origin + '/foo', 'GET')
+        self.assertEquals(headers['status'], '200')
+
+    def test_acquire_timeout(self):
+        self.connections = pool.ConnectionPool(max_connections=1, acquire_timeout=0.01)
+        response = self.connections.urlopen('GET', self.server.origin + '/foo')
+        self.assertRaises(pool.PoolTimeout, self.connections.request, self.server.origin + '/foo')
+        response.read()
+        response.close()
+        headers, content = self.connections.request(self.server.origin + '/foo')
+        self.assertEquals(headers['status'], '200')
+
+    def test_resolver_caches_lookups(self):
+        resolver = pool.Resolver(ttl=60)
+        addresses = resolver.resolve('127.0.0.1', 80)
+        self.assertTrue(resolver.resolve('127.0.0.1', 80) is addresses)
+        resolver.ttl = -1
+        resolver.cache.clear()
+        addresses = resolver.resolve('127.0.0.1', 80)
+        self.assertFalse(resolver.resolve('127.0.0.1', 80) is addresses)
+
+
+class LRUCacheTests(unittest.TestCase):
+    def test_eviction(self):
+        lru = cache.LRUCache(size=2)
+        lru.set('a', 1)
+        lru.set('b', 2)
+        lru.get('a')
+        lru.set('c', 3)
+        self.assertEquals(len(lru), 2)
+        self.assertEquals(lru.get('a'), 1)
+        self.assertTrue(lru.get('b') is None)
+        self.assertEquals(lru.get('c'), 3)
+
+    def test_expiry(self):
+        lru = cache.LRUCache(ttl=-1)
+        lru.set('a', 1)
+        self.assertTrue(lru.get('a') is None)
+        lru.set('a', 1, ttl=60)
+        self.assertEquals(lru.get('a'), 1)
+
+    def test_kvstore(self):
+        store = cache.KVCacheStore(kvstore.get_kvstore('locmem://'))
+        store.set('a', 1, ttl=60)
+        self.assertEquals(store.get('a'), 1)
+        store.set('a', 1, ttl=-1)
+        self.assertTrue(store.get('a') is None)
+
+
+class ResponseCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.cache = cache.ResponseCache({'DescribeInstances': 60}, ignored_parameters=auth.aws.AUTH_PARAMETERS)
+        self.calls = 0
+
+    def request(self, **parameters):
+        parameters.setdefault('Action', 'DescribeInstances')
+        url = http.URL('http', 'example.com', '/', parameters)
+        return http.Request('GET', url, [], '', StartResponse())
+
+    def fetch(self):
+        self.calls += 1
+        return http.Response(200, [('x-favorite-vegetable', 'asparagus')], 'snarf!')
+
+    def test_cached(self):
+        first = self.cache.fetch('snarf', self.request(Signature='a', Timestamp='1'), self.fetch)
+        second = self.cache.fetch('snarf', self.request(Signature='b', Timestamp='2'), self.fetch)
+        self.assertEquals(self.calls, 1)
+        self.assertFalse(first is second)
+        self.assertEquals(second.body, 'snarf!')
+        self.assertEquals(sorted(second.headers), sorted(first.headers))
+
+    def test_refuses_mutating_actions(self):
+        cache.ResponseCache({'DescribeInstances': 60}, is_read_only=auth.aws.is_read_only)
+        self.assertRaises(ValueError, cache.ResponseCache, {'DescribeInstances': 60, 'TerminateInstances': 60}, is_read_only=auth.aws.is_read_only)
+
+    def test_key_includes_entity_and_parameters(self):
+        self.cache.fetch('snarf', self.request(), self.fetch)
+        self.cache.fetch('blarf', self.request(), self.fetch)
+        self.cache.fetch('snarf', self.request(**{'InstanceId.1': 'i-1'}), self.fetch)
+        self.assertEquals(self.calls, 3)
+
+    def test_only_configured_actions_are_cached(self):
+        self.cache.fetch('snarf', self.request(Action='TerminateInstances'), self.fetch)
+        self.cache.fetch('snarf', self.request(Action='TerminateInstances'), self.fetch)
+        self.assertEquals(self.calls, 2)
+
+    def test_errors_are_not_cached(self):
+        fetch = lambda: http.Response(503, [], 'slow down')
+        self.cache.fetch('snarf', self.request(), fetch)
+        self.cache.fetch('snarf', self.request(), self.fetch)
+        self.assertEquals(self.calls, 1)
+
+
+class SingleFlightTests(unittest.TestCase):
+    def setUp(self):
+        self.flight = cache.SingleFlight()
+        self.gate = threading.Event()
+        self.calls = 0
+
+    def call(self):
+        self.calls += 1
+        self.gate.wait()
+        return http.Response(200, [], 'snarf!')
+
+    def run_concurrently(self, fn, count=5):
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(fn())) for _ in xrange(count)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.1)
+        self.gate.set()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_concurrent_calls_are_coalesced(self):
+        results = self.run_concurrently(lambda: self.flight.do('key', self.call))
+        self.assertEquals(self.calls, 1)
+        self.assertEquals(len(results), 5)
+        self.assertEquals(len(self.flight.calls), 0)
+
+    def test_errors_are_shared(self):
+        errors = []
+        def call():
+            self.gate.wait()
+            raise ValueError('nope')
+        def do():
+            try:
+                self.flight.do('key', call)
+            except ValueError, e:
+                errors.append(e)
+        self.run_concurrently(do)
+        self.assertEquals(len(errors), 5)
+
+    def test_goldengate_coalesces_read_only_requests(self):
+        gg = goldengate.GoldenGate(authenticator=MockAuthenticator, authorizer=MockAuthorizer, auditor=MockAuditor, proxy=MockProxy)
+        gg.coalescer = self.flight
+        gg.proxy.request = lambda request: self.call()
+        def request(action):
+            url = http.URL('http', 'example.com', '/', {'Action': action})
+            return http.Request('GET', url, [], '', StartResponse())
+
+        responses = self.run_concurrently(lambda: gg.handle(request('DescribeInstances')))
+        self.assertEquals(self.calls, 1)
+        self.assertEquals(len(set(id(response) for response in responses)), 5)
+        self.assertEquals(len(gg.auditor.records), 5)
+
+        self.gate.clear()
+        self.calls = 0
+        self.run_concurrently(lambda: gg.handle(request('TerminateInstances')))
+        self.assertEquals(self.calls, 5)
+
+
+class StreamingProxyTests(unittest.TestCase):
+    def setUp(self):
+        self.server = UpstreamServer()
+        self.server.body = 'snarf! ' * 10
+        self.proxy = goldengate.Proxy()
+        self.proxy.stream_responses = True
+        self.proxy.chunk_size = 16
+
+    def tearDown(self):
+        self.proxy.http.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def request(self, file_wrapper=None, parameters=None):
+        url = http.URL('http', self.server.origin[len('http://'):], '/foo', parameters or {})
+        return http.Request('GET', url, [], '', StartResponse(), file_wrapper=file_wrapper)
+
+    def test_large_response_is_streamed(self):
+        response = self.proxy.request(self.request())
+        self.assertTrue(isinstance(response, http.StreamingResponse))
+        start_response = StartResponse()
+        chunks = list(response.send(start_response))
+        self.assertEquals(start_response.status, '200 OK')
+        self.assertEquals(dict(start_response.headers)['Content-Length'], str(len(self.server.body)))
+        self.assertEquals(max(len(chunk) for chunk in chunks), self.proxy.chunk_size)
+        self.assertEquals(''.join(chunks), self.server.body)
+
+        # Once the body has been read the connection goes back to the pool.
+        self.proxy.request(self.request()).stream.close()
+        self.assertEquals(len(set(self.server.clients)), 1)
+
+    def test_small_response_is_buffered(self):
+        self.server.body = 'snarf!'
+        response = self.proxy.request(self.request())
+        self.assertFalse(isinstance(response, http.StreamingResponse))
+        self.assertEquals(response.body, self.server.body)
+
+    def test_file_wrapper(self):
+        class FileWrapper(object):
+            def __init__(self, stream, chunk_size):
+                self.stream = stream
+                self.chunk_size = chunk_size
+        response = self.proxy.request(self.request(file_wrapper=FileWrapper))
+        wrapped = response.send(StartResponse())
+        self.assertTrue(isinstance(wrapped, FileWrapper))
+        self.assertEquals(wrapped.chunk_size, self.proxy.chunk_size)
+        self.assertEquals(wrapped.stream.read(), self.server.body)
+        wrapped.stream.close()
+
+    def test_read_only_response_is_streamed_through_gateway(self):
+        # With the default settings (coalescing on), a read-only request
+        # that nothing else joins isn't buffered.
+        gg = goldengate.GoldenGate(authenticator=MockAuthenticator, authorizer=MockAuthorizer, auditor=MockAuditor, proxy=lambda: self.proxy)
+        self.assertTrue(gg.coalescer is not None)
+        response = gg.handle(self.request(parameters={'Action': 'DescribeInstances'}))
+        self.assertTrue(isinstance(response, http.StreamingResponse))
+        self.assertEquals(''.join(response.send(StartResponse())), self.server.body)
+
+
+class ResilienceTests(unittest.TestCase):
+    class ScriptedHttp(object):
+        """Returns (or raises) each of `results` in turn."""
+        def __init__(self, *results):
+            self.results = list(results)
+            self.calls = 0
+        def request(self, url, method, headers, body, idempotent=False):
+            self.calls += 1
+            result = self.results.pop(0)
+            if isinstance(result, Exception):
+                raise result
+            return {'status': str(result)}, 'snarf!'
+
+    def setUp(self):
+        self.proxy = goldengate.Proxy()
+        self.proxy.backoff = resilience.Backoff(0, 0)
+
+    def request(self, action):
+        url = http.URL('http', 'example.com', '/', {'Action': action})
+        return http.Request('GET', url, [], '', StartResponse())
+
+    def assertUpstreamError(self, status, request):
+        with self.assertRaises(http.HTTPException) as context:
+            self.proxy.request(request)
+        self.assertEquals(context.exception.status, status)
+
+    def test_read_only_requests_are_retried(self):
+        self.proxy.http = self.ScriptedHttp(503, socket.error('nope'), 200)
+        response = self.proxy.request(self.request('DescribeInstances'))
+        self.assertEquals(response.status, 200)
+        self.assertEquals(self.proxy.http.calls, 3)
+
+    def test_other_requests_are_not_retried(self):
+        self.proxy.http = self.ScriptedHttp(503, 200)
+        response = self.proxy.request(self.request('TerminateInstances'))
+        self.assertEquals(response.status, 503)
+        self.assertEquals(self.proxy.http.calls, 1)
+
+    def test_upstream_errors(self):
+        self.proxy.http = self.ScriptedHttp(socket.error('nope'), socket.timeout('slow'))
+        self.assertUpstreamError(502, self.request('TerminateInstances'))
+        self.assertUpstreamError(504, self.request('TerminateInstances'))
+
+    def test_circuit_breaker_fails_fast(self):
+        self.proxy.http = self.ScriptedHttp(*[500] * 5)
+        for _ in xrange(5):
+            self.proxy.request(self.request('TerminateInstances'))
+        self.assertUpstreamError(503, self.request('TerminateInstances'))
+        self.assertEquals(self.proxy.http.calls, 5)
+
+    def test_pool_timeout(self):
+        self.proxy.http = self.ScriptedHttp(pool.PoolTimeout('busy'), pool.PoolTimeout('busy'))
+        self.assertUpstreamError(503, self.request('DescribeInstances'))
+        # Not retried, and not the host's fault.
+        self.assertEquals(self.proxy.http.calls, 1)
+        self.assertEquals(self.proxy.breaker('example.com').failures, 0)
+
+    def test_pool_timeout_hands_back_trial_request(self):
+        breaker = self.proxy.breaker('example.com')
+        breaker.reset_timeout = 0
+        for _ in xrange(breaker.threshold):
+            breaker.failure()
+        self.assertTrue(breaker.is_open)
+        self.proxy.http = self.ScriptedHttp(pool.PoolTimeout('busy'), 200)
+        self.assertUpstreamError(503, self.request('TerminateInstances'))
+        self.assertFalse(breaker.trial)
+        # The next request gets the trial, and closes the breaker.
+        self.assertEquals(self.proxy.request(self.request('TerminateInstances')).status, 200)
+        self.assertFalse(breaker.is_open)
+
+    def test_circuit_breaker_trial_request(self):
+        breaker = resilience.CircuitBreaker(threshold=1, reset_timeout=0)
+        breaker.failure()
+        self.assertTrue(breaker.is_open)
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.failure()
+        self.assertTrue(breaker.allow())
+        breaker.success()
+        self.assertFalse(breaker.is_open)
+        self.assertTrue(breaker.allow())
+        self.assertTrue(breaker.allow())
+
+    def test_backoff(self):
+        backoff = resilience.Backoff(0.1, 1.0)
+        for attempt in xrange(10):
+            self.assertTrue(0 <= backoff.delay(attempt) <= min(1.0, 0.1 * 2 ** attempt))
+
+    def test_latency_percentile(self):
+        tracker = resilience.LatencyTracker(size=100, minimum=10)
+        self.assertTrue(tracker.percentile(95) is None)
+        for latency in xrange(100):
+            tracker.record(latency)
+        self.assertEquals(tracker.percentile(95), 95)
+
+    def test_hedge(self):
+        calls = []
+        discarded = []
+        release = threading.Event()
+        def fn():
+            calls.append(None)
+            if len(calls) == 1:
+                release.wait()
+                return 'slow'
+            return 'fast'
+        self.assertEquals(resilience.hedge(fn, 0.01, discarded.append), 'fast')
+        release.set()
+        time.sleep(0.05)
+        self.assertEquals(discarded, ['slow'])
+
+
+class BalancerTests(unittest.TestCase):
+    hosts = ['ec2.us-east-1.amazonaws.com', 'ec2.us-west-1.amazonaws.com']
+
+    def test_least_outstanding(self):
+        lb = balancer.Balancer(self.hosts)
+        lb.start(self.hosts[0])
+        self.assertEquals(lb.choose(), self.hosts[1])
+        lb.start(self.hosts[1])
+        lb.start(self.hosts[1])
+        self.assertEquals(lb.choose(), self.hosts[0])
+        lb.finish(self.hosts[1], 0.1, True)
+        lb.finish(self.hosts[1], 0.1, True)
+        self.assertEquals(lb.choose(), self.hosts[1])
+
+    def test_ewma(self):
+        lb = balancer.Balancer(self.hosts, strategy='ewma')
+        for host, latency in zip(self.hosts, [0.5, 0.1]):
+            lb.start(host)
+            lb.finish(host, latency, True)
+        self.assertEquals(lb.choose(), self.hosts[1])
+        lb.start(self.hosts[1])
+        lb.finish(self.hosts[1], 2.0, True)
+        self.assertEquals(lb.choose(), self.hosts[0])
+
+    def test_ejection(self):
+        lb = balancer.Balancer(self.hosts, eject_threshold=2)
+        lb.start(self.hosts[1])
+        for _ in xrange(2):
+            lb.start(self.hosts[0])
+            lb.finish(self.hosts[0], 0.1, False)
+        self.assertEquals(lb.choose(), self.hosts[1])
+        lb.endpoints[self.hosts[1]].ejected_until = time.time() + 30
+        self.assertTrue(lb.choose() in self.hosts)
+
+    def test_health_checks_dont_undo_ejection(self):
+        listeners = []
+        for _ in xrange(2):
+            listener = socket.socket()
+            listener.bind(('127.0.0.1', 0))
+            listener.listen(5)
+            listeners.append(listener)
+        flaky, other = ['127.0.0.1:%d' % (listener.getsockname()[1],) for listener in listeners]
+        try:
+            lb = balancer.Balancer([flaky, other], eject_threshold=2)
+            for _ in xrange(2):
+                lb.start(flaky)
+                lb.finish(flaky, 0.1, False)
+            # It accepts connections, but it's still ejected.
+            lb.check(timeout=1)
+            self.assertFalse(lb.endpoints[flaky].down)
+            self.assertEquals(lb.choose(), other)
+            listeners.pop(0).close()
+            lb.endpoints[flaky].ejected_until = 0
+            lb.check(timeout=1)
+            self.assertTrue(lb.endpoints[flaky].down)
+            lb.start(other)
+            self.assertEquals(lb.choose(), other)
+        finally:
+            for listener in listeners:
+                listener.close()
+
+    def test_health_check_port(self):
+        endpoint = balancer.Endpoint('example.com')
+        self.assertEquals(endpoint.address, ('example.com', 443))
+        lb = balancer.Balancer(['example.com', 'example.org:8080'])
+        lb.start('example.com', 'http')
+        self.assertEquals(lb.endpoints['example.com'].address, ('example.com', 80))
+        self.assertEquals(lb.endpoints['example.org:8080'].address, ('example.org', 8080))
+
+    def test_unknown_strategy(self):
+        self.assertRaises(ValueError, balancer.Balancer, self.hosts, strategy='random')
+
+    def test_install_moves_health_checks(self):
+        values = dict(settings.__dict__, remote_hosts=['127.0.0.1:1'], balancer_health_check_interval=3600)
+        previous = balancer.get_balancer()
+        lb = balancer.build(values)
+        self.assertEquals(lb.health_checks, None)
+        balancer.install(lb)
+        try:
+            self.assertFalse(lb.health_checks.is_set())
+            self.assertTrue(balancer.for_settings(values) is lb)
+            self.assertFalse(balancer.for_settings(settings.__dict__) is lb)
+        finally:
+            balancer.install(previous)
+        self.assertTrue(lb.health_checks.is_set())
+
+    def test_prepare_uses_balancer(self):
+        lb = balancer.Balancer(self.hosts)
+        lb.start(self.hosts[0])
+        authorizer = auth.base.Authorizer(balancer=lb)
+        url = http.URL('http', 'example.com', '/', {})
+        request = authorizer.prepare(None, http.Request('GET', url, [('host', 'example.com')], '', StartResponse()))
+        self.assertEquals(request.url.host, self.hosts[1])
+        self.assertEquals(dict(request.headers)['host'], self.hosts[1])
+
+
 class AWSTests(GGTestCase):
     scheme = 'http'
     host = 'example.com:8000'
@@ -458,6 +1259,144 @@ class AWSRequestTests(AWSTests):
             self.assertEquals(signed.url.parameters['Version'], request.url.parameters['Version'])
 
 
+class AWSSignatureTests(unittest.TestCase):
+    def test_parse_timestamp(self):
+        for timestamp in ['2010-08-12T00:00:05', '2012-02-29T23:59:59', '1999-12-31T12:30:00', '2010-8-12T0:0:5']:
+            self.assertEquals(auth.aws.parse_timestamp(timestamp), calendar.timegm(time.strptime(timestamp, auth.aws.TIME_FORMAT)))
+
+    def test_parse_bad_timestamp(self):
+        for timestamp in ['2010-02-30T00:00:05', '2010-13-01T00:00:05', '2010-08-12T24:00:05', '2010-08-12T00:00:05Z', '+010-08-12T00:00:05', '']:
+            self.assertRaises(ValueError, auth.aws.parse_timestamp, timestamp)
+
+    def test_are_equal(self):
+        self.assertTrue(auth.aws._are_equal('snarf', 'snarf'))
+        self.assertTrue(auth.aws._are_equal(u'snarf', 'snarf'))
+        self.assertFalse(auth.aws._are_equal('snarf', 'snarF'))
+        self.assertFalse(auth.aws._are_equal('snarf', 'snarfs'))
+        self.assertFalse(auth.aws._are_equal('', 'snarf'))
+
+    def test_hmac_is_copied(self):
+        first = auth.aws._hmac('secret', hashlib.sha256)
+        first.update('foo')
+        second = auth.aws._hmac('secret', hashlib.sha256)
+        second.update('bar')
+        self.assertEquals(first.digest(), hmac.new('secret', 'foo', hashlib.sha256).digest())
+        self.assertEquals(second.digest(), hmac.new('secret', 'bar', hashlib.sha256).digest())
+
+    def test_parse_v4_timestamp(self):
+        self.assertEquals(auth.aws.parse_v4_timestamp('20150830T123600Z'), calendar.timegm((2015, 8, 30, 12, 36, 0)))
+        for timestamp in ['20150830T123600', '20151330T123600Z', '']:
+            self.assertRaises(ValueError, auth.aws.parse_v4_timestamp, timestamp)
+
+    def test_v4_signing_key(self):
+        # Example from the AWS Signature Version 4 documentation.
+        key = auth.aws._signing_key('wJalrXUtnFEMI/K7MDENG+bPxRfiCYEXAMPLEKEY', '20120215', 'us-east-1', 'iam')
+        self.assertEquals(key.encode('hex'), 'f4780e2d9f65fa895f9c67b32ce1baf0b0d8a43505a000a1a9e090d414db404d')
+        self.assertTrue(auth.aws._signing_key('wJalrXUtnFEMI/K7MDENG+bPxRfiCYEXAMPLEKEY', '20120215', 'us-east-1', 'iam') is key)
+
+    def test_v4_signature(self):
+        # Example from the AWS Signature Version 4 documentation.
+        request = auth.aws.Request('GET', http.URL('https', 'iam.amazonaws.com', '/', {'Action': 'ListUsers', 'Version': '2010-05-08'}), [
+            ('content-type', 'application/x-www-form-urlencoded; charset=utf-8'),
+            ('host', 'iam.amazonaws.com'),
+            ('x-amz-date', '20150830T123600Z'),
+            ('authorization', 'AWS4-HMAC-SHA256 Credential=AKIDEXAMPLE/20150830/us-east-1/iam/aws4_request, '
+                              'SignedHeaders=content-type;host;x-amz-date, '
+                              'Signature=5d672d79c15b13162d9279b0855cfba6789a8edb4c82c400e06b5924a6f2b5d7'),
+        ], '', None)
+        self.assertTrue(request.is_v4())
+        self.assertEquals(
+            auth.aws.SignatureMethod_HMAC_SHA256_V4().build_signature(request, 'wJalrXUtnFEMI/K7MDENG+bPxRfiCYEXAMPLEKEY'),
+            '5d672d79c15b13162d9279b0855cfba6789a8edb4c82c400e06b5924a6f2b5d7',
+        )
+
+    def test_v4_scope_for_host(self):
+        signature_method = auth.aws.SignatureMethod_HMAC_SHA256_V4()
+        self.assertEquals(signature_method.scope_for_host('ec2.us-west-1.amazonaws.com'), ('us-west-1', 'ec2'))
+        self.assertEquals(signature_method.scope_for_host('ec2.amazonaws.com:443'), ('us-east-1', 'ec2'))
+        self.assertEquals(auth.aws.SignatureMethod_HMAC_SHA256_V4('eu-west-1', 'ec2').scope_for_host('localhost'), ('eu-west-1', 'ec2'))
+
+
+class ReplayCacheTests(unittest.TestCase):
+    def test_seen(self):
+        replays = auth.replay.ReplayCache()
+        now = time.time()
+        self.assertFalse(replays.seen('key', 'signature', now))
+        self.assertTrue(replays.seen('key', 'signature', now))
+        self.assertFalse(replays.seen('key', 'other signature', now))
+        self.assertFalse(replays.seen('other key', 'signature', now))
+
+    def test_old_buckets_are_dropped(self):
+        replays = auth.replay.ReplayCache(window=300, bucket_size=60)
+        replays.seen('key', 'old', time.time() - 600)
+        replays.seen('key', 'new', time.time())
+        replays.current = None
+        replays.seen('key', 'newer', time.time())
+        self.assertEquals(replays.size, 2)
+        self.assertEquals(sum(len(entries) for entries in replays.buckets.values()), 2)
+
+    def test_capacity(self):
+        replays = auth.replay.ReplayCache(capacity=1)
+        replays.seen('key', 'signature', time.time())
+        self.assertRaises(auth.replay.ReplayCacheFull, replays.seen, 'key', 'other signature', time.time())
+
+    def test_key_capacity(self):
+        replays = auth.replay.ReplayCache(key_capacity=1)
+        replays.seen('key', 'signature', time.time())
+        self.assertRaises(auth.replay.ReplayCacheFull, replays.seen, 'key', 'other signature', time.time())
+        self.assertFalse(replays.seen('other key', 'signature', time.time()))
+
+        # Aged out entries no longer count against their key.
+        replays = auth.replay.ReplayCache(window=300, bucket_size=60, key_capacity=1)
+        replays.seen('key', 'old', time.time() - 600)
+        replays.current = None
+        self.assertFalse(replays.seen('key', 'new', time.time()))
+        self.assertEquals(replays.key_sizes, {'key': 1})
+
+    def test_disabled_by_default(self):
+        self.assertTrue(auth.replay.get_replay_cache(300) is None)
+
+    def test_kvstore_timeout(self):
+        class Backend(object):
+            def __init__(self):
+                self.timeouts = {}
+            def add_with_timeout(self, key, value, timeout):
+                if key in self.timeouts:
+                    return False
+                self.timeouts[key] = timeout
+                return True
+        backend = Backend()
+        now = time.time()
+        replays = auth.replay.KVReplayCache(backend, window=300, bucket_size=60)
+        self.assertFalse(replays.seen('key', 'signature', now))
+        self.assertEquals(backend.timeouts.values(), [360])
+        # Another process that recorded it first wins.
+        self.assertTrue(auth.replay.KVReplayCache(backend, window=300, bucket_size=60).seen('key', 'signature', now))
+
+    def test_kvstore(self):
+        backend = kvstore.get_kvstore('locmem://')
+        now = time.time()
+        self.assertFalse(auth.replay.KVReplayCache(backend).seen('key', 'signature', now))
+        self.assertTrue(auth.replay.KVReplayCache(backend).seen('key', 'signature', now))
+
+        replays = auth.replay.KVReplayCache(backend)
+        replays.seen('key', 'old', now - 600)
+        replays.current = None
+        replays.seen('key', 'new', now)
+        self.assertEquals(replays.size, 1)
+        self.assertFalse(replays.seen('key', 'old', now - 600))
+
+    def test_kvstore_full(self):
+        backend = kvstore.get_kvstore('locmem://')
+        now = time.time()
+        replays = auth.replay.KVReplayCache(backend, key_capacity=1)
+        replays.seen('key', 'signature', now)
+        self.assertRaises(auth.replay.ReplayCacheFull, replays.seen, 'key', 'other signature', now)
+        # The rejected request wasn't recorded, so retrying it isn't a replay.
+        replays.key_capacity = 2
+        self.assertFalse(replays.seen('key', 'other signature', now))
+
+
 class AuthTests(AWSTests):
     def test_unauthorized_exception(self):
         exception = auth.UnauthorizedException('dereks_mom@example.com', 'a message')
@@ -480,7 +1419,7 @@ class AWSAuthTests(AWSTests):
         self.entity_key = 'snarf'
         self.entity_secret = 'sn4rf'
         self.credentials = credentials.StaticCredentialStore([credentials.Credential(self.entity, self.entity_key, self.entity_secret)])
-        self.authenticator = auth.aws.Authenticator(self.credentials)
+        self.authenticator = auth.aws.Authenticator(self.credentials, auth.replay.ReplayCache())
         self.authorizer = auth.aws.Authorizer(self.aws_key, self.aws_secret, policies=[policy.allow()])
         super(AWSAuthTests, self).setUp()
 
@@ -538,6 +1477,44 @@ class AWSAuthTests(AWSTests):
         request = self.signed_request(signature_method=auth.aws.SignatureMethod_HMAC_SHA1())
         self.assertEquals(self.authenticator.authenticate(request), self.entity)
 
+    def test_v4_signature_method(self):
+        request = auth.aws.Request.from_wsgi(self.environ, StartResponse())
+        signed = auth.aws.SignatureMethod_HMAC_SHA256_V4().sign(request, self.entity_key, self.entity_secret)
+        self.assertEquals(self.authenticator.authenticate(signed), self.entity)
+
+    def test_v4_signature_mismatch(self):
+        request = auth.aws.Request.from_wsgi(self.environ, StartResponse())
+        signed = auth.aws.SignatureMethod_HMAC_SHA256_V4().sign(request, self.entity_key, 'not sn4rf')
+        self.assertRaises(auth.UnauthenticatedException, self.authenticator.authenticate, signed)
+
+    def test_v4_authorization_header(self):
+        request = auth.aws.Request.from_wsgi(self.environ, StartResponse())
+        signed = auth.aws.SignatureMethod_HMAC_SHA256_V4().sign(request, self.entity_key, self.entity_secret)
+        parameters = signed.url.parameters.copy()
+        request = signed._clone(
+            url=http.clone_url(signed.url, parameters=dict((k, v) for k, v in parameters.iteritems() if not k.startswith('X-Amz-'))),
+            headers=signed.headers + [
+                ('x-amz-date', parameters['X-Amz-Date']),
+                ('authorization', 'AWS4-HMAC-SHA256 Credential=%s, SignedHeaders=host, Signature=x' % (parameters['X-Amz-Credential'],)),
+            ],
+        )
+        signature = auth.aws.SignatureMethod_HMAC_SHA256_V4().build_signature(request, self.entity_secret)
+        request.headers[-1] = ('authorization', request.headers[-1][1][:-1] + signature)
+        self.assertEquals(self.authenticator.authenticate(request), self.entity)
+
+    def test_v4_bad_scope(self):
+        request = auth.aws.Request.from_wsgi(self.environ, StartResponse())
+        signed = auth.aws.SignatureMethod_HMAC_SHA256_V4().sign(request, self.entity_key, self.entity_secret)
+        parameters = signed.url.parameters.copy()
+        parameters['X-Amz-Credential'] = parameters['X-Amz-Credential'].replace('aws4_request', 'aws5_request')
+        tampered = signed._clone(url=http.clone_url(signed.url, parameters=parameters))
+        self.assertRaises(auth.UnauthenticatedException, self.authenticator.authenticate, tampered)
+
+    def test_replayed_request(self):
+        request = self.signed_request()
+        self.assertEquals(self.authenticator.authenticate(request), self.entity)
+        self.assertRaises(auth.UnauthenticatedException, self.authenticator.authenticate, request)
+
     # Authorizer tests
 
     def test_prepare(self):
@@ -553,6 +1530,19 @@ class AWSAuthTests(AWSTests):
             self.signed_request(request, key=self.aws_key, secret=self.aws_secret, timestamp=authorized.url.parameters['Timestamp']).url.parameters['Signature']
         )
 
+    def test_prepare_v4(self):
+        self.authorizer.signature_method = auth.aws.SignatureMethod_HMAC_SHA256_V4()
+        request = self.signed_request()
+        entity = self.authenticator.authenticate(request)
+        authorized = self.authorizer.prepare(entity, request)
+        for parameter in ['Signature', 'AWSAccessKeyId', 'SignatureMethod', 'SignatureVersion', 'Timestamp']:
+            self.assertFalse(parameter in authorized.url.parameters)
+        self.assertTrue(authorized.url.parameters['X-Amz-Credential'].startswith(self.aws_key + '/'))
+        self.assertEquals(
+            authorized.url.parameters['X-Amz-Signature'],
+            auth.aws.SignatureMethod_HMAC_SHA256_V4().build_signature(authorized, self.aws_secret),
+        )
+
     def test_authorized(self):
         request = self.signed_request()
         entity = self.authenticator.authenticate(request)
@@ -572,7 +1562,96 @@ class AWSAuthTests(AWSTests):
 
 
 class CredentialTests(unittest.TestCase):
-    pass
+    def setUp(self):
+        self.credentials = [
+            credentials.Credential('snarf@example.com', 'snarf', 'sn4rf'),
+            credentials.Credential('snarf@example.com', 'snarf2', 'sn4rf2'),
+            credentials.Credential('lion-o@example.com', 'lion-o', 'l10n0'),
+        ]
+
+    def test_static_store(self):
+        store = credentials.StaticCredentialStore(self.credentials)
+        self.assertEquals(store.for_key('lion-o'), self.credentials[2])
+        self.assertEquals(store.for_key('cheetara'), None)
+        self.assertEquals(store.for_entity('snarf@example.com'), self.credentials[:2])
+        self.assertEquals(store.for_entity('cheetara@example.com'), [])
+
+    def test_file_store(self):
+        fd, filename = tempfile.mkstemp()
+        try:
+            os.write(fd, 'CREDENTIALS = [%r]\n' % (tuple(self.credentials[0]),))
+            os.close(fd)
+            # The file is read straight away, not just once it changes.
+            store = credentials.FileCredentialStore(self.credentials[1:], filename=filename, interval=0)
+            self.assertEquals(store.for_key('snarf'), self.credentials[0])
+            self.assertEquals(store.for_key('lion-o'), None)
+            self.assertFalse(store.check())
+
+            open(filename, 'w').write('CREDENTIALS = [%r]\n' % (tuple(self.credentials[2]),))
+            os.utime(filename, (time.time() + 10, time.time() + 10))
+            self.assertTrue(store.check())
+            self.assertEquals(store.for_key('lion-o'), self.credentials[2])
+            self.assertEquals(store.for_key('snarf'), None)
+
+            # A broken file leaves the old credentials in place.
+            open(filename, 'w').write('CREDENTIALS = [')
+            os.utime(filename, (time.time() + 20, time.time() + 20))
+            self.assertFalse(store.check())
+            self.assertEquals(store.for_key('lion-o'), self.credentials[2])
+
+            # So does one that doesn't set CREDENTIALS at all.
+            open(filename, 'w').write('CREDENTAILS = []\n')
+            os.utime(filename, (time.time() + 30, time.time() + 30))
+            self.assertFalse(store.check())
+            self.assertEquals(store.for_key('lion-o'), self.credentials[2])
+        finally:
+            os.unlink(filename)
+
+    def test_file_store_needs_its_own_file(self):
+        self.assertRaises(ValueError, credentials.FileCredentialStore, self.credentials, interval=0)
+        fd, filename = tempfile.mkstemp()
+        os.close(fd)
+        config = os.environ.get('GOLDENGATE_CONFIG')
+        os.environ['GOLDENGATE_CONFIG'] = filename
+        try:
+            self.assertRaises(ValueError, credentials.FileCredentialStore, self.credentials, filename=filename, interval=0)
+        finally:
+            if config is None:
+                del os.environ['GOLDENGATE_CONFIG']
+            else:
+                os.environ['GOLDENGATE_CONFIG'] = config
+            os.unlink(filename)
+
+    def test_kv_store(self):
+        store = kvcredentials.KVCredentialStore(self.credentials, poll_interval=0)
+        self.assertEquals(store.for_key('lion-o'), self.credentials[2])
+        self.assertEquals(store.for_entity('snarf@example.com'), self.credentials[:2])
+        self.assertEquals(store.for_key('cheetara'), None)
+
+        cheetara = credentials.Credential('cheetara@example.com', 'cheetara', 'ch33t4r4')
+        store.add(cheetara)
+        self.assertEquals(store.for_key('cheetara'), cheetara)
+        self.assertEquals(store.for_entity('cheetara@example.com'), [cheetara])
+        store.remove('cheetara')
+        self.assertEquals(store.for_key('cheetara'), None)
+        self.assertEquals(store.for_entity('cheetara@example.com'), [])
+
+    def test_kv_store_caches(self):
+        store = kvcredentials.KVCredentialStore(self.credentials, poll_interval=3600)
+        other = kvcredentials.KVCredentialStore(poll_interval=0)
+        self.assertEquals(store.for_key('mumm-ra'), None)
+        self.assertEquals(store.for_key('lion-o'), self.credentials[2])
+
+        mumm_ra = credentials.Credential('mumm-ra@example.com', 'mumm-ra', 'mumm-ra')
+        other.add(mumm_ra)
+        other.remove('lion-o')
+        # Until it checks the version stamp the first store has no idea.
+        self.assertEquals(store.for_key('mumm-ra'), None)
+        self.assertEquals(store.for_key('lion-o'), self.credentials[2])
+        store.next_poll = 0
+        self.assertEquals(store.for_key('mumm-ra'), mumm_ra)
+        self.assertEquals(store.for_key('lion-o'), None)
+        other.remove('mumm-ra')
 
 
 class PolicyTests(GGTestCase):
@@ -580,6 +1659,783 @@ class PolicyTests(GGTestCase):
         request = http.Request('get', 'http://example.com/', [], '', StartResponse())
         self.assertRaises(policy.MissingPolicyException, policy.Policy.for_request, 'foo',  request, [])
 
+    def test_policy_index(self):
+        request = auth.aws.Request('GET', http.URL('http', 'example.com', '/', {'Action': 'RunInstances'}), [], '', None)
+        policies = [
+            policy.action('DescribeInstances', True),
+            policy.action('RunInstances', False, entities=['foo']),
+            policy.AllowPolicy(policy.AnyMatcher([policy.EntityMatcher(['bar']), policy.AWSActionMatcher('TerminateInstances')])),
+            policy.action('RunInstances', True),
+            policy.deny(),
+        ]
+        for entity, action, expected in [
+            ('foo', 'RunInstances', 1),
+            ('bar', 'RunInstances', 2),
+            ('baz', 'RunInstances', 3),
+            ('baz', 'TerminateInstances', 2),
+            ('baz', 'DescribeInstances', 0),
+            ('baz', 'RebootInstances', 4),
+        ]:
+            request.url = http.clone_url(request.url, parameters={'Action': action})
+            self.assertTrue(policy.Policy.for_request(entity, request, policies) is policies[expected])
+        index = policy.PolicyIndex(policies)
+        self.assertTrue(policy.PolicyIndex.of(index) is index)
+
+    def test_policy_index_overridden_applies_to(self):
+        class RunOrTerminate(policy.DenyPolicy):
+            def applies_to(self, entity, request):
+                return request.aws_action in ('RunInstances', 'TerminateInstances')
+        class VIPMatcher(policy.EntityMatcher):
+            def matches(self, entity, request):
+                return entity == 'lion-o'
+        request = auth.aws.Request('GET', http.URL('http', 'example.com', '/', {'Action': 'TerminateInstances'}), [], '', None)
+        policies = [
+            RunOrTerminate(policy.AWSActionMatcher('RunInstances')),
+            policy.allow(),
+        ]
+        self.assertEquals(policy.constraints(policies[0]), (None, None))
+        self.assertTrue(policy.Policy.for_request('foo', request, policies) is policies[0])
+        self.assertFalse(policy.Policy.authorize('foo', request, policies))
+        policies = [
+            policy.DenyPolicy(VIPMatcher(['foo'])),
+            policy.allow(),
+        ]
+        self.assertEquals(policy.constraints(policies[0]), (None, None))
+        self.assertTrue(policy.Policy.for_request('lion-o', request, policies) is policies[0])
+
+    def test_request_without_action(self):
+        request = auth.aws.Request('GET', http.URL('http', 'example.com', '/', {'InstanceType': 'm1.small'}), [], '', None)
+        self.assertEquals(request.aws_action, None)
+        policies = [
+            policy.action('RunInstances', True),
+            policy.AllowPolicy(policy.AWSActionGlobMatcher('Describe*')),
+            policy.AllowPolicy(policy.ParameterMatcher('InstanceType', 'm1.large')),
+            policy.deny(),
+        ]
+        self.assertTrue(policy.Policy.for_request('foo', request, policies) is policies[3])
+        self.assertFalse(policy.Policy.authorize('foo', request, policies))
+        self.assertTrue(policy.Policy.authorize('foo', request, policies[:1] + [policy.allow()]))
+
+    def test_policy_decisions_are_cached(self):
+        class CountingPolicy(policy.AllowPolicy):
+            cacheable = True
+            grants = 0
+            def grant(self, entity, request):
+                CountingPolicy.grants += 1
+                return True
+        request = auth.aws.Request('GET', http.URL('http', 'example.com', '/', {'Action': 'RunInstances'}), [], '', None)
+        policies = [CountingPolicy(policy.AWSActionMatcher('RunInstances')), policy.deny()]
+        index = policy.PolicyIndex(policies)
+        self.assertTrue(policy.Policy.authorize('foo', request, index))
+        self.assertTrue(policy.Policy.authorize('foo', request, index))
+        self.assertEquals(CountingPolicy.grants, 1)
+        self.assertEquals(index.attributes, ('aws_action',))
+
+        request.url = http.clone_url(request.url, parameters={'Action': 'TerminateInstances'})
+        self.assertFalse(policy.Policy.authorize('foo', request, index))
+
+    def test_policy_index_per_snapshot(self):
+        class CountingPolicy(policy.AllowPolicy):
+            cacheable = True
+            grants = 0
+            def grant(self, entity, request):
+                CountingPolicy.grants += 1
+                return True
+        request = auth.aws.Request('GET', http.URL('http', 'example.com', '/', {'Action': 'RunInstances'}), [], '', None)
+        snapshot = settings.__dict__
+        try:
+            settings.install(settings.build({'policies': [CountingPolicy(policy.AWSActionMatcher('RunInstances')), policy.deny()]}))
+            self.assertTrue(policy.Policy.authorize('foo', request))
+            index = settings.policy_index
+            self.assertTrue(policy.Policy.authorize('foo', request))
+            self.assertEquals(CountingPolicy.grants, 1)
+            self.assertTrue(settings.policy_index is index)
+
+            # Replacing the policies starts over.
+            policies = list(settings.policies)
+            policies[1] = policy.allow()
+            settings.set('policies', policies)
+            self.assertTrue(policy.Policy.authorize('foo', request))
+            self.assertEquals(CountingPolicy.grants, 2)
+            self.assertFalse(settings.policy_index is index)
+        finally:
+            settings.install(snapshot)
+
+    def test_policy_decisions_are_cached_by_parameter(self):
+        class CountingPolicy(policy.AllowPolicy):
+            cacheable = True
+            grants = 0
+            def grant(self, entity, request):
+                CountingPolicy.grants += 1
+                return True
+        request = auth.aws.Request('GET', http.URL('http', 'example.com', '/', {'Action': 'RunInstances', 'InstanceType': 'm1.small'}), [], '', None)
+        policies = policy.PolicyIndex([CountingPolicy(policy.AllMatcher([policy.AWSActionMatcher('RunInstances'), policy.ParameterMatcher('InstanceType', 'm1.small')])), policy.deny()])
+        self.assertEquals(policies.attributes, ('aws_action', 'parameters.InstanceType'))
+        self.assertTrue(policy.Policy.authorize('foo', request, policies))
+        self.assertTrue(policy.Policy.authorize('foo', request, policies))
+        self.assertEquals(CountingPolicy.grants, 1)
+        request.url = http.clone_url(request.url, parameters={'Action': 'RunInstances', 'InstanceType': 'm1.large'})
+        self.assertFalse(policy.Policy.authorize('foo', request, policies))
+
+    def test_stateful_subclasses_are_not_cached(self):
+        class BusinessHours(policy.AllowPolicy):
+            open = True
+            def grant(self, entity, request):
+                return self.open
+        class Suspendable(policy.EntityMatcher):
+            suspended = False
+            def matches(self, entity, request):
+                return not self.suspended and entity in self.entities
+        request = auth.aws.Request('GET', http.URL('http', 'example.com', '/', {'Action': 'RunInstances'}), [], '', None)
+        hours = BusinessHours(policy.AWSActionMatcher('RunInstances'))
+        index = policy.PolicyIndex([hours, policy.deny()])
+        self.assertTrue(policy.Policy.authorize('foo', request, index))
+        hours.open = False
+        self.assertFalse(policy.Policy.authorize('foo', request, index))
+
+        suspendable = Suspendable(['foo'])
+        index = policy.PolicyIndex([policy.AllowPolicy(suspendable), policy.deny()])
+        self.assertEquals(index.attributes, None)
+        self.assertTrue(policy.Policy.authorize('foo', request, index))
+        suspendable.suspended = True
+        self.assertFalse(policy.Policy.authorize('foo', request, index))
+
+    def test_uncacheable_policy_decisions(self):
+        class CountingPolicy(policy.AllowPolicy):
+            cacheable = False
+            grants = 0
+            def grant(self, entity, request):
+                CountingPolicy.grants += 1
+                return True
+        request = auth.aws.Request('GET', http.URL('http', 'example.com', '/', {'Action': 'RunInstances'}), [], '', None)
+        policies = [CountingPolicy(policy.AlwaysMatcher())]
+        self.assertTrue(policy.Policy.authorize('foo', request, policies))
+        self.assertTrue(policy.Policy.authorize('foo', request, policies))
+        self.assertEquals(CountingPolicy.grants, 2)
+
+    def test_policy_index_patterns(self):
+        request = auth.aws.Request('GET', http.URL('http', 'example.com', '/', {'Action': 'RunInstances'}), [], '', None)
+        policies = [
+            policy.action('Describe*', True),
+            policy.AllowPolicy(policy.AllMatcher([policy.EntityMatcher(['foo']), policy.AWSActionRegexMatcher('(Run|Stop)Instances')])),
+            policy.AllowPolicy(policy.AnyMatcher([policy.AWSActionMatcher('RebootInstances'), policy.AWSActionGlobMatcher('Stop*')])),
+            policy.deny(),
+        ]
+        index = policy.PolicyIndex(policies)
+        for entity, action, expected, candidates in [
+            ('foo', 'DescribeImages', 0, 2),
+            ('foo', 'RunInstances', 1, 2),
+            ('bar', 'RunInstances', 3, 1),
+            ('bar', 'StopInstances', 2, 2),
+            ('bar', 'RebootInstances', 2, 2),
+            ('bar', 'TerminateInstances', 3, 1),
+        ]:
+            request.url = http.clone_url(request.url, parameters={'Action': action})
+            self.assertTrue(policy.Policy.for_request(entity, request, index) is policies[expected])
+            self.assertEquals(len(index.candidates(action, entity)), candidates)
+
+    def test_policy_index_compiles_matchers(self):
+        request = auth.aws.Request('GET', http.URL('http', 'example.com', '/', {'Action': 'RunInstances'}), [], '', None)
+        matcher = policy.AllMatcher([policy.AllMatcher([policy.EntityMatcher(['foo'])]), policy.AWSActionMatcher('RunInstances')])
+        policies = [policy.AllowPolicy(matcher), policy.deny()]
+        self.assertTrue(policy.Policy.for_request('foo', request, policies) is policies[0])
+        self.assertTrue(policy.Policy.for_request('bar', request, policies) is policies[1])
+        # The policy's own matcher isn't touched.
+        self.assertTrue(policies[0].matcher is matcher)
+
+    def test_matcher_constraints(self):
+        self.assertEquals(policy.action('RunInstances', True, entities=['foo']).constraints(), (frozenset(['RunInstances']), frozenset(['foo'])))
+        self.assertEquals(policy.AnyMatcher([policy.AWSActionMatcher('RunInstances'), policy.NotMatcher(policy.AlwaysMatcher())]).constraints(), (None, None))
+        self.assertEquals(policy.EntityMatcher('foo').constraints(), (None, None))
+        self.assertEquals(policy.AllMatcher([policy.AWSActionMatcher('RunInstances'), policy.AWSActionGlobMatcher('Run*')]).constraints(), (frozenset(['RunInstances']), None))
+        self.assertEquals(policy.AnyMatcher([policy.AWSActionMatcher('RunInstances'), policy.AWSActionGlobMatcher('Stop*')]).constraints(),
+                          (policy.ActionPatterns(actions=['RunInstances'], globs=['Stop*']), None))
+
+
+class SchedulerTests(unittest.TestCase):
+    def test_timers_run_in_order(self):
+        scheduler = goldengate_scheduler.Scheduler()
+        ran = []
+        done = threading.Event()
+        scheduler.call_later(0.03, lambda: (ran.append(3), done.set()))
+        scheduler.call_later(0.01, lambda: ran.append(1))
+        scheduler.call_later(0.02, lambda: ran.append(2))
+        cancelled = scheduler.call_later(0.015, lambda: ran.append('cancelled'))
+        cancelled.cancel()
+        done.wait(1)
+        scheduler.stop()
+        self.assertEquals(ran, [1, 2, 3])
+
+    def test_every(self):
+        scheduler = goldengate_scheduler.Scheduler()
+        ran = []
+        done = threading.Event()
+        def run():
+            ran.append(True)
+            if len(ran) == 3:
+                done.set()
+        scheduler.every(0.01, run)
+        done.wait(1)
+        scheduler.stop()
+        self.assertTrue(len(ran) >= 3)
+
+
+class TimeLockPolicyTests(GGTestCase):
+    class Broker(object):
+        def __init__(self):
+            self.sent = []
+        def send(self, notification):
+            self.sent.append(notification)
+
+    def setUp(self):
+        self.broker = self.Broker()
+        self.request = http.Request('GET', http.URL('http', 'example.com', '/', {}), [], '', StartResponse())
+        self.poll_interval = settings.time_lock_poll_interval
+        settings.set('time_lock_poll_interval', 0)
+
+    def tearDown(self):
+        settings.set('time_lock_poll_interval', self.poll_interval)
+
+    def policy(self, duration):
+        return policy.TimeLockPolicy(policy.AlwaysMatcher(), duration, self.broker, '{{ request_uuid }}', ['snarf@example.com'])
+
+    def test_lock_expires(self):
+        self.assertTrue(self.policy(0.01).grant('snarf', self.request))
+        self.assertEquals(len(self.broker.sent), 1)
+        self.assertEquals(policy.TimeLockPolicy.waiters.events, {})
+
+    def test_cancel_wakes_request(self):
+        time_lock = self.policy(60)
+        result = []
+        thread = threading.Thread(target=lambda: result.append(time_lock.grant('snarf', self.request)))
+        thread.start()
+        while not self.broker.sent:
+            time.sleep(0.001)
+        start = time.time()
+        policy.TimeLockPolicy.cancel(self.broker.sent[0].body)
+        thread.join(5)
+        self.assertEquals(result, [False])
+        self.assertTrue(time.time() - start < 5)
+
+    class PendingBroker(object):
+        "Delivers notifications only when the test says so."
+        def __init__(self):
+            self.sent = []
+            self.deliveries = []
+        def send(self, notification):
+            self.sent.append(notification)
+            self.deliveries.append(notifications.Delivery())
+            return self.deliveries[-1]
+
+    def test_undelivered_notification_cancels(self):
+        broker = self.PendingBroker()
+        time_lock = policy.TimeLockPolicy(policy.AlwaysMatcher(), 60, broker, '{{ request_uuid }}', [])
+        result = []
+        thread = threading.Thread(target=lambda: result.append(time_lock.grant('snarf', self.request)))
+        thread.start()
+        while not broker.deliveries:
+            time.sleep(0.001)
+        broker.deliveries[0].settle(False)
+        thread.join(5)
+        self.assertEquals(result, [False])
+        self.assertTrue(policy.TimeLock.get(broker.sent[0].body).cancelled)
+
+    def test_notification_not_delivered_in_time(self):
+        broker = self.PendingBroker()
+        time_lock = policy.TimeLockPolicy(policy.AlwaysMatcher(), 0.01, broker, '{{ request_uuid }}', [])
+        self.assertFalse(time_lock.grant('snarf', self.request))
+        # Delivering it afterwards doesn't change anything.
+        broker.deliveries[0].settle(True)
+        self.assertFalse(policy.TimeLock.get(broker.sent[0].body).cancelled)
+
+    def test_cancelled_before_waiting(self):
+        class Broker(object):
+            def send(self, notification):
+                policy.TimeLockPolicy.cancel(notification.body)
+        time_lock = policy.TimeLockPolicy(policy.AlwaysMatcher(), 60, Broker(), '{{ request_uuid }}', [])
+        start = time.time()
+        self.assertFalse(time_lock.grant('snarf', self.request))
+        self.assertTrue(time.time() - start < 5)
+
+    def test_poll_cancellations(self):
+        time_lock = self.policy(60)
+        result = []
+        thread = threading.Thread(target=lambda: result.append(time_lock.grant('snarf', self.request)))
+        thread.start()
+        while not self.broker.sent:
+            time.sleep(0.001)
+        # Cancelled by some other process.
+        timelock = policy.TimeLock.get(self.broker.sent[0].body)
+        timelock.cancelled = True
+        timelock.save()
+        policy.TimeLockPolicy.waiters.poll()
+        thread.join(5)
+        self.assertEquals(result, [False])
+
+    def test_published_cancellation_wakes_request(self):
+        settings.set('time_lock_poll_interval', 0.01)
+        time_lock = self.policy(60)
+        result = []
+        thread = threading.Thread(target=lambda: result.append(time_lock.grant('snarf', self.request)))
+        thread.start()
+        while not self.broker.sent:
+            time.sleep(0.001)
+        while self.broker.sent[0].body not in policy.TimeLockPolicy.waiters.events:
+            time.sleep(0.001)
+        # The backend notifies waiters, so nothing polls.
+        self.assertTrue(policy.TimeLockPolicy.waiters.subscribed)
+        self.assertTrue(policy.TimeLockPolicy.waiters.thread is None)
+        # Cancelled by some other process, which publishes it.
+        request_uuid = self.broker.sent[0].body
+        timelock = policy.TimeLock.get(request_uuid)
+        timelock.cancelled = True
+        timelock.save()
+        policy.TimeLock.storage_backend.publish(policy.TimeLockPolicy.waiters.channel, request_uuid)
+        thread.join(5)
+        self.assertEquals(result, [False])
+
+    def test_polling_thread(self):
+        # A backend that can't notify waiters.
+        waiters = policy.TimeLockPolicy.waiters
+        subscribed = waiters.subscribed
+        waiters.subscribed = False
+        try:
+            settings.set('time_lock_poll_interval', 0.01)
+            time_lock = self.policy(60)
+            result = []
+            thread = threading.Thread(target=lambda: result.append(time_lock.grant('snarf', self.request)))
+            thread.start()
+            while not self.broker.sent or self.broker.sent[0].body not in waiters.events:
+                time.sleep(0.001)
+            self.assertFalse(waiters.thread is None)
+            timelock = policy.TimeLock.get(self.broker.sent[0].body)
+            timelock.cancelled = True
+            timelock.save()
+            thread.join(5)
+            self.assertEquals(result, [False])
+        finally:
+            waiters.subscribed = subscribed
+        # The polling thread stops once nothing is waiting.
+        for i in range(500):
+            if waiters.thread is None:
+                break
+            time.sleep(0.01)
+        self.assertTrue(waiters.thread is None)
+
+
+class TwoPersonPolicyTests(GGTestCase):
+    def setUp(self):
+        self.broker = TimeLockPolicyTests.Broker()
+        self.request = http.Request('GET', http.URL('http', 'example.com', '/', {}), [], '', StartResponse())
+        self.poll_interval = settings.approval_poll_interval
+        settings.set('approval_poll_interval', 0)
+        settings.set('institutional_entities', ['hudson'])
+
+    def tearDown(self):
+        settings.set('approval_poll_interval', self.poll_interval)
+        settings.set('institutional_entities', [])
+
+    def policy(self, timeout, **kwargs):
+        return policy.TwoPersonPolicy(policy.AlwaysMatcher(), timeout, self.broker, '{{ request_uuid }}', [], **kwargs)
+
+    def start(self, two_person):
+        result = []
+        thread = threading.Thread(target=lambda: result.append(two_person.grant('snarf', self.request)))
+        thread.start()
+        while not self.broker.sent:
+            time.sleep(0.001)
+        return thread, result, self.broker.sent[0].body
+
+    def test_approval_wakes_request(self):
+        thread, result, request_uuid = self.start(self.policy(60))
+        self.assertRaises(policy.ApprovalException, policy.TwoPersonPolicy.approve, request_uuid, 'snarf')
+        self.assertRaises(policy.ApprovalException, policy.TwoPersonPolicy.approve, request_uuid, 'hudson')
+        self.assertRaises(KeyError, policy.TwoPersonPolicy.approve, 'nope', 'lion-o')
+        policy.TwoPersonPolicy.approve(request_uuid, 'lion-o')
+        thread.join(5)
+        self.assertEquals(result, [True])
+        self.assertRaises(policy.ApprovalException, policy.TwoPersonPolicy.approve, request_uuid, 'cheetara')
+
+    def test_approvers(self):
+        thread, result, request_uuid = self.start(self.policy(60, approvers=['cheetara']))
+        self.assertRaises(policy.ApprovalException, policy.TwoPersonPolicy.approve, request_uuid, 'lion-o')
+        policy.TwoPersonPolicy.approve(request_uuid, 'cheetara')
+        thread.join(5)
+        self.assertEquals(result, [True])
+
+    def test_timeout(self):
+        self.assertFalse(self.policy(0.01).grant('snarf', self.request))
+        self.assertRaises(policy.ApprovalException, policy.TwoPersonPolicy.approve, self.broker.sent[0].body, 'lion-o')
+
+    def test_approve_route(self):
+        gg = goldengate.GoldenGate(authenticator=MockAuthenticator, authorizer=MockAuthorizer, auditor=MockAuditor, proxy=MockProxy)
+        thread, result, request_uuid = self.start(self.policy(60))
+        approve = http.Request('GET', http.URL('http', 'example.com', '/~/approve/' + request_uuid, {}), [], '', StartResponse())
+        gg.authenticator.entity = 'hudson'
+        self.assertRaises(auth.UnauthorizedException, gg.handle, approve)
+        gg.authenticator.entity = 'lion-o'
+        self.assertEquals(gg.handle(approve).status, 200)
+        thread.join(5)
+        self.assertEquals(result, [True])
+
+
+class DeferredTests(GGTestCase):
+    class Authorizer(MockAuthorizer):
+        def prepare(self, entity, request):
+            self.entity = entity
+            self.request = request
+            return request
+
+    class Proxy(MockProxy):
+        response = http.Response(200, [('x-spirit-animal', 'kangaroo')], 'done and done')
+
+    def setUp(self):
+        settings.set('deferred_executor', True)
+        self.goldengate = goldengate.GoldenGate(authenticator=MockAuthenticator, authorizer=self.Authorizer, auditor=MockAuditor, proxy=self.Proxy)
+        self.goldengate.authenticator.entity = 'snarf'
+        self.broker = TimeLockPolicyTests.Broker()
+        self.time_lock = policy.TimeLockPolicy(policy.AlwaysMatcher(), 3600, self.broker, '{{ request_uuid }}', [], defer=True)
+        url = http.URL('http', 'example.com', '/', {'Action': 'TerminateInstances', 'InstanceId.1': 'i-1234'})
+        self.request = http.Request('POST', url, [('host', 'example.com')], '', StartResponse())
+        self.executors = [self.goldengate.executor]
+        self.deferred = []
+
+    def tearDown(self):
+        for request_uuid in self.deferred:
+            deferred.cancel(request_uuid)
+        for executor in self.executors:
+            executor.stop()
+        settings.set('deferred_executor', False)
+
+    def defer(self):
+        try:
+            self.time_lock.grant('snarf', self.request)
+        except deferred.DeferredException, e:
+            self.deferred.append(e.request_uuid)
+            self.assertEquals(e.status, 202)
+            self.assertEquals(dict(e.headers)['Location'], '/~/result/' + e.request_uuid)
+            return e.request_uuid
+        self.fail('Request was not deferred')
+
+    def result(self, request_uuid):
+        url = http.URL('http', 'example.com', '/~/result/' + request_uuid, {})
+        return self.goldengate.handle(http.Request('GET', url, [], '', StartResponse()))
+
+    def test_deferred_request(self):
+        request_uuid = self.defer()
+        self.assertTrue(request_uuid in deferred.DeferredQueue.pending())
+        self.assertEquals(self.result(request_uuid).status, 202)
+
+        self.goldengate.executor.execute(request_uuid)
+        self.assertEquals(self.goldengate.authorizer.entity, 'snarf')
+        self.assertEquals(self.goldengate.authorizer.request.url, self.request.url)
+        self.assertFalse(request_uuid in deferred.DeferredQueue.pending())
+        response = self.result(request_uuid)
+        self.assertEquals(response.status, 200)
+        self.assertEquals(response.body, 'done and done')
+        self.assertEquals(dict(response.headers)['x-spirit-animal'], 'kangaroo')
+
+    def test_deferred_until_notified(self):
+        broker = TimeLockPolicyTests.PendingBroker()
+        self.time_lock.notification_broker = broker
+        request_uuid = self.defer()
+        self.assertEquals(deferred.result(request_uuid).execute_at, None)
+        broker.deliveries[0].settle(True)
+        job = deferred.result(request_uuid)
+        self.assertEquals(job.execute_at, job.expires_at)
+        self.assertEquals(self.goldengate.executor.scheduled[request_uuid].when, job.execute_at)
+
+        request_uuid = self.defer()
+        broker.deliveries[1].settle(False)
+        self.assertEquals(deferred.result(request_uuid).state, deferred.CANCELLED)
+        self.assertEquals(self.result(request_uuid).status, 410)
+
+    def test_cancelled_request(self):
+        request_uuid = self.defer()
+        policy.TimeLockPolicy.cancel(request_uuid)
+        self.assertFalse(request_uuid in deferred.DeferredQueue.pending())
+        self.goldengate.executor.execute(request_uuid)
+        self.assertEquals(self.goldengate.authorizer.request, None)
+        self.assertEquals(self.result(request_uuid).status, 410)
+
+    def test_result_for_someone_else(self):
+        request_uuid = self.defer()
+        self.goldengate.authenticator.entity = 'lion-o'
+        self.assertEquals(self.result(request_uuid).status, 404)
+        self.assertEquals(self.result('nope').status, 404)
+
+    def test_two_person_deferred_request(self):
+        two_person = policy.TwoPersonPolicy(policy.AlwaysMatcher(), 3600, self.broker, '{{ request_uuid }}', [], defer=True)
+        try:
+            two_person.grant('snarf', self.request)
+        except deferred.DeferredException, e:
+            request_uuid = e.request_uuid
+        self.deferred.append(request_uuid)
+        # Only its expiry is scheduled until it's approved.
+        self.assertEquals(self.goldengate.executor.scheduled[request_uuid].when, deferred.result(request_uuid).expires_at)
+        policy.TwoPersonPolicy.approve(request_uuid, 'lion-o')
+        # Once approved it's due straight away, so the executor sends it.
+        deadline = time.time() + 5
+        while deferred.result(request_uuid).state != deferred.DONE and time.time() < deadline:
+            time.sleep(0.001)
+        self.assertEquals(self.result(request_uuid).status, 200)
+
+    def test_two_person_deferred_request_expires(self):
+        two_person = policy.TwoPersonPolicy(policy.AlwaysMatcher(), 0.01, self.broker, '{{ request_uuid }}', [], defer=True)
+        try:
+            two_person.grant('snarf', self.request)
+        except deferred.DeferredException, e:
+            request_uuid = e.request_uuid
+        self.deferred.append(request_uuid)
+        deadline = time.time() + 5
+        # The queue is updated after the state is saved.
+        while request_uuid in deferred.DeferredQueue.pending() and time.time() < deadline:
+            time.sleep(0.001)
+        self.assertEquals(deferred.result(request_uuid).state, deferred.EXPIRED)
+        self.assertFalse(request_uuid in deferred.DeferredQueue.pending())
+        self.assertEquals(self.result(request_uuid).status, 410)
+        self.assertEquals(self.goldengate.authorizer.request, None)
+        self.assertRaises(policy.ApprovalException, policy.TwoPersonPolicy.approve, request_uuid, 'lion-o')
+
+    def test_executor_is_opt_in(self):
+        settings.set('deferred_executor', config.DeferredExecutor.default)
+        gg = goldengate.GoldenGate(authenticator=MockAuthenticator, authorizer=MockAuthorizer, auditor=MockAuditor, proxy=MockProxy)
+        self.assertEquals(gg.executor, None)
+
+    def test_recover(self):
+        request_uuid = self.defer()
+        executor = deferred.Executor(self.goldengate.authorizer, self.goldengate.proxy, self.goldengate.auditor)
+        self.executors.append(executor)
+        executor.recover()
+        self.assertTrue(request_uuid in executor.scheduled)
+        executor.execute(request_uuid)
+        self.assertEquals(self.result(request_uuid).status, 200)
+
+    def test_poll_for_requests_from_other_processes(self):
+        executor = deferred.Executor(self.goldengate.authorizer, self.goldengate.proxy, self.goldengate.auditor, poll_interval=0.01)
+        self.executors.append(executor)
+        executor.start()
+        self.assertFalse(executor.poller is None)
+        # Queued by another process.
+        deferred.DeferredRequest(id='snarf', entity='snarf', request=self.request.to_dict(), execute_at=time.time() + 3600).save()
+        deferred.DeferredQueue.update(lambda ids: ids + ('snarf',))
+        self.deferred.append('snarf')
+        deadline = time.time() + 5
+        while 'snarf' not in executor.scheduled and time.time() < deadline:
+            time.sleep(0.001)
+        self.assertTrue('snarf' in executor.scheduled)
+        executor.stop()
+        executor.poller.join(5)
+        self.assertFalse(executor.poller.is_alive())
+
+    def test_requests_are_claimed(self):
+        request_uuid = self.defer()
+        deferred.release(request_uuid)
+        other = deferred.Executor(self.goldengate.authorizer, self.goldengate.proxy, self.goldengate.auditor)
+        self.assertTrue(other.claim(request_uuid))
+        self.goldengate.executor.execute(request_uuid)
+        self.assertEquals(self.goldengate.authorizer.request, None)
+        self.assertEquals(deferred.result(request_uuid).state, deferred.PENDING)
+
+    def test_recover_interrupted_requests(self):
+        claimed, unclaimed = self.defer(), self.defer()
+        for request_uuid in [claimed, unclaimed]:
+            job = deferred.result(request_uuid)
+            job.state = deferred.RUNNING
+            job.save()
+        self.goldengate.executor.claim(claimed)
+        # As if it had just started.
+        executor = deferred.Executor(self.goldengate.authorizer, self.goldengate.proxy, self.goldengate.auditor)
+        self.executors.append(executor)
+        executor.recover()
+        # Another executor may still be sending the claimed one.
+        self.assertEquals(deferred.result(claimed).state, deferred.RUNNING)
+        self.assertEquals(deferred.result(unclaimed).state, deferred.FAILED)
+        self.deferred.remove(claimed)
+        self.goldengate.executor.finish(deferred.result(claimed), deferred.FAILED, None)
+
+    def test_queue_updates_are_locked(self):
+        backend = deferred.DeferredQueue.storage_backend
+        # Held by another process.
+        self.assertTrue(backend.add_with_timeout(deferred.DeferredQueue.LOCK_KEY, True, 30))
+        thread = threading.Thread(target=deferred.DeferredQueue.update, args=(lambda ids: ids + ('snarf',),))
+        thread.start()
+        time.sleep(0.05)
+        self.assertFalse('snarf' in deferred.DeferredQueue.pending())
+        backend.delete(deferred.DeferredQueue.LOCK_KEY)
+        thread.join(5)
+        self.assertTrue('snarf' in deferred.DeferredQueue.pending())
+        self.assertFalse(backend.has_key(deferred.DeferredQueue.LOCK_KEY))
+        deferred.DeferredQueue.update(lambda ids: [i for i in ids if i != 'snarf'])
+
+    def test_abandoned_queue_lock_is_taken_over(self):
+        backend = deferred.DeferredQueue.storage_backend
+        self.assertTrue(backend.add_with_timeout(deferred.DeferredQueue.LOCK_KEY, True, 30))
+        timeout = deferred.DeferredQueue.LOCK_TIMEOUT
+        deferred.DeferredQueue.LOCK_TIMEOUT = 0.01
+        try:
+            deferred.DeferredQueue.update(lambda ids: ids + ('snarf',))
+        finally:
+            deferred.DeferredQueue.LOCK_TIMEOUT = timeout
+        self.assertTrue('snarf' in deferred.DeferredQueue.pending())
+        deferred.DeferredQueue.update(lambda ids: [i for i in ids if i != 'snarf'])
+
+    def test_policies_that_defer_without_an_executor_warn(self):
+        policies = [self.time_lock, policy.allow()]
+        self.assertTrue(deferred.check_policies(policies, None))
+        self.assertFalse(deferred.check_policies(policies, self.goldengate.executor))
+        self.assertFalse(deferred.check_policies([policy.allow()], None))
+
+
+class NotificationTests(unittest.TestCase):
+    class SMTP(object):
+        connections = []
+        def __init__(self, host, port):
+            self.sent = []
+            self.calls = []
+            self.disconnected = False
+            self.connections.append(self)
+        def ehlo(self):
+            self.calls.append('ehlo')
+        def starttls(self):
+            self.calls.append('starttls')
+        def login(self, username, password):
+            self.calls.append('login')
+        def sendmail(self, sender, recipients, message):
+            if self.disconnected:
+                raise smtplib.SMTPServerDisconnected()
+            self.sent.append((sender, recipients, message))
+            return {}
+        def quit(self):
+            self.calls.append('quit')
+        def close(self):
+            pass
+
+    def setUp(self):
+        self.SMTP.connections = []
+        self.broker = notifications.EmailNotificationBroker('gg@example.com', 'localhost', 25, username='gg', password='gg', idle_timeout=5)
+        self.broker.smtp_class = self.SMTP
+
+    def tearDown(self):
+        self.broker.stop()
+
+    def test_session_is_reused(self):
+        self.broker.send(notifications.Notification(['snarf@example.com', 'lion-o@example.com'], 'first'))
+        self.broker.send(notifications.Notification(['snarf@example.com'], 'second'))
+        self.broker.join()
+        self.assertEquals(len(self.SMTP.connections), 1)
+        smtp = self.SMTP.connections[0]
+        self.assertEquals(smtp.calls, ['ehlo', 'starttls', 'ehlo', 'login'])
+        self.assertEquals([recipients for _, recipients, _ in smtp.sent], [['snarf@example.com', 'lion-o@example.com'], ['snarf@example.com']])
+        self.assertTrue('To: snarf@example.com, lion-o@example.com' in smtp.sent[0][2])
+
+    def test_reconnect(self):
+        self.broker.send(notifications.Notification(['snarf@example.com'], 'first'))
+        self.broker.join()
+        self.SMTP.connections[0].disconnected = True
+        self.broker.send(notifications.Notification(['snarf@example.com'], 'second'))
+        self.broker.join()
+        self.assertEquals(len(self.SMTP.connections), 2)
+        self.assertEquals(len(self.SMTP.connections[1].sent), 1)
+
+    def test_retries(self):
+        class FlakyBroker(notifications.QueuedNotificationBroker):
+            attempts = 0
+            def deliver(self, worker, notification):
+                FlakyBroker.attempts += 1
+                if FlakyBroker.attempts < 3:
+                    raise Exception('nope')
+        broker = FlakyBroker(retries=5, backoff=resilience.Backoff(0.001, 0.001))
+        delivery = broker.send(notifications.Notification(['snarf@example.com'], 'hi'))
+        broker.join()
+        self.assertEquals(FlakyBroker.attempts, 3)
+        self.assertEquals(delivery.delivered, True)
+
+        # Giving up settles the delivery as failed.
+        FlakyBroker.attempts = -10
+        settled = []
+        delivery = broker.send(notifications.Notification(['snarf@example.com'], 'hi'))
+        delivery.then(settled.append)
+        broker.join()
+        broker.stop()
+        self.assertEquals(delivery.delivered, False)
+        self.assertEquals(settled, [delivery])
+
+
+class DigestNotificationTests(unittest.TestCase):
+    def setUp(self):
+        self.broker = TimeLockPolicyTests.Broker()
+
+    def test_digest(self):
+        digest = notifications.DigestNotificationBroker(self.broker, window=3600)
+        digest.send(notifications.Notification(['snarf@example.com', 'lion-o@example.com'], 'cancel one'))
+        digest.send(notifications.Notification(['lion-o@example.com', 'snarf@example.com'], 'cancel two'))
+        digest.send(notifications.Notification(['cheetara@example.com'], 'cancel three'))
+        self.assertEquals(self.broker.sent, [])
+        digest.flush_all()
+        sent = dict((tuple(notification.recipients), notification.body) for notification in self.broker.sent)
+        self.assertEquals(len(sent), 2)
+        self.assertEquals(sent[('cheetara@example.com',)], 'cancel three')
+        body = sent[('lion-o@example.com', 'snarf@example.com')]
+        self.assertTrue(body.startswith('2 requests'))
+        self.assertTrue('cancel one' in body and 'cancel two' in body)
+
+    def test_delivery(self):
+        class Broker(object):
+            deliveries = []
+            def send(self, notification):
+                self.deliveries.append(notifications.Delivery())
+                return self.deliveries[-1]
+        broker = Broker()
+        digest = notifications.DigestNotificationBroker(broker, window=3600)
+        one = digest.send(notifications.Notification(['snarf@example.com'], 'one'))
+        two = digest.send(notifications.Notification(['snarf@example.com'], 'two'))
+        digest.flush_all()
+        self.assertEquals((one.delivered, two.delivered), (None, None))
+        broker.deliveries[0].settle(False)
+        self.assertEquals((one.delivered, two.delivered), (False, False))
+        # Brokers that don't return a delivery have delivered by the time send returns.
+        digest = notifications.DigestNotificationBroker(self.broker, window=3600)
+        one = digest.send(notifications.Notification(['snarf@example.com'], 'one'))
+        digest.flush_all()
+        self.assertEquals(one.delivered, True)
+
+    def test_window(self):
+        digest = notifications.DigestNotificationBroker(self.broker, window=0.01)
+        digest.send(notifications.Notification(['snarf@example.com'], 'one'))
+        digest.send(notifications.Notification(['snarf@example.com'], 'two'))
+        deadline = time.time() + 5
+        while not self.broker.sent and time.time() < deadline:
+            time.sleep(0.005)
+        self.assertEquals(len(self.broker.sent), 1)
+        self.assertEquals(digest.pending, {})
+
+    def test_deadline(self):
+        digest = notifications.DigestNotificationBroker(self.broker, window=3600, margin=60)
+        # Too close to its deadline to hold on to at all.
+        digest.send(notifications.Notification(['snarf@example.com'], 'one', time.time() + 30))
+        self.assertEquals([notification.body for notification in self.broker.sent], ['one'])
+        # Held until shortly before the earliest deadline in the digest.
+        digest.send(notifications.Notification(['snarf@example.com'], 'two', time.time() + 7200))
+        self.assertTrue(digest.timers[('snarf@example.com',)].when > time.time() + 3000)
+        digest.send(notifications.Notification(['snarf@example.com'], 'three', time.time() + 60.05))
+        deadline = time.time() + 5
+        while len(self.broker.sent) < 2 and time.time() < deadline:
+            time.sleep(0.005)
+        self.assertEquals(len(self.broker.sent), 2)
+        self.assertTrue(self.broker.sent[1].body.startswith('2 requests'))
+        self.assertTrue(self.broker.sent[1].deadline - time.time() < 60.05)
+        self.assertEquals(digest.pending, {})
+
+    def test_max_entries(self):
+        digest = notifications.DigestNotificationBroker(self.broker, window=3600, max_entries=2)
+        digest.send(notifications.Notification(['snarf@example.com'], 'one'))
+        digest.send(notifications.Notification(['snarf@example.com'], 'two'))
+        self.assertEquals(len(self.broker.sent), 1)
+        digest.send(notifications.Notification(['snarf@example.com'], 'three'))
+        digest.flush_all()
+        self.assertEquals([notification.body for notification in self.broker.sent][1], 'three')
+
 
 class MatcherTests(GGTestCase):
     class MockAWSRequest(object):
@@ -605,6 +2461,195 @@ class MatcherTests(GGTestCase):
         self.assertFalse(policy.AnyMatcher([policy.NotMatcher(policy.AlwaysMatcher())]).matches(None, None))
         self.assertTrue(policy.AnyMatcher([policy.NotMatcher(policy.AlwaysMatcher()), policy.AlwaysMatcher()]).matches(None, None))
 
+    def test_aws_action_pattern_matchers(self):
+        describe = policy.AWSActionGlobMatcher('Describe*')
+        self.assertTrue(describe.matches(None, self.MockAWSRequest('DescribeInstances')))
+        self.assertFalse(describe.matches(None, self.MockAWSRequest('RunInstances')))
+        self.assertFalse(describe.matches(None, self.MockAWSRequest(None)))
+        self.assertTrue(policy.AWSActionGlobMatcher('?topInstances').matches(None, self.MockAWSRequest('StopInstances')))
+        self.assertFalse(policy.AWSActionGlobMatcher('Stop.*').matches(None, self.MockAWSRequest('StopInstances')))
+        regex = policy.AWSActionRegexMatcher('(Start|Stop)Instances')
+        self.assertTrue(regex.matches(None, self.MockAWSRequest('StartInstances')))
+        self.assertFalse(regex.matches(None, self.MockAWSRequest('StartInstancesNow')))
+
+    def test_parameter_matchers(self):
+        request = auth.aws.Request('GET', http.URL('http', 'example.com', '/', {
+            'Action': 'RunInstances', 'InstanceType': 'm1.small', 'ImageId': 'ami-1234', 'MaxCount': '3',
+            'InstanceId.1': 'i-1', 'InstanceId.2': 'i-2'}), [], '', None)
+        self.assertTrue(policy.ParameterMatcher('InstanceType', ['m1.small', 't1.micro']).matches(None, request))
+        self.assertFalse(policy.ParameterMatcher('InstanceType', 'm1.large').matches(None, request))
+        self.assertTrue(policy.ParameterMatcher('ImageId').matches(None, request))
+        self.assertFalse(policy.ParameterMatcher('KernelId').matches(None, request))
+        self.assertTrue(policy.ParameterMatcher('InstanceId.N', ['i-1', 'i-2', 'i-3']).matches(None, request))
+        self.assertFalse(policy.ParameterMatcher('InstanceId.N', ['i-1']).matches(None, request))
+        self.assertTrue(policy.ParameterGlobMatcher('ImageId', 'ami-*').matches(None, request))
+        self.assertFalse(policy.ParameterGlobMatcher('InstanceType', 'c1.*').matches(None, request))
+        self.assertTrue(policy.ParameterRangeMatcher('MaxCount', maximum=5).matches(None, request))
+        self.assertFalse(policy.ParameterRangeMatcher('MaxCount', minimum=4).matches(None, request))
+        self.assertFalse(policy.ParameterRangeMatcher('InstanceType', minimum=0).matches(None, request))
+        self.assertTrue(policy.ParameterCountMatcher('InstanceId.N', minimum=1, maximum=2).matches(None, request))
+        self.assertFalse(policy.ParameterCountMatcher('InstanceId.N', maximum=1).matches(None, request))
+        self.assertFalse(policy.ParameterMatcher('InstanceType').matches(None, self.MockAWSRequest('RunInstances')))
+        self.assertTrue(policy.ParameterMatcher('InstanceId.N', ['i-1'], quantifier='any').matches(None, request))
+        self.assertTrue(policy.ParameterGlobMatcher('InstanceId.N', '*-2', quantifier='any').matches(None, request))
+        self.assertFalse(policy.ParameterGlobMatcher('InstanceId.N', '*-2').matches(None, request))
+        self.assertTrue(policy.ParameterRangeMatcher('MaxCount', maximum=5, quantifier='any').matches(None, request))
+        self.assertRaises(ValueError, policy.ParameterMatcher, 'InstanceId.N', quantifier='some')
+
+    def test_parameter_deny_rule(self):
+        production = ['i-prod1', 'i-prod2']
+        policies = [
+            policy.DenyPolicy(policy.AllMatcher([policy.AWSActionMatcher('TerminateInstances'),
+                                                 policy.ParameterMatcher('InstanceId.N', production, quantifier='any')])),
+            policy.allow(),
+        ]
+        for ids, allowed in [(['i-dev1'], True), (['i-prod1'], False), (['i-dev1', 'i-prod2'], False)]:
+            parameters = dict(('InstanceId.%d' % (i + 1,), instance) for i, instance in enumerate(ids))
+            parameters['Action'] = 'TerminateInstances'
+            request = auth.aws.Request('GET', http.URL('http', 'example.com', '/', parameters), [], '', None)
+            self.assertEquals(policy.Policy.authorize('snarf', request, policies), allowed)
+
+    def test_action_automaton(self):
+        automaton = policy.ActionAutomaton()
+        automaton.add(0, policy.ActionPatterns(globs=['Describe*']))
+        automaton.add(1, policy.ActionPatterns(globs=['*Instances', 'Create?mage']))
+        automaton.add(2, policy.ActionPatterns(globs=['Describe*Attribute*']))
+        automaton.add(3, policy.ActionPatterns(actions=['RunInstances'], regexes=['Reboot.+']))
+        automaton.add(4, policy.ActionPatterns(globs=['*']))
+        for action, expected in [
+            ('DescribeInstances', [0, 1, 4]),
+            ('DescribeImageAttribute', [0, 2, 4]),
+            ('RunInstances', [1, 3, 4]),
+            ('CreateImage', [1, 4]),
+            ('RebootInstances', [1, 3, 4]),
+            ('Reboot', [4]),
+            ('', [4]),
+        ]:
+            self.assertEquals(sorted(automaton.match(action)), expected, action)
+
+    def test_compile_flattens_and_merges(self):
+        matcher = policy.compile_matcher(policy.AllMatcher([
+            policy.AllMatcher([policy.EntityMatcher(['foo', 'bar']), policy.AlwaysMatcher()]),
+            policy.AllMatcher([policy.EntityMatcher(['bar', 'baz']), policy.AWSActionMatcher('RunInstances')]),
+        ]))
+        self.assertTrue(isinstance(matcher, policy.AdaptiveAllMatcher))
+        self.assertEquals(len(matcher.matchers), 2)
+        self.assertEquals(matcher.constraints(), (frozenset(['RunInstances']), frozenset(['bar'])))
+        self.assertTrue(matcher.matches('bar', self.MockAWSRequest('RunInstances')))
+        self.assertFalse(matcher.matches('foo', self.MockAWSRequest('RunInstances')))
+
+        matcher = policy.compile_matcher(policy.AnyMatcher([policy.AWSActionMatcher('RunInstances'), policy.AnyMatcher([policy.AWSActionMatcher('StopInstances')])]))
+        self.assertTrue(isinstance(matcher, policy.AWSActionMatcher))
+        self.assertEquals(matcher.actions, frozenset(['RunInstances', 'StopInstances']))
+
+        self.assertTrue(isinstance(policy.compile_matcher(policy.AnyMatcher([policy.EntityMatcher(['foo']), policy.AlwaysMatcher()])), policy.AlwaysMatcher))
+        self.assertTrue(isinstance(policy.compile_matcher(policy.AllMatcher([policy.EntityMatcher(['foo']), policy.NotMatcher(policy.AlwaysMatcher())])), policy.NeverMatcher))
+        self.assertTrue(isinstance(policy.compile_matcher(policy.AnyMatcher([])), policy.NeverMatcher))
+        entities = policy.EntityMatcher(['foo'])
+        self.assertTrue(policy.compile_matcher(policy.NotMatcher(policy.NotMatcher(entities))) is entities)
+
+    def test_compile_leaves_subclasses_alone(self):
+        class WeekdayMatcher(policy.AllMatcher):
+            weekday = False
+            def matches(self, entity, request):
+                return self.weekday and super(WeekdayMatcher, self).matches(entity, request)
+        class VIPMatcher(policy.EntityMatcher):
+            def matches(self, entity, request):
+                return entity == 'lion-o'
+        weekday = WeekdayMatcher([policy.AWSActionMatcher('RunInstances')])
+        vips = VIPMatcher(['foo'])
+        matcher = policy.compile_matcher(policy.AllMatcher([weekday, vips, policy.EntityMatcher(['foo', 'lion-o'])]))
+        self.assertTrue(weekday in matcher.matchers)
+        self.assertTrue(vips in matcher.matchers)
+        self.assertFalse(matcher.matches('lion-o', self.MockAWSRequest('RunInstances')))
+        weekday.weekday = True
+        self.assertTrue(matcher.matches('lion-o', self.MockAWSRequest('RunInstances')))
+        self.assertTrue(policy.compile_matcher(weekday) is weekday)
+
+    def test_compiled_matchers_reorder_children(self):
+        class CountingMatcher(policy.Matcher):
+            def __init__(self, result, cost=1):
+                self.result = result
+                self.cost = cost
+                self.calls = 0
+            def matches(self, entity, request):
+                self.calls += 1
+                return self.result
+        expensive, cheap = CountingMatcher(False, cost=10), CountingMatcher(False)
+        matcher = policy.compile_matcher(policy.AllMatcher([CountingMatcher(True), expensive, cheap]))
+        for _ in xrange(matcher.REORDER_INTERVAL * 2):
+            self.assertFalse(matcher.matches(None, None))
+        self.assertTrue(matcher.matchers[0] is cheap)
+        self.assertTrue(expensive.calls <= matcher.REORDER_INTERVAL)
+
+
+class DirectoryTests(unittest.TestCase):
+    def setUp(self):
+        self.groups = settings.entity_groups
+        self.kinds = settings.entity_kinds
+        settings.set('entity_groups', {'thundercats': ['lion-o', 'cheetara'], 'leaders': ['lion-o']})
+        settings.set('entity_kinds', {'mutant': ['mumm-ra'], 'human': ['lion-o']})
+        settings.set('institutional_entities', ['hudson'])
+
+    def tearDown(self):
+        settings.set('entity_groups', self.groups)
+        settings.set('entity_kinds', self.kinds)
+        settings.set('institutional_entities', [])
+
+    def test_directory(self):
+        entities = directory.get_directory()
+        self.assertTrue(directory.get_directory() is entities)
+        self.assertEquals(entities.groups_of('lion-o'), frozenset(['thundercats', 'leaders']))
+        self.assertEquals(entities.groups_of('mumm-ra'), frozenset())
+        self.assertTrue(entities.in_group('cheetara', 'thundercats'))
+        self.assertFalse(entities.in_group('cheetara', 'leaders'))
+        self.assertEquals(entities.kind_of('mumm-ra'), 'mutant')
+        self.assertEquals(entities.kind_of('hudson'), directory.INSTITUTIONAL)
+        self.assertEquals(entities.kind_of('cheetara'), None)
+        self.assertTrue(policy.is_institutional('hudson'))
+        self.assertRaises(ValueError, directory.Directory, kinds={'mutant': ['mumm-ra'], 'human': ['mumm-ra']})
+
+    def test_bad_directory_fails_at_startup(self):
+        config = os.environ.get('GOLDENGATE_CONFIG')
+        fd, filename = tempfile.mkstemp(suffix='.py')
+        os.write(fd, 'ENTITY_KINDS = {"mutant": ["hudson"]}\n')
+        os.close(fd)
+        os.environ['GOLDENGATE_CONFIG'] = filename
+        try:
+            # hudson is already institutional.
+            self.assertRaises(ValueError, load_config)
+        finally:
+            if config is None:
+                del os.environ['GOLDENGATE_CONFIG']
+            else:
+                os.environ['GOLDENGATE_CONFIG'] = config
+            os.remove(filename)
+
+    def test_group_changes_are_picked_up(self):
+        request = auth.aws.Request('GET', http.URL('http', 'example.com', '/', {'Action': 'RunInstances'}), [], '', None)
+        policies = [
+            policy.AllowPolicy(policy.AllMatcher([policy.GroupMatcher('leaders'), policy.AWSActionMatcher('RunInstances')])),
+            policy.AllowPolicy(policy.KindMatcher(['mutant'])),
+            policy.deny(),
+        ]
+        # One index throughout, so decisions it cached have to follow the
+        # directory.
+        policies = policy.PolicyIndex(policies)
+        self.assertTrue(policy.Policy.authorize('lion-o', request, policies))
+        self.assertFalse(policy.Policy.authorize('cheetara', request, policies))
+        self.assertTrue(policy.Policy.authorize('mumm-ra', request, policies))
+
+        # Replacing the setting builds a new directory.
+        settings.set('entity_groups', {'leaders': ['cheetara']})
+        self.assertFalse(policy.Policy.authorize('lion-o', request, policies))
+        self.assertTrue(policy.Policy.authorize('cheetara', request, policies))
+
+        # Changes made in place need a reload.
+        settings.entity_groups['leaders'].append('lion-o')
+        self.assertFalse(policy.Policy.authorize('lion-o', request, policies))
+        directory.reload()
+        self.assertTrue(policy.Policy.authorize('lion-o', request, policies))
+
 
 class KVStoreTests(unittest.TestCase):
     def test_bad_backend_uri_raises(self):
@@ -655,6 +2700,16 @@ class KVStoreBackendTests(object):
         self.assertFalse(self.kvstore.has_key('_'))
         self.assertTrue(self.kvstore.get('_') is None)
 
+    def test_add_with_timeout(self):
+        self.kvstore.delete('added')
+        self.wait()
+        self.assertTrue(self.kvstore.add_with_timeout('added', 'first', 60))
+        self.wait()
+        self.assertFalse(self.kvstore.add_with_timeout('added', 'second', 60))
+        self.wait()
+        self.assertEquals(self.kvstore.get('added'), 'first')
+        self.kvstore.delete('added')
+
 
 class LocalMemoryKVStoreTests(unittest.TestCase, KVStoreBackendTests):
     backend = 'locmem://'